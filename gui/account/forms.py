@@ -30,6 +30,7 @@ import re
 
 from django.contrib.auth import authenticate
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from django.utils.translation import ugettext_lazy as _
 from django.http import QueryDict
 
@@ -84,7 +85,7 @@ class NewPasswordForm(Form):
                     username=user.bsdusr_username,
                     password=self.cleaned_data['password'].encode('utf-8'),
                 )
-                notifier().reload("user")
+                notifier().reload("user", wait=False)
         return valid
 
 
@@ -243,6 +244,7 @@ class bsdUsersForm(ModelForm, bsdUserGroupMixin):
             if new.get('bsdusr_group', None) == '-----':
                 new['bsdusr_group'] = ''
             args = (new,) + args[1:]
+        group_choices = kwargs.pop('group_choices', None)
         super(bsdUsersForm, self).__init__(*args, **kwargs)
         self.fields.keyOrder.remove('bsdusr_group')
         self.fields.keyOrder.insert(3, 'bsdusr_group')
@@ -250,10 +252,12 @@ class bsdUsersForm(ModelForm, bsdUserGroupMixin):
             del self.fields['bsdusr_password2']
         self.fields['bsdusr_shell'].choices = self._populate_shell_choices()
         self.fields['bsdusr_shell'].choices.sort()
-        self.fields['bsdusr_to_group'].choices = [
-            (x.id, x.bsdgrp_group)
-            for x in models.bsdGroups.objects.order_by('bsdgrp_group')
-        ]
+        if group_choices is None:
+            group_choices = [
+                (x.id, x.bsdgrp_group)
+                for x in models.bsdGroups.objects.order_by('bsdgrp_group')
+            ]
+        self.fields['bsdusr_to_group'].choices = group_choices
         self.fields['bsdusr_password_disabled'].widget.attrs['onChange'] = (
             'javascript:toggleGeneric("id_bsdusr_password_disabled", '
             '["id_bsdusr_locked", "id_bsdusr_sudo"], false);')
@@ -265,7 +269,10 @@ class bsdUsersForm(ModelForm, bsdUserGroupMixin):
             '["id_bsdusr_password_disabled"], false);')
 
         if not self.instance.id:
-            self.fields['bsdusr_uid'].initial = notifier().user_getnextuid()
+            if not self.is_bound:
+                self.fields['bsdusr_uid'].initial = (
+                    notifier().user_getnextuid()
+                )
             self.fields['bsdusr_home'].label = _('Create Home Directory In')
             self.fields['bsdusr_creategroup'].widget.attrs['onChange'] = (
                 'javascript:toggleGeneric("id_bsdusr_creategroup", '
@@ -646,7 +653,7 @@ class bsdUserPasswordForm(ModelForm):
             self.instance.bsdusr_unixhash = unixhash
             self.instance.bsdusr_smbhash = smbhash
             self.instance.save()
-            _notifier.reload("user")
+            _notifier.reload("user", wait=False)
         return self.instance
 
 
@@ -658,7 +665,7 @@ class bsdUserEmailForm(ModelForm, bsdUserGroupMixin):
 
     def save(self):
         bsduser = super(bsdUserEmailForm, self).save(commit=True)
-        notifier().reload("user")
+        notifier().reload("user", wait=False)
         return bsduser
 
 
@@ -680,7 +687,8 @@ class bsdGroupsForm(ModelForm, bsdUserGroupMixin):
                 'dijitValidationTextBoxDisabled'
             )
         else:
-            self.initial['bsdgrp_gid'] = notifier().user_getnextgid()
+            if not self.is_bound:
+                self.initial['bsdgrp_gid'] = notifier().user_getnextgid()
             self.fields['allow'] = forms.BooleanField(
                 label=_("Allow repeated GIDs"),
                 initial=False,
@@ -728,10 +736,248 @@ class bsdGroupsForm(ModelForm, bsdUserGroupMixin):
         ins = super(bsdGroupsForm, self).save()
         notifier().groupmap_add(unixgroup=self.instance.bsdgrp_group,
             ntgroup=self.instance.bsdgrp_group)
-        notifier().reload("user")
+        notifier().reload("user", wait=False)
         return ins
 
 
+class bsdImportForm(object):
+    """
+    Bulk import of groups and users.
+
+    ``data`` is a dict with optional "groups" and "users" lists, each entry
+    taking the same fields as the group and user API resources.  Groups may
+    be referenced by name, including groups of the same batch, in
+    bsdusr_group and bsdusr_to_group.  A missing bsdusr_uid is allocated.
+
+    The whole batch is validated before anything is written, rows are
+    saved in a single transaction and passwd/group/sudoers and the samba
+    passdb are regenerated once at the end.
+    """
+
+    FIRST_ID = 1000
+
+    def __init__(self, data):
+        self.data = data or {}
+        self.errors = {}
+        self._group_forms = []
+        self._user_forms = []
+
+    def _next_free(self, used, start):
+        while start in used:
+            start += 1
+        return start
+
+    def is_valid(self):
+        groups = self.data.get('groups') or []
+        users = self.data.get('users') or []
+        if not isinstance(groups, list) or not isinstance(users, list):
+            self.errors['__all__'] = [
+                _('"groups" and "users" have to be lists'),
+            ]
+            return False
+
+        existing = dict(
+            models.bsdGroups.objects.values_list('bsdgrp_group', 'id')
+        )
+        gids = set(
+            models.bsdGroups.objects.values_list('bsdgrp_gid', flat=True)
+        )
+        uids = set(
+            models.bsdUsers.objects.values_list('bsdusr_uid', flat=True)
+        )
+
+        group_errors = {}
+        batch_groups = set()
+        for idx, entry in enumerate(groups):
+            form = bsdGroupsForm(data=entry, api_validation=True)
+            if form.is_valid():
+                name = form.cleaned_data['bsdgrp_group']
+                gid = form.cleaned_data['bsdgrp_gid']
+                if name in batch_groups:
+                    form._errors['bsdgrp_group'] = form.error_class([
+                        _("A group with that name already exists."),
+                    ])
+                elif gid in gids and not form.cleaned_data.get('allow'):
+                    form._errors['bsdgrp_gid'] = form.error_class([
+                        _("A group with this gid already exists"),
+                    ])
+                batch_groups.add(name)
+                gids.add(gid)
+            if form.errors:
+                group_errors[idx] = form.errors
+            self._group_forms.append(form)
+
+        choices = sorted(
+            [(v, k) for k, v in existing.items()], key=lambda x: x[1]
+        )
+        user_errors = {}
+        usernames = set()
+        next_uid = self.FIRST_ID
+        for idx, entry in enumerate(users):
+            entry = dict(entry)
+
+            # References to groups of this batch are resolved on save
+            primary = entry.get('bsdusr_group')
+            if primary in batch_groups:
+                entry['bsdusr_group'] = ''
+                entry['bsdusr_creategroup'] = True
+            else:
+                entry['bsdusr_group'] = existing.get(primary, primary)
+                primary = None
+            aux = entry.get('bsdusr_to_group') or []
+            if not isinstance(aux, list):
+                aux = [aux]
+            entry['bsdusr_to_group'] = [
+                existing.get(g, g) for g in aux if g not in batch_groups
+            ]
+            aux = [g for g in aux if g in batch_groups]
+
+            if entry.get('bsdusr_uid') in (None, ''):
+                next_uid = self._next_free(uids, next_uid)
+                entry['bsdusr_uid'] = next_uid
+
+            form = bsdUsersForm(
+                data=entry, api_validation=True, group_choices=choices,
+            )
+            if form.is_valid():
+                username = form.cleaned_data['bsdusr_username']
+                if username in usernames:
+                    form._errors['bsdusr_username'] = form.error_class([
+                        _("A user with that username already exists."),
+                    ])
+                usernames.add(username)
+                uids.add(form.cleaned_data['bsdusr_uid'])
+            if form.errors:
+                user_errors[idx] = form.errors
+            self._user_forms.append((form, primary, aux))
+
+        if group_errors:
+            self.errors['groups'] = group_errors
+        if user_errors:
+            self.errors['users'] = user_errors
+        return not self.errors
+
+    def save(self):
+        _notifier = notifier()
+
+        # Hashing takes a while for large imports, keep it out of the
+        # transaction so other requests are not locked out meanwhile
+        hashes = _notifier.user_hash_many([{
+            'username': str(form.cleaned_data['bsdusr_username']),
+            'uid': form.cleaned_data['bsdusr_uid'],
+            'password': (
+                form.cleaned_data.get('bsdusr_password') or ''
+            ).encode('utf8', 'ignore'),
+            'password_disabled': form.cleaned_data.get(
+                'bsdusr_password_disabled', False
+            ),
+        } for form, primary, aux in self._user_forms])
+
+        gids = set(
+            models.bsdGroups.objects.values_list('bsdgrp_gid', flat=True)
+        )
+        with transaction.atomic():
+            batch = {}
+            created = []
+            for form in self._group_forms:
+                # Skip bsdGroupsForm.save, groupmap and reload are done once
+                group = ModelForm.save(form)
+                batch[group.bsdgrp_group] = group
+                created.append(group)
+                gids.add(group.bsdgrp_gid)
+
+            users, members = [], []
+            next_gid = self.FIRST_ID
+            for (form, primary, aux), (unixhash, smbhash) in zip(
+                self._user_forms, hashes
+            ):
+                cdata = form.cleaned_data
+                username = cdata['bsdusr_username']
+                if primary:
+                    group = batch[primary]
+                elif cdata['bsdusr_group'] is not None:
+                    group = cdata['bsdusr_group']
+                elif username in batch:
+                    group = batch[username]
+                else:
+                    try:
+                        group = models.bsdGroups.objects.get(
+                            bsdgrp_group=username
+                        )
+                    except models.bsdGroups.DoesNotExist:
+                        # Same as pw(8): use the uid as gid if it is free
+                        gid = cdata['bsdusr_uid']
+                        if gid in gids:
+                            next_gid = self._next_free(gids, next_gid)
+                            gid = next_gid
+                        group = models.bsdGroups.objects.create(
+                            bsdgrp_gid=gid,
+                            bsdgrp_group=username,
+                            bsdgrp_builtin=False,
+                        )
+                        created.append(group)
+                        gids.add(gid)
+                    batch[username] = group
+
+                bsduser = ModelForm.save(form, commit=False)
+                bsduser.bsdusr_group = group
+                bsduser.bsdusr_uid = cdata['bsdusr_uid']
+                bsduser.bsdusr_shell = cdata['bsdusr_shell']
+                bsduser.bsdusr_unixhash = unixhash
+                bsduser.bsdusr_smbhash = smbhash
+                bsduser.bsdusr_builtin = False
+                bsduser.save()
+                users.append(bsduser)
+                groupids = set(int(g) for g in cdata['bsdusr_to_group'])
+                groupids.update(batch[name].id for name in aux)
+                for groupid in groupids:
+                    members.append(models.bsdGroupMembership(
+                        bsdgrpmember_group_id=groupid,
+                        bsdgrpmember_user=bsduser,
+                    ))
+            models.bsdGroupMembership.objects.bulk_create(members)
+
+        # The home directories are only created once the users are in the
+        # database; should that fail, drop the batch again.  Nothing else
+        # refers to it yet, the passwd database is regenerated below.
+        try:
+            _notifier.user_homedir_create_many([{
+                'uid': user.bsdusr_uid,
+                'gid': user.bsdusr_group.bsdgrp_gid,
+                'homedir': str(user.bsdusr_home),
+                'homedir_mode': int(
+                    f.cleaned_data.get('bsdusr_mode') or '755', 8
+                ),
+            } for (f, primary, aux), user in zip(self._user_forms, users)])
+        except:
+            with transaction.atomic():
+                models.bsdUsers.objects.filter(
+                    id__in=[u.id for u in users]
+                ).delete()
+                models.bsdGroups.objects.filter(
+                    id__in=[g.id for g in created]
+                ).delete()
+            raise
+
+        for form in self._group_forms:
+            _notifier.groupmap_add(
+                unixgroup=form.instance.bsdgrp_group,
+                ntgroup=form.instance.bsdgrp_group,
+            )
+        _notifier.reload("user")
+        _notifier.user_import_smbhashes([u.bsdusr_smbhash for u in users])
+
+        for (form, primary, aux), bsduser in zip(self._user_forms, users):
+            if form.cleaned_data.get('bsdusr_sshpubkey'):
+                _notifier.save_pubkey(
+                    bsduser.bsdusr_home,
+                    form.cleaned_data['bsdusr_sshpubkey'],
+                    bsduser.bsdusr_username,
+                    bsduser.bsdusr_group.bsdgrp_group,
+                )
+        return users
+
+
 class bsdGroupToUserForm(Form):
     bsdgroup_to_user = SelectMultipleField(
         label=_('Member users'),
@@ -765,7 +1011,7 @@ class bsdGroupToUserForm(Form):
                 bsdgrpmember_group=group,
                 bsdgrpmember_user=user)
             m.save()
-        notifier().reload("user")
+        notifier().reload("user", wait=False)
 
 
 class bsdUserToGroupForm(Form):
@@ -810,7 +1056,7 @@ class bsdUserToGroupForm(Form):
                 bsdgrpmember_group=group,
                 bsdgrpmember_user=user)
             m.save()
-        notifier().reload("user")
+        notifier().reload("user", wait=False)
 
 
 class DeleteGroupForm(forms.Form):
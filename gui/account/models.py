@@ -76,7 +76,7 @@ class bsdGroups(Model):
             Samba4().group_delete(self.bsdgrp_group.encode('utf-8'))
         super(bsdGroups, self).delete(using)
         if reload:
-            notifier().reload("user")
+            notifier().reload("user", wait=False)
 
 
 def get_sentinel_group():
@@ -249,7 +249,7 @@ class bsdUsers(Model):
             pass
         super(bsdUsers, self).delete(using)
         if reload:
-            notifier().reload("user")
+            notifier().reload("user", wait=False)
 
     def save(self, *args, **kwargs):
         #TODO: Add last_login field
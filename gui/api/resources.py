@@ -43,6 +43,7 @@ from dojango.forms.models import inlineformset_factory
 from freenasOS import Update
 from freenasUI import choices
 from freenasUI.account.forms import (
+    bsdImportForm,
     bsdUsersForm,
     bsdUserPasswordForm,
 )
@@ -50,6 +51,7 @@ from freenasUI.account.forms import bsdUserToGroupForm
 from freenasUI.account.models import bsdUsers, bsdGroups, bsdGroupMembership
 from freenasUI.api.utils import DojoResource
 from freenasUI.common import humanize_size, humanize_number_si
+from freenasUI.common.freenasusers import user_index, group_index
 from freenasUI.common.system import (
     get_sw_login_version,
     get_sw_name,
@@ -113,6 +115,39 @@ def _common_human_fields(bundle):
         bundle.data[human] = getattr(bundle.obj, "get_%s" % human)()
 
 
+class PrincipalSearchMixin(object):
+    """
+    Name completion for users and groups, answered from the in-memory
+    index instead of enumerating the directory service.
+
+    GET parameters: ``q`` (query), ``limit`` (default 50, at most 1000)
+    and ``substring`` to match anywhere in the name.
+    """
+
+    def _principal_search(self, request, index, idfield):
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+
+        try:
+            limit = int(request.GET.get('limit', 50))
+        except ValueError:
+            raise ImmediateHttpResponse(
+                response=self.error_response(request, {
+                    'limit': [_('Enter a whole number.')],
+                })
+            )
+        limit = max(1, min(limit, 1000))
+
+        results = index.search(
+            request.GET.get('q'),
+            limit=limit,
+            substring=request.GET.get('substring') in ('1', 'true'),
+        )
+        return self.create_response(request, [
+            {'name': name, idfield: id} for name, id in results
+        ])
+
+
 class NestedMixin(object):
 
     def _get_parent(self, request, kwargs):
@@ -931,6 +966,8 @@ class ReplicationResourceMixin(object):
     def dehydrate(self, bundle):
         bundle = super(ReplicationResourceMixin, self).dehydrate(bundle)
         bundle.data['repl_status'] = bundle.obj.status
+        bundle.data['repl_lastthroughput'] = bundle.obj.repl_lastthroughput
+        bundle.data['repl_progress'] = bundle.obj.repl_progress
         bundle.data['repl_remote_hostname'] = (
             bundle.obj.repl_remote.ssh_remote_hostname
         )
@@ -1477,7 +1514,7 @@ class ISCSITargetExtentResourceMixin(object):
         return bundle
 
 
-class BsdUserResourceMixin(NestedMixin):
+class BsdUserResourceMixin(NestedMixin, PrincipalSearchMixin):
 
     class Meta:
         queryset = bsdUsers.objects.all().order_by(
@@ -1487,6 +1524,18 @@ class BsdUserResourceMixin(NestedMixin):
 
     def prepend_urls(self):
         return [
+            url(
+                r"^(?P<resource_name>%s)/import%s$" % (
+                    self._meta.resource_name, trailing_slash()
+                ),
+                self.wrap_view('bulk_import')
+            ),
+            url(
+                r"^(?P<resource_name>%s)/search%s$" % (
+                    self._meta.resource_name, trailing_slash()
+                ),
+                self.wrap_view('search')
+            ),
             url(
                 r"^(?P<resource_name>%s)/(?P<pk>\w[\w/-]*)/groups%s$" % (
                     self._meta.resource_name, trailing_slash()
@@ -1501,6 +1550,40 @@ class BsdUserResourceMixin(NestedMixin):
             ),
         ]
 
+    def bulk_import(self, request, **kwargs):
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+
+        deserialized = self.deserialize(
+            request,
+            request.body,
+            format=request.META.get('CONTENT_TYPE', 'application/json'),
+        )
+        form = bsdImportForm(deserialized)
+        if not form.is_valid():
+            raise ImmediateHttpResponse(
+                response=self.error_response(request, form.errors)
+            )
+        try:
+            users = form.save()
+        except MiddlewareError, e:
+            raise ImmediateHttpResponse(
+                response=self.error_response(request, {
+                    'error': e.value,
+                })
+            )
+
+        bundles = []
+        for obj in users:
+            bundle = self.build_bundle(obj=obj, request=request)
+            bundles.append(self.full_dehydrate(bundle))
+        return self.create_response(
+            request, bundles, response_class=HttpCreated
+        )
+
+    def search(self, request, **kwargs):
+        return self._principal_search(request, user_index, 'uid')
+
     def groups(self, request, **kwargs):
         if request.method.lower() not in ('post', 'get'):
             response = HttpMethodNotAllowed(request.method)
@@ -1628,11 +1711,24 @@ class BsdUserResourceMixin(NestedMixin):
         return bundle
 
 
-class BsdGroupResourceMixin(object):
+class BsdGroupResourceMixin(PrincipalSearchMixin):
 
     class Meta:
         queryset = bsdGroups.objects.order_by('bsdgrp_builtin', 'bsdgrp_gid')
 
+    def prepend_urls(self):
+        return [
+            url(
+                r"^(?P<resource_name>%s)/search%s$" % (
+                    self._meta.resource_name, trailing_slash()
+                ),
+                self.wrap_view('search')
+            ),
+        ]
+
+    def search(self, request, **kwargs):
+        return self._principal_search(request, group_index, 'gid')
+
     def dehydrate(self, bundle):
         bundle = super(BsdGroupResourceMixin, self).dehydrate(bundle)
         if self.is_webclient(bundle.request):
@@ -1867,49 +1963,51 @@ class SnapshotResource(DojoResource):
         resource_name = 'storage/snapshot'
         max_limit = 0
 
-    def get_list(self, request, **kwargs):
+    def prepend_urls(self):
+        return [
+            url(
+                r"^(?P<resource_name>%s)/bulk_delete%s$" % (
+                    self._meta.resource_name, trailing_slash()
+                ),
+                self.wrap_view('bulk_delete')
+            ),
+        ]
 
-        # Get a list of snapshots in remote sides to show whether it has been
-        # transfered already or not
-        repli = {}
-        for repl in Replication.objects.all():
-            """
-            Multiple replications tasks can have the same remote host.
-            We can't get the list of snapshots on the remote side multiple
-            times, make sure we don't do that.
-            """
-            found = False
-            for _repl, snaps in repli.items():
-                if _repl.repl_remote.ssh_remote_hostname == \
-                    repl.repl_remote.ssh_remote_hostname and \
-                    _repl.repl_remote.ssh_remote_port == \
-                    repl.repl_remote.ssh_remote_port:
-                    found = True
-                    repli[repl] = snaps
-                    break
-            if found is False:
-                repli[repl] = notifier().repl_remote_snapshots(repl)
+    def _get_timestamp(self, request, name):
+        value = request.GET.get(name)
+        if not value:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise ImmediateHttpResponse(
+                response=self.error_response(request, {
+                    name: _('Must be a unix timestamp'),
+                })
+            )
 
-        snapshots = notifier().zfs_snapshot_list(replications=repli)
+    def get_list(self, request, **kwargs):
 
-        results = []
-        for snaps in snapshots.values():
-            results.extend(snaps)
         FIELD_MAP = {
             'extra': 'mostrecent',
         }
-
+        ordering = []
         for sfield in self._apply_sorting(request.GET):
             if sfield.startswith('-'):
-                field = sfield[1:]
-                reverse = True
+                ordering.append('-' + FIELD_MAP.get(sfield[1:], sfield[1:]))
             else:
-                field = sfield
-                reverse = False
-            field = FIELD_MAP.get(field, field)
-            results.sort(
-                key=lambda item: getattr(item, field),
-                reverse=reverse)
+                ordering.append(FIELD_MAP.get(sfield, sfield))
+
+        store = notifier().zfs_snapshot_store()
+        results = store.query(
+            dataset=request.GET.get('dataset') or None,
+            recursive=request.GET.get('recursive') in ('1', 'true'),
+            prefix=request.GET.get('prefix') or None,
+            pattern=request.GET.get('name') or None,
+            created_after=self._get_timestamp(request, 'created_after'),
+            created_before=self._get_timestamp(request, 'created_before'),
+            ordering=ordering,
+        )
 
         limit = self._meta.limit
         if 'HTTP_X_RANGE' in request.META:
@@ -1925,11 +2023,25 @@ class SnapshotResource(DojoResource):
             max_limit=self._meta.max_limit,
             collection_name=self._meta.collection_name,
         )
+        # Keyset pagination, continue right after the given snapshot
+        if request.GET.get('after'):
+            paginator.offset = store.offset_after(
+                results, request.GET.get('after')
+            )
         to_be_serialized = paginator.page()
+        objects = to_be_serialized[self._meta.collection_name]
+
+        # Snapshots in remote sides show whether it has been transfered
+        # already or not, only checked for the snapshots being returned
+        repli = notifier().repl_remote_snapshots_many(
+            Replication.objects.all()
+        )
+        notifier().zfs_snapshot_replication(objects, repli)
+
         # Dehydrate the bundles in preparation for serialization.
         bundles = []
 
-        for obj in to_be_serialized[self._meta.collection_name]:
+        for obj in objects:
             bundle = self.build_bundle(obj=obj, request=request)
             bundles.append(self.full_dehydrate(bundle))
 
@@ -1982,17 +2094,24 @@ class SnapshotResource(DojoResource):
                 })
             )
         dataset, name = kwargs['pk'].split('@', 1)
-        snap = notifier().zfs_snapshot_list(path='%s@%s' % (
-            dataset,
-            name,
-        )).values()
-        if not snap:
-            raise ImmediateHttpResponse(
-                response=self.error_response(bundle.request, {
-                    'error': _('Invalid snapshot'),
-                })
-            )
-        snap = snap[0][0]
+        snap = None
+        for obj in notifier().zfs_snapshot_store().query(dataset=dataset):
+            if obj.name == name:
+                snap = obj
+                break
+        if snap is None:
+            # Might have been taken after the store was built
+            snap = notifier().zfs_snapshot_list(path='%s@%s' % (
+                dataset,
+                name,
+            )).values()
+            if not snap:
+                raise ImmediateHttpResponse(
+                    response=self.error_response(bundle.request, {
+                        'error': _('Invalid snapshot'),
+                    })
+                )
+            snap = snap[0][0]
 
         try:
             notifier().destroy_zfs_dataset(path=kwargs['pk'].encode('utf8'))
@@ -2012,6 +2131,40 @@ class SnapshotResource(DojoResource):
             response_class=HttpAccepted,
         )
 
+    def bulk_delete(self, request, **kwargs):
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+
+        deserialized = self.deserialize(
+            request,
+            request.body,
+            format=request.META.get('CONTENT_TYPE', 'application/json'),
+        )
+        snapshots = None
+        if isinstance(deserialized, dict):
+            snapshots = deserialized.get('snapshots')
+        if (
+            not isinstance(snapshots, list) or not snapshots or
+            [s for s in snapshots if not isinstance(s, basestring)]
+        ):
+            raise ImmediateHttpResponse(
+                response=self.error_response(request, {
+                    'snapshots': [_('A list of snapshot names is required.')],
+                })
+            )
+
+        results = notifier().destroy_zfs_snapshots(
+            [s.encode('utf8') for s in snapshots]
+        )
+        if [err for err in results.values() if not err]:
+            notifier().reload('collectd', wait=False)
+
+        return self.create_response(request, [{
+            'snapshot': snapshot,
+            'destroyed': not err,
+            'error': err or None,
+        } for snapshot, err in results.items()])
+
     def dehydrate(self, bundle):
         if self.is_webclient(bundle.request):
             bundle.data['used'] = humanize_size(bundle.data['used'])
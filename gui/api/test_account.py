@@ -187,6 +187,103 @@ class UsersResourceTest(APITestCase):
         self.assertEqual(data, ["mail"])
 
 
+    def test_Import(self):
+        resp = self.api_client.post(
+            '%simport/' % self.get_api_url(),
+            format='json',
+            data={
+                'groups': [{
+                    'bsdgrp_gid': 1200,
+                    'bsdgrp_group': 'students',
+                }],
+                'users': [{
+                    'bsdusr_username': 'juca',
+                    'bsdusr_home': '/nonexistent',
+                    'bsdusr_creategroup': True,
+                    'bsdusr_password': '12345',
+                    'bsdusr_shell': '/usr/local/bin/bash',
+                    'bsdusr_full_name': 'Juca Xunda',
+                    'bsdusr_to_group': ['students'],
+                }, {
+                    'bsdusr_uid': 1300,
+                    'bsdusr_username': 'zeca',
+                    'bsdusr_home': '/nonexistent',
+                    'bsdusr_group': 'students',
+                    'bsdusr_password': '12345',
+                    'bsdusr_shell': '/usr/local/bin/bash',
+                    'bsdusr_full_name': 'Zeca Xunda',
+                }],
+            }
+        )
+        self.assertHttpCreated(resp)
+        data = self.deserialize(resp)
+        self.assertEqual(
+            [u['bsdusr_username'] for u in data], [u'juca', u'zeca']
+        )
+        self.assertEqual(data[1]['bsdusr_uid'], 1300)
+        self.assertEqual(data[1]['bsdusr_group'], 1200)
+        juca = models.bsdUsers.objects.get(bsdusr_username='juca')
+        self.assertEqual(juca.bsdusr_group.bsdgrp_group, 'juca')
+        self.assertEqual(
+            [m.bsdgrpmember_group.bsdgrp_group
+             for m in juca.bsdgroupmembership_set.all()],
+            ['students'],
+        )
+
+    def test_Import_invalid(self):
+        resp = self.api_client.post(
+            '%simport/' % self.get_api_url(),
+            format='json',
+            data={
+                'users': [{
+                    'bsdusr_username': 'juca',
+                    'bsdusr_home': '/nonexistent',
+                    'bsdusr_creategroup': True,
+                    'bsdusr_password': '12345',
+                    'bsdusr_shell': '/usr/local/bin/bash',
+                    'bsdusr_full_name': 'Juca Xunda',
+                }, {
+                    'bsdusr_username': 'juca',
+                    'bsdusr_home': '/nonexistent',
+                    'bsdusr_creategroup': True,
+                    'bsdusr_password': '12345',
+                    'bsdusr_shell': '/usr/local/bin/bash',
+                    'bsdusr_full_name': 'Juca Xunda',
+                }],
+            }
+        )
+        self.assertHttpBadRequest(resp)
+        self.assertFalse(
+            models.bsdUsers.objects.filter(bsdusr_username='juca').exists()
+        )
+
+    def test_Search(self):
+        models.bsdUsers.objects.create(
+            bsdusr_uid=1100,
+            bsdusr_group=models.bsdGroups.objects.create(
+                bsdgrp_gid=1101,
+                bsdgrp_group='juca'
+            ),
+            bsdusr_username='juca',
+            bsdusr_shell='/usr/local/bin/bash',
+            bsdusr_full_name='Juca Xunda',
+        )
+        resp = self.api_client.get(
+            '%ssearch/?q=JU' % self.get_api_url(),
+            format='json',
+        )
+        self.assertHttpOK(resp)
+        data = self.deserialize(resp)
+        self.assertIn({u'name': u'juca', u'uid': 1100}, data)
+
+    def test_Search_invalid_limit(self):
+        resp = self.api_client.get(
+            '%ssearch/?q=ju&limit=abc' % self.get_api_url(),
+            format='json',
+        )
+        self.assertHttpBadRequest(resp)
+
+
 class GroupsResourceTest(APITestCase):
 
     def test_get_list_unauthorzied(self):
@@ -261,3 +358,16 @@ class GroupsResourceTest(APITestCase):
             format='json',
         )
         self.assertHttpAccepted(resp)
+
+    def test_Search(self):
+        models.bsdGroups.objects.create(
+            bsdgrp_gid=1100,
+            bsdgrp_group='testgroup',
+        )
+        resp = self.api_client.get(
+            '%ssearch/?q=ing&substring=1' % self.get_api_url(),
+            format='json',
+        )
+        self.assertHttpOK(resp)
+        data = self.deserialize(resp)
+        self.assertIn({u'name': u'testgroup', u'gid': 1100}, data)
@@ -493,3 +493,21 @@ class ReplicationResourceTest(APITestCase):
             format='json',
         )
         self.assertHttpAccepted(resp)
+
+
+class SnapshotResourceTest(APITestCase):
+
+    def test_get_list_unauthorzied(self):
+        self.assertHttpUnauthorized(
+            self.client.get(self.get_api_url(), format='json')
+        )
+
+    def test_Bulk_Delete_invalid(self):
+        resp = self.api_client.post(
+            '%sbulk_delete/' % self.get_api_url(),
+            format='json',
+            data={
+                'snapshots': 'tank@auto-20150101.0000-2w',
+            }
+        )
+        self.assertHttpBadRequest(resp)
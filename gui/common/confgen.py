@@ -0,0 +1,522 @@
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Renderers for the flat configuration files historically generated by
+the ix.rc.d shell scripts (group, master.passwd, exports, crontab).
+
+Every renderer declares the SQL it needs; ConfigSnapshot runs all of
+them inside a single read transaction so a regeneration costs one
+connection to the config database no matter how many groups, users or
+shares there are.  A file is only replaced, and its reload hook only
+run, when the rendered content differs from what is on disk.
+"""
+import grp
+import hashlib
+import logging
+import os
+import pwd
+import sqlite3
+import subprocess
+import tempfile
+
+from freenasUI.common.system import FREENAS_DATABASE
+
+log = logging.getLogger('common.confgen')
+
+CRON_PATH = (
+    '/bin:/sbin:/usr/bin:/usr/sbin:/usr/local/bin:/usr/local/sbin:/root/bin'
+)
+NIS_PWDSTR = '+:::::::::'
+NIS_GRPSTR = '+:*::'
+
+
+class ConfigSnapshot(object):
+    """
+    Result of running a set of named queries against the config database
+    in one transaction.  Rows are sqlite3.Row objects, indexed by name.
+    """
+
+    def __init__(self, queries, database=FREENAS_DATABASE):
+        self._rows = {}
+        conn = sqlite3.connect(database, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN')
+            for name, sql in queries.items():
+                try:
+                    cursor.execute(sql)
+                except sqlite3.OperationalError, e:
+                    # Tables of optional apps may not exist yet
+                    log.debug("Query %s failed: %s", name, e)
+                    self._rows[name] = []
+                    continue
+                self._rows[name] = cursor.fetchall()
+            cursor.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def __getitem__(self, name):
+        return self._rows[name]
+
+    def first(self, name, default=None):
+        rows = self._rows[name]
+        if rows:
+            return rows[0]
+        return default
+
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return content_digest(f.read())
+    except IOError:
+        return None
+
+
+def write_if_changed(path, content, mode=0644, install=os.rename):
+    """
+    Atomically replace ``path`` with ``content`` unless the file already
+    holds exactly that content.  The content is written to a temporary
+    file in the same directory, ``install(tmp, path)`` puts it in place.
+
+    Returns True if the file was written.
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf8')
+    if file_digest(path) == content_digest(content):
+        return False
+    dirname = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.%s.' % (
+        os.path.basename(path),
+    ))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmp, mode)
+        install(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return True
+
+
+class Renderer(object):
+    """
+    Base class for config file renderers.
+
+    Subclasses set ``queries`` (name -> SQL) and implement render(), which
+    returns a dict mapping target path to file content.  install() puts a
+    changed file in place, and should raise if that fails so the file is
+    left as it was.  reload() is called with the list of paths that
+    actually changed.
+    """
+
+    name = None
+    queries = {}
+    modes = {}
+
+    def render(self, snapshot):
+        raise NotImplementedError
+
+    def install(self, tmp, path):
+        os.rename(tmp, path)
+
+    def reload(self, changed):
+        pass
+
+    def write(self, snapshot):
+        changed = []
+        for path, content in sorted(self.render(snapshot).items()):
+            if write_if_changed(
+                path, content, self.modes.get(path, 0644), self.install
+            ):
+                changed.append(path)
+        if changed:
+            self.reload(changed)
+        return changed
+
+
+def _lines(lines):
+    if not lines:
+        return ''
+    return '\n'.join(lines) + '\n'
+
+
+class PasswdRenderer(Renderer):
+
+    name = 'passwd'
+    queries = {
+        'users': """
+            SELECT
+                u.bsdusr_username, u.bsdusr_unixhash, u.bsdusr_uid,
+                g.bsdgrp_gid, u.bsdusr_full_name, u.bsdusr_home,
+                u.bsdusr_shell, u.bsdusr_password_disabled, u.bsdusr_locked
+            FROM account_bsdusers AS u
+            INNER JOIN account_bsdgroups AS g ON u.bsdusr_group_id = g.id
+            ORDER BY u.id
+        """,
+        'groups': """
+            SELECT id, bsdgrp_group, bsdgrp_gid
+            FROM account_bsdgroups
+            ORDER BY id
+        """,
+        'members': """
+            SELECT m.bsdgrpmember_group_id, u.bsdusr_username
+            FROM account_bsdgroupmembership AS m
+            INNER JOIN account_bsdusers AS u ON m.bsdgrpmember_user_id = u.id
+            ORDER BY m.id
+        """,
+        'nis': """
+            SELECT nis_enable FROM directoryservice_nis
+            ORDER BY id DESC LIMIT 1
+        """,
+    }
+    modes = {
+        '/etc/master.passwd': 0600,
+    }
+
+    def render(self, snapshot):
+        nis = snapshot.first('nis')
+        nis = bool(nis and nis['nis_enable'])
+
+        passwd = []
+        for u in snapshot['users']:
+            if u['bsdusr_password_disabled']:
+                password = '*'
+            elif u['bsdusr_locked']:
+                password = '*LOCKED*'
+            else:
+                password = u['bsdusr_unixhash']
+            passwd.append(u'%s:%s:%s:%s::0:0:%s:%s:%s' % (
+                u['bsdusr_username'],
+                password,
+                u['bsdusr_uid'],
+                u['bsdgrp_gid'],
+                u['bsdusr_full_name'],
+                u['bsdusr_home'],
+                u['bsdusr_shell'],
+            ))
+        if nis:
+            passwd.append(NIS_PWDSTR)
+
+        members = {}
+        for m in snapshot['members']:
+            members.setdefault(m['bsdgrpmember_group_id'], []).append(
+                m['bsdusr_username']
+            )
+        group = []
+        for g in snapshot['groups']:
+            group.append(u'%s:*:%s:%s' % (
+                g['bsdgrp_group'],
+                g['bsdgrp_gid'],
+                ','.join(members.get(g['id'], [])),
+            ))
+        if nis:
+            group.append(NIS_GRPSTR)
+
+        return {
+            '/etc/group': _lines(group),
+            '/etc/master.passwd': _lines(passwd),
+        }
+
+    def install(self, tmp, path):
+        if path != '/etc/master.passwd':
+            return super(PasswdRenderer, self).install(tmp, path)
+        # pwd_mkdb only moves the file to /etc/master.passwd once the
+        # databases are built.  Should it fail, the file on disk still
+        # differs from the rendered one and the next run tries again.
+        proc = subprocess.Popen(
+            ['/usr/sbin/pwd_mkdb', '-p', tmp],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            close_fds=True,
+        )
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise IOError("pwd_mkdb failed: %s" % output.strip())
+
+
+def _map_user(user):
+    # mountd cannot parse names with spaces, hand it the uid instead
+    if ' ' in user:
+        try:
+            return str(pwd.getpwnam(user.encode('utf8')).pw_uid)
+        except KeyError:
+            pass
+    return user
+
+
+def _map_group(group):
+    if ' ' in group:
+        try:
+            return str(grp.getgrnam(group.encode('utf8')).gr_gid)
+        except KeyError:
+            pass
+    return group
+
+
+class ExportsRenderer(Renderer):
+
+    name = 'exports'
+    queries = {
+        'nfs': """
+            SELECT nfs_srv_v4 FROM services_nfs ORDER BY id DESC LIMIT 1
+        """,
+        'shares': """
+            SELECT
+                id, nfs_network, nfs_hosts, nfs_alldirs, nfs_ro, nfs_quiet,
+                nfs_maproot_user, nfs_maproot_group, nfs_mapall_user,
+                nfs_mapall_group, nfs_security
+            FROM sharing_nfs_share
+            ORDER BY id DESC
+        """,
+        'paths': """
+            SELECT p.share_id, p.path
+            FROM sharing_nfs_share_path AS p
+            INNER JOIN sharing_nfs_share AS s ON p.share_id = s.id
+            ORDER BY p.id DESC
+        """,
+    }
+
+    def render(self, snapshot):
+        nfs = snapshot.first('nfs')
+        v4 = bool(nfs and nfs['nfs_srv_v4'])
+
+        paths = {}
+        for p in snapshot['paths']:
+            if os.path.isdir(p['path']):
+                paths.setdefault(p['share_id'], []).append(p['path'])
+
+        lines = []
+        if v4:
+            lines.append('V4: /')
+        for share in snapshot['shares']:
+            if share['id'] not in paths:
+                continue
+            line = [' '.join(paths[share['id']])]
+            if share['nfs_alldirs']:
+                line.append('-alldirs')
+            if share['nfs_ro']:
+                line.append('-ro')
+            if share['nfs_quiet']:
+                line.append('-quiet')
+            if share['nfs_mapall_user'] or share['nfs_mapall_group']:
+                line.append('-mapall=%s:%s' % (
+                    _map_user(share['nfs_mapall_user'] or ''),
+                    _map_group(share['nfs_mapall_group'] or ''),
+                ))
+            elif share['nfs_maproot_user'] or share['nfs_maproot_group']:
+                line.append('-maproot=%s:%s' % (
+                    _map_user(share['nfs_maproot_user'] or ''),
+                    _map_group(share['nfs_maproot_group'] or ''),
+                ))
+            if v4 and share['nfs_security']:
+                line.append('-sec=%s' % share['nfs_security'].replace(
+                    ',', ':'
+                ))
+            line = ' '.join(line)
+
+            networks = (share['nfs_network'] or '').split()
+            for network in networks:
+                lines.append('%s -network %s' % (line, network))
+            if share['nfs_hosts']:
+                lines.append('%s %s' % (line, share['nfs_hosts']))
+            elif not networks:
+                lines.append(line)
+
+        return {'/etc/exports': _lines(lines)}
+
+    def reload(self, changed):
+        subprocess.call(['/usr/sbin/service', 'mountd', 'quietreload'])
+
+
+class CrontabRenderer(Renderer):
+    """
+    Renders /etc/crontab from the base crontab plus cron jobs, rsync tasks,
+    scrubs, autosnap and the update check.
+
+    The ix-crontab-custom-* shell snippets are still sourced by ix-crontab
+    after this renderer runs.
+    """
+
+    name = 'crontab'
+    base = '/conf/base/etc/crontab'
+    queries = {
+        'cronjobs': """
+            SELECT
+                cron_minute, cron_hour, cron_daymonth, cron_month,
+                cron_dayweek, cron_user, cron_command, cron_stdout,
+                cron_stderr
+            FROM tasks_cronjob
+            WHERE cron_enabled = 1
+            ORDER BY id
+        """,
+        'rsyncs': """
+            SELECT * FROM tasks_rsync WHERE rsync_enabled = 1 ORDER BY id
+        """,
+        'scrubs': """
+            SELECT
+                s.scrub_threshold, s.scrub_minute, s.scrub_hour,
+                s.scrub_daymonth, s.scrub_month, s.scrub_dayweek, v.vol_name
+            FROM storage_scrub AS s
+            INNER JOIN storage_volume AS v ON s.scrub_volume_id = v.id
+            WHERE s.scrub_enabled = 1
+            ORDER BY v.id
+        """,
+        'snaptasks': """
+            SELECT COUNT(id) AS count FROM storage_task
+            WHERE task_enabled = 1
+        """,
+    }
+
+    def _update_check(self):
+        from freenasUI.middleware.notifier import notifier
+        try:
+            _n = notifier()
+            train = _n.get_train()
+            location = _n.get_update_location()
+        except Exception, e:
+            log.warn("Failed to get update train: %s", e)
+            return None
+        if not train:
+            return None
+        # Spread the check across machines but keep it stable for a given
+        # host so regenerating the crontab does not rewrite it every time.
+        try:
+            with open('/etc/hostid', 'r') as f:
+                seed = f.read().strip()
+        except IOError:
+            seed = os.uname()[1]
+        seed = int(hashlib.md5(seed).hexdigest()[:8], 16)
+        return '%d\t%d\t*\t*\t*\troot\t/usr/local/bin/freenas-update ' \
+            '-C %s -T %s check > /dev/null 2>&1' % (
+                seed % 60, seed / 60 % 4 + 1, location, train,
+            )
+
+    def render(self, snapshot):
+        from freenasUI.tasks.models import Rsync
+
+        with open(self.base, 'r') as f:
+            content = f.read().decode('utf8')
+
+        lines = []
+        for c in snapshot['cronjobs']:
+            line = u'\t'.join([
+                c['cron_minute'], c['cron_hour'], c['cron_daymonth'],
+                c['cron_month'], c['cron_dayweek'], c['cron_user'],
+                u'PATH="%s" %s' % (
+                    CRON_PATH,
+                    c['cron_command'].replace('\n', '').replace(
+                        '%', '\\%', 1
+                    ),
+                ),
+            ])
+            if c['cron_stdout']:
+                line += ' > /dev/null'
+            if c['cron_stderr']:
+                line += ' 2> /dev/null'
+            lines.append(line)
+
+        for r in snapshot['rsyncs']:
+            rsync = Rsync(**dict(zip(r.keys(), r)))
+            lines.append(u'\t'.join([
+                r['rsync_minute'], r['rsync_hour'], r['rsync_daymonth'],
+                r['rsync_month'], r['rsync_dayweek'], r['rsync_user'],
+                u'PATH="%s" %s 2>&1 |/usr/bin/logger -t rsync' % (
+                    CRON_PATH, rsync.commandline(),
+                ),
+            ]))
+
+        for s in snapshot['scrubs']:
+            lines.append(u'\t'.join([
+                s['scrub_minute'], s['scrub_hour'], s['scrub_daymonth'],
+                s['scrub_month'], s['scrub_dayweek'], u'root',
+                u'PATH="%s" /usr/local/sbin/scrub -t %s %s' % (
+                    CRON_PATH, s['scrub_threshold'], s['vol_name'],
+                ),
+            ]))
+
+        if snapshot.first('snaptasks')['count'] > 0:
+            when = '*\t*\t*\t*\t*'
+        else:
+            when = '15\t4\t*\t*\t6'
+        lines.append(
+            '%s\troot\t/usr/local/bin/python '
+            '/usr/local/www/freenasUI/tools/autosnap.py '
+            '> /dev/null 2>&1' % when
+        )
+
+        update = self._update_check()
+        if update:
+            lines.append(update)
+
+        return {'/etc/crontab': content + _lines(lines)}
+
+
+class _Scoped(object):
+
+    def __init__(self, snapshot, prefix):
+        self._snapshot = snapshot
+        self._prefix = prefix
+
+    def __getitem__(self, name):
+        return self._snapshot['%s.%s' % (self._prefix, name)]
+
+    def first(self, name, default=None):
+        return self._snapshot.first('%s.%s' % (self._prefix, name), default)
+
+
+RENDERERS = dict(
+    (r.name, r) for r in (PasswdRenderer, ExportsRenderer, CrontabRenderer)
+)
+
+
+def generate(names):
+    """
+    Render the named targets from one read of the config database.
+    Returns a dict mapping renderer name to the list of changed paths.
+    """
+    renderers = [RENDERERS[name]() for name in names]
+    queries = {}
+    for renderer in renderers:
+        for qname, sql in renderer.queries.items():
+            queries['%s.%s' % (renderer.name, qname)] = sql
+    snapshot = ConfigSnapshot(queries)
+
+    changed = {}
+    for renderer in renderers:
+        changed[renderer.name] = renderer.write(
+            _Scoped(snapshot, renderer.name)
+        )
+    return changed
+
@@ -25,11 +25,17 @@
 #
 #####################################################################
 
-import os
-import cPickle as pickle
+import contextlib
+import errno
+import grp
 import logging
+import marshal
+import os
+import pwd
+import sqlite3
+import threading
+import time
 
-from bsddb3 import db
 from freenasUI.common.system import (
     get_freenas_var,
     ldap_enabled,
@@ -44,6 +50,12 @@ log = logging.getLogger('common.frenascache')
 FREENAS_CACHEDIR = get_freenas_var("FREENAS_CACHEDIR", "/var/tmp/.cache")
 FREENAS_CACHEEXPIRE = int(get_freenas_var("FREENAS_CACHEEXPIRE", 60))
 
+#
+# Entries outlive the nightly cachetool fill so a refill always lands
+# before they go stale.
+#
+FREENAS_CACHE_TTL = int(get_freenas_var("FREENAS_CACHE_TTL", 90000))
+
 FREENAS_USERCACHE = os.path.join(FREENAS_CACHEDIR, ".users")
 FREENAS_GROUPCACHE = os.path.join(FREENAS_CACHEDIR, ".groups")
 
@@ -92,28 +104,212 @@ FLAGS_CACHE_WRITE_GROUP  = 0x00000008
 FLAGS_CACHE_READ_QUERY   = 0x00000010
 FLAGS_CACHE_WRITE_QUERY  = 0x00000020
 
+#
+# Entries are stored as a one byte type tag followed by the fields
+# separated by NUL, which is a fraction of the size of a pickle and
+# much cheaper to decode.  Anything that is not a passwd or group
+# entry (raw directory results, query results) is marshalled.
+#
+ENTRY_PASSWD = 'p'
+ENTRY_GROUP = 'g'
+ENTRY_MARSHAL = 'm'
+
+
+def _text(value):
+    if value is None or isinstance(value, unicode):
+        return value
+    return str(value).decode('utf-8', 'replace')
+
+
+def _first(attrs, names):
+    for name in names:
+        value = attrs.get(name)
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if value:
+            return value
+    return None
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def cache_encode(value):
+    """
+    Encode `value` and return (data, name, uid, gid) where the last
+    three feed the secondary indexes.
+    """
+    if isinstance(value, pwd.struct_passwd):
+        data = ENTRY_PASSWD + '\0'.join([
+            value.pw_name,
+            value.pw_passwd,
+            str(value.pw_uid),
+            str(value.pw_gid),
+            value.pw_gecos,
+            value.pw_dir,
+            value.pw_shell,
+        ])
+        return data, value.pw_name, value.pw_uid, value.pw_gid
+
+    if isinstance(value, grp.struct_group):
+        data = ENTRY_GROUP + '\0'.join([
+            value.gr_name,
+            value.gr_passwd,
+            str(value.gr_gid),
+            ','.join(value.gr_mem),
+        ])
+        return data, value.gr_name, None, value.gr_gid
+
+    #
+    # (dn, attributes) from LDAP/AD or the dicts built from NIS/NT4
+    #
+    attrs = None
+    if isinstance(value, tuple) and len(value) == 2 and \
+        isinstance(value[1], dict):
+        attrs = value[1]
+    elif isinstance(value, dict):
+        attrs = value
+
+    name = uid = gid = None
+    if attrs:
+        name = _first(attrs, ('sAMAccountName', 'uid', 'cn', 'name'))
+        uid = _int(_first(attrs, ('uidNumber', )))
+        gid = _int(_first(attrs, ('gidNumber', )))
+
+    return ENTRY_MARSHAL + marshal.dumps(value), name, uid, gid
+
+
+def cache_decode(data):
+    data = str(data)
+    tag, data = data[0], data[1:]
+
+    if tag == ENTRY_PASSWD:
+        f = data.split('\0')
+        return pwd.struct_passwd((f[0], f[1], int(f[2]), int(f[3]),
+            f[4], f[5], f[6]))
+
+    if tag == ENTRY_GROUP:
+        f = data.split('\0')
+        return grp.struct_group((f[0], f[1], int(f[2]),
+            [m for m in f[3].split(',') if m]))
+
+    return marshal.loads(data)
+
+
+@contextlib.contextmanager
+def refilling(caches):
+    """
+    FreeNAS_BaseCache.refilling() for several caches at once, they
+    are all committed at the end of the with block or all aborted.
+    """
+    for cache in caches:
+        cache.begin()
+    try:
+        yield caches
+
+    except:
+        for cache in caches:
+            cache.abort()
+        raise
+
+    for cache in caches:
+        cache.commit()
+
+
 class FreeNAS_BaseCache(object):
-    def __init__(self, cachedir=FREENAS_CACHEDIR):
+    """
+    An expiring key/value store backed by sqlite.
+
+    Every entry carries its own expiry time and lives in a generation.
+    Readers only ever see the current generation; a refill started with
+    begin() writes a new one and commit() swaps it in atomically, so a
+    half filled cache is never visible.  Entries are also indexed by
+    uid, gid and lowercased name for lookups and name completion.
+
+    The object can be shared between threads, they take turns on one
+    connection and so write into the same refill.
+    """
+    def __init__(self, cachedir=FREENAS_CACHEDIR, ttl=FREENAS_CACHE_TTL):
         log.debug("FreeNAS_BaseCache._init__: enter")
 
         self.cachedir = cachedir
-        self.__cachefile = os.path.join(self.cachedir, ".cache.db")
+        self.ttl = ttl
+        self.__cachefile = os.path.join(self.cachedir, ".cache.sqlite")
 
         if not self.__dir_exists(self.cachedir):
-            os.makedirs(self.cachedir)
-
-        self.__dbenv = db.DBEnv()
-        self.__dbenv.open(self.cachedir,
-            db.DB_INIT_CDB | db.DB_INIT_MPOOL | db.DB_CREATE, 0700)
+            try:
+                os.makedirs(self.cachedir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
 
-        self.__cache = db.DB(self.__dbenv)
-        self.__cache.open(self.__cachefile, None, db.DB_HASH, db.DB_CREATE)
+        self.__building = None
+        self.__skipping = False
+        self.__lock = threading.RLock()
+        self.__open()
 
         log.debug("FreeNAS_BaseCache._init__: cachedir = %s", self.cachedir)
         log.debug("FreeNAS_BaseCache._init__: cachefile = %s",
             self.__cachefile)
         log.debug("FreeNAS_BaseCache._init__: leave")
 
+    def __open(self):
+        self.__cache = sqlite3.connect(self.__cachefile, timeout=1,
+            isolation_level=None, check_same_thread=False)
+        self.__cache.text_factory = str
+        self.__cache.execute("PRAGMA synchronous=OFF")
+
+        #
+        # Creating the schema takes the write lock, which a refill
+        # holds from begin() to commit(); only do it for a new file.
+        #
+        if self.__cache.execute("SELECT 1 FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'meta'").fetchone():
+            return
+
+        try:
+            self.__create()
+
+        except sqlite3.OperationalError as e:
+            #
+            # Only a concurrent __open() can hold the lock of a file
+            # without a schema, and it creates the same one.
+            #
+            log.debug("FreeNAS_BaseCache.__open: %s", e)
+            try:
+                self.__cache.execute("ROLLBACK")
+            except sqlite3.OperationalError:
+                pass
+
+    def __create(self):
+        self.__cache.execute("PRAGMA journal_mode=WAL")
+        self.__cache.executescript("""
+            BEGIN IMMEDIATE;
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS cache (
+                generation INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                name TEXT,
+                uid INTEGER,
+                gid INTEGER,
+                expires INTEGER NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (generation, key)
+            );
+            CREATE INDEX IF NOT EXISTS cache_name ON cache (generation, name);
+            CREATE INDEX IF NOT EXISTS cache_uid ON cache (generation, uid);
+            CREATE INDEX IF NOT EXISTS cache_gid ON cache (generation, gid);
+            INSERT OR IGNORE INTO meta VALUES ('generation', 0);
+            COMMIT;
+        """)
+
     def __dir_exists(self, path):
         path_exists = False
         try:
@@ -125,75 +321,245 @@ class FreeNAS_BaseCache(object):
 
         return path_exists
 
+    def __execute(self, sql, args=()):
+        with self.__lock:
+            return self.__cache.execute(sql, args).fetchall()
+
+    def __current(self):
+        return self.__execute(
+            "SELECT value FROM meta WHERE key = 'generation'")[0][0]
+
+    def __generation(self):
+        if self.__building is not None:
+            return self.__building
+        return self.__current()
+
+    def __select(self, columns, where='', args=(), order=''):
+        #
+        # Reads always see the committed generation, even while this
+        # very object is refilling the next one.
+        #
+        sql = "SELECT %s FROM cache WHERE generation = ? AND expires > ?" % (
+            columns, )
+        if where:
+            sql += " AND " + where
+        if order:
+            sql += " ORDER BY " + order
+        with self.__lock:
+            return self.__execute(sql,
+                (self.__current(), int(time.time())) + tuple(args))
+
     def __len__(self):
-        return len(self.__cache)
+        return self.__select("COUNT(*)")[0][0]
 
     def __iter__(self):
-        for key in sorted(self.__cache.keys()):
-            obj = pickle.loads(self.__cache[key])
-            yield obj
+        for (value, ) in self.__select("value", order="key"):
+            yield cache_decode(value)
 
     def __getitem__(self, key):
-        return pickle.loads(self.__cache.get(key))
+        rows = self.__select("value", "key = ?", (_text(key), ))
+        if not rows:
+            raise KeyError(key)
+        return cache_decode(rows[0][0])
 
     def __setitem__(self, key, value, overwrite=False):
-        haskey = self.__cache.has_key(key)
-        if (haskey and overwrite) or (not haskey):
-            self.__cache[key] = pickle.dumps(value)
+        self.write(key, value, overwrite)
 
     def has_key(self, key):
-        return self.__cache.has_key(key)
+        return len(self.__select("1", "key = ?", (_text(key), ))) > 0
 
     def keys(self):
-        return self.__cache.keys()
+        return [key for (key, ) in self.__select("key")]
 
     def values(self):
-        cache_values = []
-        for key in self.__cache.keys():
-            cache_values.append(pickle.loads(self.__cache[key]))
-        return cache_values
+        return [cache_decode(value) for (value, ) in self.__select("value")]
 
     def items(self):
-        cache_items = []
-        for key in self.__cache.keys():
-            cache_items.append((key, pickle.loads(self.__cache[key])))
-        return cache_items
+        return [(key, cache_decode(value))
+            for (key, value) in self.__select("key, value")]
 
     def empty(self):
-        return (len(self.__cache) == 0)
+        return not self.__select("1", order="key LIMIT 1")
+
+    def by_uid(self, uid):
+        return [cache_decode(value)
+            for (value, ) in self.__select("value", "uid = ?", (uid, ))]
+
+    def by_gid(self, gid):
+        return [cache_decode(value)
+            for (value, ) in self.__select("value", "gid = ?", (gid, ))]
+
+    def search(self, prefix, limit=None):
+        """
+        Entries whose name starts with `prefix` (case insensitive),
+        ordered by name.
+        """
+        prefix = _text(prefix).lower()
+        where, args = "name IS NOT NULL", ()
+        if prefix:
+            upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+            where, args = "name >= ? AND name < ?", (prefix, upper)
+
+        order = "name"
+        if limit:
+            order += " LIMIT %d" % int(limit)
+
+        return [cache_decode(value)
+            for (value, ) in self.__select("value", where, args, order)]
+
+    @contextlib.contextmanager
+    def refilling(self, enabled=True):
+        """
+        begin() a new generation, commit() it at the end of the with
+        block, or abort() it if the block raises so the write lock is
+        not left held.
+        """
+        if not enabled:
+            yield self
+            return
+
+        self.begin()
+        try:
+            yield self
+
+        except:
+            self.abort()
+            raise
+
+        self.commit()
+
+    def begin(self):
+        """Start filling a new generation, see commit()."""
+        with self.__lock:
+            if self.__building is not None or self.__skipping:
+                return
+
+            try:
+                self.__cache.execute("BEGIN IMMEDIATE")
+
+            except sqlite3.OperationalError as e:
+                #
+                # Somebody else is already refilling, their generation
+                # will do.  Drop our writes until commit() rather than
+                # wait out the busy timeout on each of them.
+                #
+                log.debug("FreeNAS_BaseCache.begin: %s", e)
+                self.__skipping = True
+                return
+
+            self.__building = self.__current() + 1
+
+    def commit(self):
+        """Make the generation filled since begin() the current one."""
+        with self.__lock:
+            self.__skipping = False
+            if self.__building is None:
+                return
+
+            building, self.__building = self.__building, None
+            self.__cache.execute(
+                "UPDATE meta SET value = ? WHERE key = 'generation'",
+                (building, ))
+            self.__cache.execute("DELETE FROM cache WHERE generation != ?",
+                (building, ))
+            self.__cache.execute("COMMIT")
+
+    def abort(self):
+        with self.__lock:
+            self.__skipping = False
+            if self.__building is None:
+                return
+
+            self.__building = None
+            self.__cache.execute("ROLLBACK")
+
+    def purge(self):
+        """Drop entries past their expiry time."""
+        with self.__lock:
+            cur = self.__cache.execute(
+                "DELETE FROM cache WHERE expires <= ?", (int(time.time()), ))
+            return cur.rowcount
 
     def expire(self):
-        for key in self.__cache.keys():
-            self.__cache.delete(key)
-        self.__cache.close()
-        os.unlink(self.__cachefile)
+        self.abort()
+        with self.__lock:
+            self.__cache.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(self.__cachefile + suffix)
+            except OSError:
+                pass
 
     def read(self, key):
         if not key:
             return None
 
-        pobj = pickle.loads(self.__cache[key])
-        return pobj
+        return self[key]
 
-    def write(self, key, entry, overwrite=False):
-        if not key:
+    def write(self, key, entry, overwrite=False, ttl=None):
+        if not key or self.__skipping:
             return False
 
-        haskey = self.__cache.has_key(key)
-        if (haskey and overwrite) or (not haskey):
-            self.__cache[key] = pickle.dumps(entry)
-
-        return True
+        data, name, uid, gid = cache_encode(entry)
+        if ttl is None:
+            ttl = self.ttl
+
+        #
+        # A commit() from another thread must not happen between
+        # picking the generation and writing to it
+        #
+        with self.__lock:
+            now = int(time.time())
+            generation = self.__generation()
+            key = _text(key)
+
+            sql = "INSERT OR %s INTO cache SELECT ?, ?, ?, ?, ?, ?, ?" % (
+                'IGNORE' if self.__building and not overwrite
+                else 'REPLACE', )
+            args = (
+                generation,
+                key,
+                _text(name).lower() if name else None,
+                uid,
+                gid,
+                now + int(ttl),
+                buffer(data),
+            )
+            if not overwrite and not self.__building:
+                #
+                # Only replace an entry that has already expired
+                #
+                sql += " WHERE NOT EXISTS (SELECT 1 FROM cache WHERE " \
+                    "generation = ? AND key = ? AND expires > ?)"
+                args += (generation, key, now)
+
+            try:
+                self.__cache.execute(sql, args)
+
+            except sqlite3.OperationalError as e:
+                #
+                # Another process is refilling the cache, losing a write
+                # here only costs a directory lookup later.
+                #
+                log.debug("FreeNAS_BaseCache.write: %s", e)
+                return False
+
+            return True
 
     def delete(self, key):
-        if not key:
+        if not key or self.__skipping:
             return False
 
-        self.__cache.delete(key)
+        with self.__lock:
+            self.__cache.execute(
+                "DELETE FROM cache WHERE generation = ? AND key = ?",
+                (self.__generation(), _text(key)))
         return True
 
     def close(self):
-        self.__cache.close()
+        self.abort()
+        with self.__lock:
+            self.__cache.close()
 
 
 class FreeNAS_LDAP_UserCache(FreeNAS_BaseCache):
@@ -296,35 +296,37 @@ class FreeNAS_DomainController_Users(FreeNAS_DomainController):
         for d in self.__domains:
             self.__users[d] = []
 
-            if (self.flags & FLAGS_CACHE_READ_USER) and self.__loaded('du', d):
-                log.debug("FreeNAS_DomainController_Users.__get_users: "
-                    "DomainController [%s] users in cache", d)
-                dc_users = self.__ducache[d]
+            with self.__ucache[d].refilling(self.flags & FLAGS_CACHE_WRITE_USER), \
+                self.__ducache[d].refilling(self.flags & FLAGS_CACHE_WRITE_USER):
+                if (self.flags & FLAGS_CACHE_READ_USER) and self.__loaded('du', d):
+                    log.debug("FreeNAS_DomainController_Users.__get_users: "
+                        "DomainController [%s] users in cache", d)
+                    dc_users = self.__ducache[d]
 
-            else:
-                log.debug("FreeNAS_DomainController_Users.__get_users: "
-                    "DomainController [%s] users not in cache", d)
-                dc_users = self.get_users(domain=d)
+                else:
+                    log.debug("FreeNAS_DomainController_Users.__get_users: "
+                        "DomainController [%s] users not in cache", d)
+                    dc_users = self.get_users(domain=d)
 
-            for u in dc_users:
-                uid = u['uid']
+                for u in dc_users:
+                    uid = u['uid']
 
-                if self.flags & FLAGS_CACHE_WRITE_USER:
-                    self.__ducache[d][uid] = u
+                    if self.flags & FLAGS_CACHE_WRITE_USER:
+                        self.__ducache[d][uid] = u
 
-                sAMAccountName = u['sAMAccountName']
-                try:
-                    pw = pwd.getpwnam(sAMAccountName)
+                    sAMAccountName = u['sAMAccountName']
+                    try:
+                        pw = pwd.getpwnam(sAMAccountName)
 
-                except Exception, e:
-                    log.debug("Error on getpwname: %s",  e)
-                    continue
+                    except Exception, e:
+                        log.debug("Error on getpwname: %s",  e)
+                        continue
 
-                self.__users[d].append(pw) 
-                if self.flags & FLAGS_CACHE_WRITE_USER:
-                    self.__ucache[d][sAMAccountName] = pw
+                    self.__users[d].append(pw) 
+                    if self.flags & FLAGS_CACHE_WRITE_USER:
+                        self.__ucache[d][sAMAccountName] = pw
 
-                pw = None
+                    pw = None
 
             if self.flags & FLAGS_CACHE_WRITE_USER:
                 self.__loaded('u', d, True)
@@ -434,33 +436,35 @@ class FreeNAS_DomainController_Groups(FreeNAS_DomainController):
         for d in self.__domains:
             self.__groups[d] = []
 
-            if (self.flags & FLAGS_CACHE_READ_GROUP) and self.__loaded('dg', d):
-                log.debug("FreeNAS_DomainController_Groups.__get_groups: "
-                    "DomainController [%s] groups in cache", d)
-                dc_groups = self.__dgcache[d]
+            with self.__gcache[d].refilling(self.flags & FLAGS_CACHE_WRITE_GROUP), \
+                self.__dgcache[d].refilling(self.flags & FLAGS_CACHE_WRITE_GROUP):
+                if (self.flags & FLAGS_CACHE_READ_GROUP) and self.__loaded('dg', d):
+                    log.debug("FreeNAS_DomainController_Groups.__get_groups: "
+                        "DomainController [%s] groups in cache", d)
+                    dc_groups = self.__dgcache[d]
 
-            else:
-                log.debug("FreeNAS_DomainController_Groups.__get_groups: "
-                    "DomainController [%s] groups not in cache", d)
-                dc_groups = self.get_groups(domain=d)
+                else:
+                    log.debug("FreeNAS_DomainController_Groups.__get_groups: "
+                        "DomainController [%s] groups not in cache", d)
+                    dc_groups = self.get_groups(domain=d)
 
-            for g in dc_groups:
-                sAMAccountName = g['sAMAccountName']
+                for g in dc_groups:
+                    sAMAccountName = g['sAMAccountName']
 
-                if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                    self.__dgcache[d][sAMAccountName.upper()] = g
+                    if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                        self.__dgcache[d][sAMAccountName.upper()] = g
 
-                try:
-                    gr = grp.getgrnam(sAMAccountName)
+                    try:
+                        gr = grp.getgrnam(sAMAccountName)
 
-                except:
-                    continue
+                    except:
+                        continue
 
-                self.__groups[d].append(gr)
-                if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                    self.__gcache[d][sAMAccountName.upper()] = gr
+                    self.__groups[d].append(gr)
+                    if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                        self.__gcache[d][sAMAccountName.upper()] = gr
 
-                gr = None
+                    gr = None
 
             if self.flags & FLAGS_CACHE_WRITE_GROUP:
                 self.__loaded('g', d, True)
@@ -34,6 +34,7 @@ import os
 import pwd
 import socket
 import sqlite3
+import threading
 import time
 import types
 
@@ -53,6 +54,7 @@ from freenasUI.common.system import (
     activedirectory_objects,
 )
 from freenasUI.common.freenascache import *
+from freenasUI.common.nss import getpwnam_many, getgrnam_many
 
 log = logging.getLogger('common.freenasldap')
 
@@ -74,6 +76,8 @@ FREENAS_LDAP_VERSION = ldap.VERSION3
 FREENAS_LDAP_REFERRALS = get_freenas_var("FREENAS_LDAP_REFERRALS", 0)
 
 FREENAS_LDAP_PAGESIZE = get_freenas_var("FREENAS_LDAP_PAGESIZE", 1024)
+FREENAS_LDAP_PAGE_TIMEOUT = int(
+    get_freenas_var("FREENAS_LDAP_PAGE_TIMEOUT", 60))
 
 ldap.protocol_version = FREENAS_LDAP_VERSION
 ldap.set_option(ldap.OPT_REFERRALS, FREENAS_LDAP_REFERRALS)
@@ -294,21 +298,19 @@ class FreeNAS_LDAP_Directory(object):
         if not self._isopen:
             return None
 
-        #
-        # XXX
-        # For some reason passing attributes causes paged search results
-        # to hang/fail after a a certain numbe of pages. I can't figure
-        # out why. This is a workaround.
-        # XXX
-        #
-        attributes = None
-
         if not filter: 
             filter = ''
 
+        #
+        # Only fetch what the caller asked for, enumerating a large
+        # directory with every attribute of every object is very slow.
+        #
+        if attributes is not None:
+            attributes = [str(a) for a in attributes]
+
         m = hashlib.sha256()
         m.update(repr(filter) + self.host + str(self.port) +
-            (basedn if basedn else ''))
+            (basedn if basedn else '') + repr(attributes))
         key = m.hexdigest()
         m = None
 
@@ -333,45 +335,68 @@ class FreeNAS_LDAP_Directory(object):
                 self.pagesize)
 
             page = 0
-            while True:
-                log.debug("FreeNAS_LDAP_Directory._search: getting page %d",
-                    page)
-                serverctrls = [paged]
-
-                id = self._handle.search_ext(
-                   basedn,
-                   scope,
-                   filterstr=filter,
-                   attrlist=attributes,
-                   attrsonly=attrsonly,
-                   serverctrls=serverctrls,
-                   clientctrls=clientctrls,
-                   timeout=timeout,
-                   sizelimit=sizelimit
-                )
+            id = None
+            try:
+                while True:
+                    log.debug("FreeNAS_LDAP_Directory._search: getting page %d",
+                        page)
+                    serverctrls = [paged]
+
+                    id = self._handle.search_ext(
+                       basedn,
+                       scope,
+                       filterstr=filter,
+                       attrlist=attributes,
+                       attrsonly=attrsonly,
+                       serverctrls=serverctrls,
+                       clientctrls=clientctrls,
+                       timeout=timeout,
+                       sizelimit=sizelimit
+                    )
 
-                (rtype, rdata, rmsgid, serverctrls) = self._handle.result3(
-                    id, resp_ctrl_classes=paged_ctrls
-                )
+                    (rtype, rdata, rmsgid, serverctrls) = self._handle.result3(
+                        id, resp_ctrl_classes=paged_ctrls,
+                        timeout=FREENAS_LDAP_PAGE_TIMEOUT
+                    )
 
-                result.extend(rdata)
+                    result.extend(rdata)
 
-                paged.size = 0
-                paged.cookie = cookie = None
-                for sc in serverctrls:
-                    if sc.controlType == \
-                        SimplePagedResultsControl.controlType:
-                        cookie = sc.cookie
-                        if cookie:
-                            paged.cookie = cookie
-                            paged.size = self.pagesize
+                    paged.size = 0
+                    paged.cookie = cookie = None
+                    for sc in serverctrls:
+                        if sc.controlType == \
+                            SimplePagedResultsControl.controlType:
+                            cookie = sc.cookie
+                            if cookie:
+                                paged.cookie = cookie
+                                paged.size = self.pagesize
 
-                        break
+                            break
 
-                if not cookie:
-                    break
+                    if not cookie:
+                        break
 
-                page += 1
+                    page += 1
+
+            except ldap.LDAPError as e:
+                if attributes is None:
+                    raise
+
+                #
+                # Some servers stop answering paged searches with an
+                # attribute list after a number of pages, fetch every
+                # attribute instead.
+                #
+                log.debug("FreeNAS_LDAP_Directory._search: paged search "
+                    "with attributes failed on page %d, retrying without: "
+                    "%s", page, e)
+                if id is not None:
+                    try:
+                        self._handle.abandon(id)
+                    except ldap.LDAPError:
+                        pass
+                return self._search(basedn, scope, filter, None, attrsonly,
+                    None, clientctrls, timeout, sizelimit)
         else:
             log.debug("FreeNAS_LDAP_Directory._search: pagesize = 0")
 
@@ -1570,9 +1595,14 @@ class FreeNAS_ActiveDirectory_Base(object):
         log.debug("FreeNAS_ActiveDirectory_Base.get_user: leave")
         return ad_user
 
-    def get_users(self):
+    def get_users(self, handle=None, basedn=None):
         log.debug("FreeNAS_ActiveDirectory_Base.get_users: enter")
 
+        if handle is None:
+            handle = self.dchandle
+        if basedn is None:
+            basedn = self.basedn
+
         users = []
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(|(objectclass=user)(objectclass=person))' \
@@ -1580,7 +1610,7 @@ class FreeNAS_ActiveDirectory_Base(object):
         if self.attributes and 'sAMAccountType' not in self.attributes:
             self.attributes.append('sAMAccountType')
 
-        results = self._search(self.dchandle, self.basedn, scope,
+        results = self._search(handle, basedn, scope,
             filter, self.attributes)
         if results:
             for r in results:
@@ -1641,20 +1671,25 @@ class FreeNAS_ActiveDirectory_Base(object):
         log.debug("FreeNAS_ActiveDirectory_Base.get_group: leave")
         return ad_group
 
-    def get_groups(self):
+    def get_groups(self, handle=None, basedn=None):
         log.debug("FreeNAS_ActiveDirectory_Base.get_groups: enter")
 
+        if handle is None:
+            handle = self.dchandle
+        if basedn is None:
+            basedn = self.basedn
+
         groups = []
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(objectclass=group)(sAMAccountName=*))'
         if self.attributes and 'groupType' not in self.attributes:
             self.attributes.append('groupType')
 
-        results = self._search(self.dchandle, self.basedn, scope,
+        results = self._search(handle, basedn, scope,
             filter, self.attributes)
         if results:
             for r in results:
-                if r[0]:
+                if r[0] and r[1] and r[1].has_key('groupType'):
                     type = int(r[1]['groupType'][0])
                     if not (type & 0x1):
                         groups.append(r)
@@ -1698,6 +1733,93 @@ class FreeNAS_ActiveDirectory_Base(object):
         return count
 
 
+    def search_domains(self, domains, method):
+        """
+        Run `method` (get_users or get_groups) against every domain in
+        `domains` at once, each over its own domain controller
+        connection, and return the results keyed by NetBIOS name.
+        """
+        log.debug("FreeNAS_ActiveDirectory_Base.search_domains: enter")
+
+        #
+        # get_best_host() drives the global asyncore map, so pick the
+        # domain controllers up front before fanning out.
+        #
+        handles = {}
+        for d in domains:
+            n = d['nETBIOSName']
+            if d['nCName'] == self.basedn:
+                handles[n] = self.dchandle
+                continue
+
+            dcs = self.get_domain_controllers(d['dnsRoot'])
+            if not dcs:
+                raise FreeNAS_ActiveDirectory_Exception(
+                    "Unable to find domain controllers for %s" % d['dnsRoot'])
+            (host, port) = self.get_best_host(dcs)
+            handles[n] = FreeNAS_LDAP_Directory(
+                binddn=self.binddn, bindpw=self.bindpw,
+                host=host, port=port, flags=self.flags,
+                pagesize=self.pagesize)
+
+        #
+        # Page through the directory, a plain search stops at the
+        # server side size limit.
+        #
+        pagesize = self.dchandle.pagesize
+        self.dchandle.pagesize = self.pagesize
+
+        results = {}
+        errors = []
+        # The threads falling back to self.dchandle take turns on it
+        dclock = threading.Lock()
+
+        def search(d):
+            n = d['nETBIOSName']
+            handle = handles[n]
+            try:
+                if handle is not self.dchandle:
+                    try:
+                        handle.open()
+                    except ldap.LDAPError as e:
+                        log.debug("FreeNAS_ActiveDirectory_Base."
+                            "search_domains: [%s] falling back to %s: %s",
+                            n, self.dchost, e)
+                        handle = handles[n] = self.dchandle
+                if handle is self.dchandle:
+                    with dclock:
+                        results[n] = method(handle=handle,
+                            basedn=d['nCName'])
+                else:
+                    results[n] = method(handle=handle, basedn=d['nCName'])
+
+            except Exception as e:
+                log.debug("FreeNAS_ActiveDirectory_Base.search_domains: "
+                    "[%s] %s", n, e)
+                errors.append(e)
+
+        threads = []
+        for d in domains:
+            t = threading.Thread(target=search, args=(d, ))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        self.dchandle.pagesize = pagesize
+        for handle in handles.values():
+            if handle is not self.dchandle:
+                handle.close()
+
+        if errors:
+            raise errors[0]
+
+        log.debug("FreeNAS_ActiveDirectory_Base.search_domains: leave")
+        return results
+
+
 class FreeNAS_ActiveDirectory(FreeNAS_ActiveDirectory_Base):
     def __init__(self, **kwargs):
         log.debug("FreeNAS_ActiveDirectory.__init__: enter")
@@ -1789,36 +1911,36 @@ class FreeNAS_LDAP_Users(FreeNAS_LDAP):
                 "LDAP users not in cache")
             ldap_users = self.get_users()
 
-        parts = self.host.split('.')
-        host = parts[0].upper()
-        for u in ldap_users:
-            CN = str(u[0])
-            if self.flags & FLAGS_CACHE_WRITE_USER:
-                self.__ducache[CN] = u
-
-            u = u[1]
-            if self.use_default_domain:
-                uid = u['uid'][0]
-            else:
-                uid = "{}{}{}".format(
-                    host,
-                    FREENAS_AD_SEPARATOR,
-                    u['uid'][0]
-                )
-
-            self.__usernames.append(uid)
+        with self.__ucache.refilling(self.flags & FLAGS_CACHE_WRITE_USER), \
+            self.__ducache.refilling(self.flags & FLAGS_CACHE_WRITE_USER):
+            parts = self.host.split('.')
+            host = parts[0].upper()
+            for u in ldap_users:
+                CN = str(u[0])
+                if self.flags & FLAGS_CACHE_WRITE_USER:
+                    self.__ducache[CN] = u
 
-            try:
-                pw = pwd.getpwnam(uid)
+                u = u[1]
+                if self.use_default_domain:
+                    uid = u['uid'][0]
+                else:
+                    uid = "{}{}{}".format(
+                        host,
+                        FREENAS_AD_SEPARATOR,
+                        u['uid'][0]
+                    )
 
-            except:
-                continue
+                self.__usernames.append(uid)
 
-            self.__users.append(pw)
-            if self.flags & FLAGS_CACHE_WRITE_USER:
-                self.__ucache[uid] = pw
+            pwents = getpwnam_many(self.__usernames)
+            for uid in self.__usernames:
+                pw = pwents.get(uid.lower())
+                if pw is None:
+                    continue
 
-            pw = None
+                self.__users.append(pw)
+                if self.flags & FLAGS_CACHE_WRITE_USER:
+                    self.__ucache[uid] = pw
 
         if self.flags & FLAGS_CACHE_WRITE_USER:
             self.__loaded('u', True)
@@ -1922,63 +2044,82 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
                 log.debug("FreeNAS_ActiveDirectory_Users.__get_users: leave")
                 return
 
+        self.attributes = ['sAMAccountName', 'sAMAccountType']
+        self.pagesize = FREENAS_LDAP_PAGESIZE
+
+        ad_users = {}
+        uncached = []
         for d in self.__domains:
             n = d['nETBIOSName']
             self.__users[n] = []
 
-            dcs = self.get_domain_controllers(d['dnsRoot'])
-            if not dcs: 
-                raise FreeNAS_ActiveDirectory_Exception(
-                    "Unable to find domain controllers for %s" % d['dnsRoot'])
-            (self.host, self.port) = self.get_best_host(dcs)
-
-            self.basedn = d['nCName']
-            self.attributes = ['sAMAccountName']
-            self.pagesize = FREENAS_LDAP_PAGESIZE
-
             if (self.flags & FLAGS_CACHE_READ_USER) \
                 and self.__loaded('du', n):
                 log.debug("FreeNAS_ActiveDirectory_Users.__get_users: "
                     "AD [%s] users in cache" % n)
-                ad_users = self.__ducache[n]
+                ad_users[n] = self.__ducache[n]
 
             else:
                 log.debug("FreeNAS_ActiveDirectory_Users.__get_users: "
                     "AD [%s] users not in cache" % n)
-                ad_users = self.get_users()
+                uncached.append(d)
 
-            for u in ad_users:
-                CN = str(u[0])
+        if uncached:
+            ad_users.update(self.search_domains(uncached, self.get_users))
 
-                if self.flags & FLAGS_CACHE_WRITE_USER:
-                    self.__ducache[n][CN] = u
+        caches = []
+        if self.flags & FLAGS_CACHE_WRITE_USER:
+            for d in self.__domains:
+                n = d['nETBIOSName']
+                caches += [self.__ucache[n], self.__ducache[n]]
 
-                u = u[1]
-                if self.use_default_domain:
-                    sAMAccountName = u['sAMAccountName'][0]
-                else:
-                    sAMAccountName = "{}{}{}".format(
-                        n,
-                        FREENAS_AD_SEPARATOR,
-                        u['sAMAccountName'][0]
-                    )
+        with refilling(caches):
+            names = {}
+            for d in self.__domains:
+                n = d['nETBIOSName']
+                names[n] = []
 
-                self.__usernames.append(sAMAccountName)
+                for u in ad_users[n]:
+                    CN = str(u[0])
 
-                try:
-                    pw = pwd.getpwnam(sAMAccountName)
+                    if self.flags & FLAGS_CACHE_WRITE_USER:
+                        self.__ducache[n][CN] = u
 
-                except Exception, e:
-                    log.debug("Error on getpwnam: %s", e)
-                    continue
+                    u = u[1]
+                    if self.use_default_domain:
+                        sAMAccountName = u['sAMAccountName'][0]
+                    else:
+                        sAMAccountName = "{}{}{}".format(
+                            n,
+                            FREENAS_AD_SEPARATOR,
+                            u['sAMAccountName'][0]
+                        )
 
-                self.__users[n].append(pw)
-                if self.flags & FLAGS_CACHE_WRITE_USER:
-                    self.__ucache[n][sAMAccountName] = pw
+                    self.__usernames.append(sAMAccountName)
+                    names[n].append(sAMAccountName)
 
-                pw = None
+            #
+            # Resolve every account through winbindd in one pass rather
+            # than one getpwnam() round trip per user.
+            #
+            pwents = getpwnam_many(self.__usernames)
+
+            for d in self.__domains:
+                n = d['nETBIOSName']
+
+                for sAMAccountName in names[n]:
+                    pw = pwents.get(sAMAccountName.lower())
+                    if pw is None:
+                        log.debug("Unable to resolve user %s", sAMAccountName)
+                        continue
+
+                    self.__users[n].append(pw)
+                    if self.flags & FLAGS_CACHE_WRITE_USER:
+                        self.__ucache[n][sAMAccountName] = pw
 
-            if self.flags & FLAGS_CACHE_WRITE_USER:
+        if self.flags & FLAGS_CACHE_WRITE_USER:
+            for d in self.__domains:
+                n = d['nETBIOSName']
                 self.__loaded('u', n, True)
                 self.__loaded('du', n, True)
 
@@ -2075,6 +2216,7 @@ class FreeNAS_LDAP_Groups(FreeNAS_LDAP):
             return
 
         self.attributes = ['cn']
+        self.pagesize = FREENAS_LDAP_PAGESIZE
 
         ldap_groups = None
         if (self.flags & FLAGS_CACHE_READ_GROUP) and self.__loaded('dg'):
@@ -2087,37 +2229,36 @@ class FreeNAS_LDAP_Groups(FreeNAS_LDAP):
                 "LDAP groups not in cache")
             ldap_groups = self.get_groups()
 
-        parts = self.host.split('.') 
-        host = parts[0].upper()
-        for g in ldap_groups:
-            CN = str(g[0])
-            if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                self.__dgcache[CN] = g
-
-            g = g[1]
-            if self.use_default_domain:
-                cn = g['cn'][0]
-            else:
-                cn = "{}{}{}".format(
-                    host,
-                    FREENAS_AD_SEPARATOR,
-                    g['cn'][0]
-                )
-
-            self.__groupnames.append(cn)
-
-            try:
-                gr = grp.getgrnam(cn)
+        with self.__gcache.refilling(self.flags & FLAGS_CACHE_WRITE_GROUP), \
+            self.__dgcache.refilling(self.flags & FLAGS_CACHE_WRITE_GROUP):
+            parts = self.host.split('.') 
+            host = parts[0].upper()
+            for g in ldap_groups:
+                CN = str(g[0])
+                if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                    self.__dgcache[CN] = g
 
-            except:
-                continue
+                g = g[1]
+                if self.use_default_domain:
+                    cn = g['cn'][0]
+                else:
+                    cn = "{}{}{}".format(
+                        host,
+                        FREENAS_AD_SEPARATOR,
+                        g['cn'][0]
+                    )
 
-            self.__groups.append(gr)
+                self.__groupnames.append(cn)
 
-            if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                self.__gcache[cn] = gr
+            grents = getgrnam_many(self.__groupnames)
+            for cn in self.__groupnames:
+                gr = grents.get(cn.lower())
+                if gr is None:
+                    continue
 
-            gr = None
+                self.__groups.append(gr)
+                if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                    self.__gcache[cn] = gr
 
         if self.flags & FLAGS_CACHE_WRITE_GROUP:
             self.__loaded('g', True)
@@ -2211,7 +2352,7 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
 
             for d in self.__domains:
                 n = d['nETBIOSName']
-                if self.__loaded('u', n):
+                if self.__loaded('g', n):
                     self.__groups[n] = self.__gcache[n]
                     count += 1
 
@@ -2222,62 +2363,77 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
                     "leave")
                 return
 
+        self.attributes = ['sAMAccountName', 'groupType']
+        self.pagesize = FREENAS_LDAP_PAGESIZE
+
+        ad_groups = {}
+        uncached = []
         for d in self.__domains:
             n = d['nETBIOSName']
             self.__groups[n] = []
 
-            dcs = self.get_domain_controllers(d['dnsRoot'])
-            if not dcs: 
-                raise FreeNAS_ActiveDirectory_Exception(
-                    "Unable to find domain controllers for %s" % d['dnsRoot'])
-            (self.host, self.port) = self.get_best_host(dcs)
-
-            self.basedn = d['nCName']
-            self.attributes = ['sAMAccountName']
-            self.pagesize = FREENAS_LDAP_PAGESIZE
-
             if (self.flags & FLAGS_CACHE_READ_GROUP) \
                 and self.__loaded('dg', n):
                 log.debug("FreeNAS_ActiveDirectory_Groups.__get_groups: "
                     "AD [%s] groups in cache", n)
-                ad_groups = self.__dgcache[n]
+                ad_groups[n] = self.__dgcache[n]
 
             else:
                 log.debug("FreeNAS_ActiveDirectory_Groups.__get_groups: "
                     "AD [%s] groups not in cache", n)
-                ad_groups = self.get_groups()
+                uncached.append(d)
 
-            for g in ad_groups:
-                CN = str(g[0])
+        if uncached:
+            ad_groups.update(self.search_domains(uncached, self.get_groups))
 
-                if self.use_default_domain:
-                    sAMAccountName = g[1]['sAMAccountName'][0]
-                else:  
-                    sAMAccountName = "{}{}{}".format(
-                        n,
-                        FREENAS_AD_SEPARATOR,
-                        g[1]['sAMAccountName'][0]
-                    )
+        caches = []
+        if self.flags & FLAGS_CACHE_WRITE_GROUP:
+            for d in self.__domains:
+                n = d['nETBIOSName']
+                caches += [self.__gcache[n], self.__dgcache[n]]
 
-                self.__groupnames.append(sAMAccountName)
+        with refilling(caches):
+            names = {}
+            for d in self.__domains:
+                n = d['nETBIOSName']
+                names[n] = []
 
-                if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                    self.__dgcache[n][CN] = g
+                for g in ad_groups[n]:
+                    CN = str(g[0])
 
-                try:
-                    gr = grp.getgrnam(sAMAccountName)
+                    if self.use_default_domain:
+                        sAMAccountName = g[1]['sAMAccountName'][0]
+                    else:  
+                        sAMAccountName = "{}{}{}".format(
+                            n,
+                            FREENAS_AD_SEPARATOR,
+                            g[1]['sAMAccountName'][0]
+                        )
 
-                except Exception as e:
-                    log.debug("Error on getgrnam: %s", e)
-                    continue
+                    self.__groupnames.append(sAMAccountName)
+                    names[n].append(sAMAccountName)
 
-                self.__groups[n].append(gr)
-                if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                    self.__gcache[n][sAMAccountName] = gr
+                    if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                        self.__dgcache[n][CN] = g
 
-                gr = None
+            grents = getgrnam_many(self.__groupnames)
+
+            for d in self.__domains:
+                n = d['nETBIOSName']
 
-            if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                for sAMAccountName in names[n]:
+                    gr = grents.get(sAMAccountName.lower())
+                    if gr is None:
+                        log.debug("Unable to resolve group %s", sAMAccountName)
+                        continue
+
+                    self.__groups[n].append(gr)
+                    if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                        self.__gcache[n][sAMAccountName] = gr
+
+        if self.flags & FLAGS_CACHE_WRITE_GROUP:
+            for d in self.__domains:
+                n = d['nETBIOSName']
                 self.__loaded('g', n, True)
                 self.__loaded('dg', n, True)
 
@@ -31,6 +31,7 @@ import pwd
 
 from freenasUI.common.cmd import cmd_pipe
 from freenasUI.common.freenascache import *
+from freenasUI.common.nss import passwd_entry, group_entry
 from freenasUI.common.system import nis_objects
 
 log = logging.getLogger('common.freenasnis')
@@ -315,36 +316,44 @@ class FreeNAS_NIS_Users(FreeNAS_NIS):
         for d in self.__domains:
             self.__users[d] = []
 
-            if (self.flags & FLAGS_CACHE_READ_USER) and self.__loaded('du', d):
-                log.debug("FreeNAS_NIS_Users.__get_users: "
-                    "NIS [%s] users in cache", d)
-                nis_users = self.__ducache[d]
+            with self.__ucache[d].refilling(self.flags & FLAGS_CACHE_WRITE_USER), \
+                self.__ducache[d].refilling(self.flags & FLAGS_CACHE_WRITE_USER):
+                if (self.flags & FLAGS_CACHE_READ_USER) and self.__loaded('du', d):
+                    log.debug("FreeNAS_NIS_Users.__get_users: "
+                        "NIS [%s] users in cache", d)
+                    nis_users = self.__ducache[d]
 
-            else:
-                log.debug("FreeNAS_NIS_Users.__get_users: "
-                    "NIS [%s] users not in cache", d)
-                nis_users = self.get_users(domain=d)
+                else:
+                    log.debug("FreeNAS_NIS_Users.__get_users: "
+                        "NIS [%s] users not in cache", d)
+                    nis_users = self.get_users(domain=d)
 
-            for u in nis_users:
-                uid = u['uid']
+                for u in nis_users:
+                    uid = u['uid']
 
-                self.__usernames.append(uid)
+                    self.__usernames.append(uid)
 
-                if self.flags & FLAGS_CACHE_WRITE_USER:
-                    self.__ducache[d][uid] = u
+                    if self.flags & FLAGS_CACHE_WRITE_USER:
+                        self.__ducache[d][uid] = u
 
-                try:
-                    pw = pwd.getpwnam(uid)
+                    #
+                    # ypcat already handed us the passwd map, there is no
+                    # need to ask nss about every account again.
+                    #
+                    try:
+                        pw = passwd_entry(uid, '*', u['uidNumber'],
+                            u['gidNumber'], u['gecos'], u['homeDirectory'],
+                            u['loginShell'])
 
-                except Exception, e:
-                    log.debug("Error on getpwname: %s",  e)
-                    continue
+                    except (KeyError, ValueError), e:
+                        log.debug("Invalid NIS user %s: %s", uid, e)
+                        continue
 
-                self.__users[d].append(pw)
-                if self.flags & FLAGS_CACHE_WRITE_USER:
-                    self.__ucache[d][uid] = pw
+                    self.__users[d].append(pw)
+                    if self.flags & FLAGS_CACHE_WRITE_USER:
+                        self.__ucache[d][uid] = pw
 
-                pw = None
+                    pw = None
 
             if self.flags & FLAGS_CACHE_WRITE_USER:
                 self.__loaded('u', d, True)
@@ -437,7 +446,7 @@ class FreeNAS_NIS_Groups(FreeNAS_NIS):
             count = 0
 
             for d in self.__domains:
-                if self.__loaded('u', d):
+                if self.__loaded('g', d):
                     self.__groups[d] = self.__gcache[d]
                     count += 1
 
@@ -450,35 +459,38 @@ class FreeNAS_NIS_Groups(FreeNAS_NIS):
         for d in self.__domains:
             self.__groups[d] = []
 
-            if (self.flags & FLAGS_CACHE_READ_GROUP) and self.__loaded('dg', d):
-                log.debug("FreeNAS_NIS_Groups.__get_groups: "
-                    "NIS [%s] groups in cache", d)
-                nis_groups = self.__dgcache[d]
+            with self.__gcache[d].refilling(self.flags & FLAGS_CACHE_WRITE_GROUP), \
+                self.__dgcache[d].refilling(self.flags & FLAGS_CACHE_WRITE_GROUP):
+                if (self.flags & FLAGS_CACHE_READ_GROUP) and self.__loaded('dg', d):
+                    log.debug("FreeNAS_NIS_Groups.__get_groups: "
+                        "NIS [%s] groups in cache", d)
+                    nis_groups = self.__dgcache[d]
 
-            else:
-                log.debug("FreeNAS_NIS_Groups.__get_groups: "
-                    "NIS [%s] groups not in cache", d)
-                nis_groups = self.get_groups()
+                else:
+                    log.debug("FreeNAS_NIS_Groups.__get_groups: "
+                        "NIS [%s] groups not in cache", d)
+                    nis_groups = self.get_groups()
 
-            for g in nis_groups:
-                group = g['group']
+                for g in nis_groups:
+                    group = g['group']
 
-                if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                    self.__dgcache[d][group] = g
+                    if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                        self.__dgcache[d][group] = g
 
-                self.__groupnames.append(group)
+                    self.__groupnames.append(group)
 
-                try:
-                    gr = grp.getgrnam(group)
+                    try:
+                        gr = group_entry(group, '*', g['gidNumber'],
+                            g['members'])
 
-                except:
-                    continue
+                    except (KeyError, ValueError):
+                        continue
 
-                self.__groups[d].append(gr)
-                if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                    self.__gcache[d][group] = gr
+                    self.__groups[d].append(gr)
+                    if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                        self.__gcache[d][group] = gr
 
-                gr = None
+                    gr = None
 
             if self.flags & FLAGS_CACHE_WRITE_GROUP:
                 self.__loaded('g', d, True)
@@ -31,6 +31,12 @@ import pwd
 
 from freenasUI.common.freenascache import *
 from freenasUI.common.cmd import cmd_pipe
+from freenasUI.common.nss import (
+    getpwnam_many,
+    getgrnam_many,
+    passwd_entry,
+    group_entry
+)
 
 log = logging.getLogger('common.freenasnt4')
 
@@ -138,21 +144,22 @@ class FreeNAS_NT4_Base(object):
         users = [] 
         (wbres, wbout) = self._wbinfo(wbargs)
         if wbres == 0:
-            for line in wbout.splitlines():
-                (gres, gout) = self._wbinfo("--user-info '%s'" % line.strip())
-                parts = gout.strip().split(':')
-                if not parts or len(parts) < 7:
+            names = [line.strip() for line in wbout.splitlines()]
+            pwents = getpwnam_many(names)
+            for name in names:
+                pw = pwents.get(name.lower())
+                if pw is None:
                     continue
 
                 user = {
-                    "name": parts[0],
-                    "sAMAccountName": parts[0],
-                    "uid": parts[0],
-                    "uidNumber": parts[2],
-                    "gidNumber": parts[3],
-                    "gecos": parts[4],
-                    "homeDirectory": parts[5],
-                    "loginShell": parts[6]
+                    "name": pw.pw_name,
+                    "sAMAccountName": pw.pw_name,
+                    "uid": pw.pw_name,
+                    "uidNumber": str(pw.pw_uid),
+                    "gidNumber": str(pw.pw_gid),
+                    "gecos": pw.pw_gecos,
+                    "homeDirectory": pw.pw_dir,
+                    "loginShell": pw.pw_shell
                 }
                 users.append(user)
 
@@ -192,16 +199,18 @@ class FreeNAS_NT4_Base(object):
         groups = []
         (wbres, wbout) = self._wbinfo(wbargs)
         if wbres == 0:
-            for line in wbout.splitlines():
-                (gres, gout) = self._wbinfo("--group-info '%s'" % line.strip())
-                parts = gout.strip().split(':')
-                if not parts or len(parts) < 4:
+            names = [line.strip() for line in wbout.splitlines()]
+            grents = getgrnam_many(names)
+            for name in names:
+                gr = grents.get(name.lower())
+                if gr is None:
                     continue
+
                 group = {
-                    "name": parts[0],
-                    "sAMAccountName": parts[0],
-                    "gidNumber": parts[2],
-                    "members": parts[3]
+                    "name": gr.gr_name,
+                    "sAMAccountName": gr.gr_name,
+                    "gidNumber": str(gr.gr_gid),
+                    "members": ','.join(gr.gr_mem)
                 }
                 groups.append(group)
 
@@ -302,36 +311,40 @@ class FreeNAS_NT4_Users(FreeNAS_NT4):
         for d in self.__domains:
             self.__users[d] = []
 
-            if (self.flags & FLAGS_CACHE_READ_USER) and self.__loaded('du', d):
-                log.debug("FreeNAS_NT4_Users.__get_users: "
-                    "NT4 [%s] users in cache", d)
-                nt4_users = self.__ducache[d]
+            with self.__ucache[d].refilling(self.flags & FLAGS_CACHE_WRITE_USER), \
+                self.__ducache[d].refilling(self.flags & FLAGS_CACHE_WRITE_USER):
+                if (self.flags & FLAGS_CACHE_READ_USER) and self.__loaded('du', d):
+                    log.debug("FreeNAS_NT4_Users.__get_users: "
+                        "NT4 [%s] users in cache", d)
+                    nt4_users = self.__ducache[d]
 
-            else:
-                log.debug("FreeNAS_NT4_Users.__get_users: "
-                    "NT4 [%s] users not in cache", d)
-                nt4_users = self.get_users(domain=d)
+                else:
+                    log.debug("FreeNAS_NT4_Users.__get_users: "
+                        "NT4 [%s] users not in cache", d)
+                    nt4_users = self.get_users(domain=d)
 
-            for u in nt4_users:
-                uid = u['uid']
+                for u in nt4_users:
+                    uid = u['uid']
 
-                if self.flags & FLAGS_CACHE_WRITE_USER:
-                    self.__ducache[d][uid] = u
+                    if self.flags & FLAGS_CACHE_WRITE_USER:
+                        self.__ducache[d][uid] = u
 
-                sAMAccountName = u['sAMAccountName']
-                usernames.append(sAMAccountName)
-                try:
-                    pw = pwd.getpwnam(sAMAccountName)
+                    sAMAccountName = u['sAMAccountName']
+                    self.__usernames.append(sAMAccountName)
+                    try:
+                        pw = passwd_entry(sAMAccountName, '*', u['uidNumber'],
+                            u['gidNumber'], u['gecos'], u['homeDirectory'],
+                            u['loginShell'])
 
-                except Exception, e:
-                    log.debug("Error on getpwname: %s",  e)
-                    continue
+                    except (KeyError, ValueError), e:
+                        log.debug("Invalid NT4 user %s: %s", sAMAccountName, e)
+                        continue
 
-                self.__users[d].append(pw) 
-                if self.flags & FLAGS_CACHE_WRITE_USER:
-                    self.__ucache[d][sAMAccountName] = pw
+                    self.__users[d].append(pw) 
+                    if self.flags & FLAGS_CACHE_WRITE_USER:
+                        self.__ucache[d][sAMAccountName] = pw
 
-                pw = None
+                    pw = None
 
             if self.flags & FLAGS_CACHE_WRITE_USER:
                 self.__loaded('u', d, True)
@@ -434,7 +447,7 @@ class FreeNAS_NT4_Groups(FreeNAS_NT4):
             count = 0
 
             for d in self.__domains:
-                if self.__loaded('u', d):
+                if self.__loaded('g', d):
                     self.__groups[d] = self.__gcache[d]
                     count += 1
 
@@ -447,34 +460,37 @@ class FreeNAS_NT4_Groups(FreeNAS_NT4):
         for d in self.__domains:
             self.__groups[d] = []
 
-            if (self.flags & FLAGS_CACHE_READ_GROUP) and self.__loaded('dg', d):
-                log.debug("FreeNAS_NT4_Groups.__get_groups: "
-                    "NT4 [%s] groups in cache", d)
-                nt4_groups = self.__dgcache[d]
+            with self.__gcache[d].refilling(self.flags & FLAGS_CACHE_WRITE_GROUP), \
+                self.__dgcache[d].refilling(self.flags & FLAGS_CACHE_WRITE_GROUP):
+                if (self.flags & FLAGS_CACHE_READ_GROUP) and self.__loaded('dg', d):
+                    log.debug("FreeNAS_NT4_Groups.__get_groups: "
+                        "NT4 [%s] groups in cache", d)
+                    nt4_groups = self.__dgcache[d]
 
-            else:
-                log.debug("FreeNAS_NT4_Groups.__get_groups: "
-                    "NT4 [%s] groups not in cache", d)
-                nt4_groups = self.get_groups(domain=d)
+                else:
+                    log.debug("FreeNAS_NT4_Groups.__get_groups: "
+                        "NT4 [%s] groups not in cache", d)
+                    nt4_groups = self.get_groups(domain=d)
 
-            for g in nt4_groups:
-                sAMAccountName = g['sAMAccountName']
-                self.__groupnames.append(sAMAccountName)
+                for g in nt4_groups:
+                    sAMAccountName = g['sAMAccountName']
+                    self.__groupnames.append(sAMAccountName)
 
-                if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                    self.__dgcache[d][sAMAccountName.upper()] = g
+                    if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                        self.__dgcache[d][sAMAccountName.upper()] = g
 
-                try:
-                    gr = grp.getgrnam(sAMAccountName)
+                    try:
+                        gr = group_entry(sAMAccountName, '*', g['gidNumber'],
+                            g['members'])
 
-                except:
-                    continue
+                    except (KeyError, ValueError):
+                        continue
 
-                self.__groups[d].append(gr)
-                if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                    self.__gcache[d][sAMAccountName.upper()] = gr
+                    self.__groups[d].append(gr)
+                    if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                        self.__gcache[d][sAMAccountName.upper()] = gr
 
-                gr = None
+                    gr = None
 
             if self.flags & FLAGS_CACHE_WRITE_GROUP:
                 self.__loaded('g', d, True)
@@ -24,9 +24,16 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 #####################################################################
+import bisect
 import grp
+import heapq
 import logging
 import pwd
+import threading
+import time
+
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
 
 from freenasUI.common.system import (
     activedirectory_enabled,
@@ -44,7 +51,8 @@ from freenasUI.common.freenasldap import (
     FreeNAS_LDAP_Group,
     FreeNAS_LDAP_User,
     FreeNAS_LDAP_Groups,
-    FreeNAS_LDAP_Users
+    FreeNAS_LDAP_Users,
+    FLAGS_DBINIT
 )
 
 from freenasUI.common.freenasnt4 import (
@@ -61,6 +69,13 @@ from freenasUI.common.freenasnis import (
     FreeNAS_NIS_Users
 )
 
+from freenasUI.common.freenascache import (
+    FLAGS_CACHE_READ_USER,
+    FLAGS_CACHE_WRITE_USER,
+    FLAGS_CACHE_READ_GROUP,
+    FLAGS_CACHE_WRITE_GROUP
+)
+
 from freenasUI.common.freenasdc import (
     FreeNAS_DomainController_Group,
     FreeNAS_DomainController_User,
@@ -216,6 +231,7 @@ class FreeNAS_Group(object):
 class FreeNAS_Groups(object):
     def __init__(self, **kwargs):
         log.debug("FreeNAS_Groups.__init__: enter")
+        local = kwargs.pop('local', True)
         self.__groups = None
 
         """
@@ -251,7 +267,7 @@ class FreeNAS_Groups(object):
             self.__groups = []
 
         self.__bsd_groups = []
-        objects = bsdGroups_objects()
+        objects = bsdGroups_objects() if local else {}
         for group, obj in objects.items():
             self.__bsd_groups.append(FreeNAS_Group(group, data=obj, dflags=0))
 
@@ -355,6 +371,7 @@ class FreeNAS_User(object):
 class FreeNAS_Users(object):
     def __init__(self, **kwargs):
         log.debug("FreeNAS_Users.__init__: enter")
+        local = kwargs.pop('local', True)
         self.__users = None
 
         """
@@ -389,7 +406,7 @@ class FreeNAS_Users(object):
             self.__users = []
 
         self.__bsd_users = []
-        objects = bsdUsers_objects()
+        objects = bsdUsers_objects() if local else {}
         for username, obj in objects.items():
             self.__bsd_users.append(
                 FreeNAS_User(username, data=obj, dflags=0)
@@ -405,3 +422,160 @@ class FreeNAS_Users(object):
             yield pw
         for pw in self.__users:
             yield pw
+
+
+class FreeNAS_PrincipalIndex(object):
+    """
+    Sorted in-memory index of the local and directory user (or group)
+    names, for name completion without enumerating the directory on
+    every request.
+
+    Local accounts are reindexed from the database as soon as they
+    change.  Directory principals are loaded from the directory cache
+    in a background thread, at first and then once older than REFRESH
+    seconds or after the directory service settings changed.  Searches
+    never wait for it, they answer from the previous index, without
+    directory principals until the first load is done.
+    """
+
+    REFRESH = 300
+
+    def __init__(self, kind):
+        assert kind in ('user', 'group')
+        self.kind = kind
+        self._lock = threading.Lock()
+        self._local = None
+        self._directory = ([], [])
+        self._built = 0
+        self._dirty = True
+        self._thread = None
+
+        post_save.connect(self._model_changed)
+        post_delete.connect(self._model_changed)
+
+    def _model_changed(self, sender, **kwargs):
+        module = getattr(sender, '__module__', '')
+        if module == 'freenasUI.account.models':
+            self._local = None
+        elif module == 'freenasUI.directoryservice.models':
+            self._dirty = True
+
+    def invalidate(self):
+        self._local = None
+        self._dirty = True
+
+    @staticmethod
+    def _sorted(entries):
+        entries = sorted(set(
+            (name.lower(), name, id) for name, id in entries
+        ))
+        return [e[0] for e in entries], [(e[1], e[2]) for e in entries]
+
+    def _load_local(self):
+        if self.kind == 'user':
+            entries = [
+                (name, obj['bsdusr_uid'])
+                for name, obj in bsdUsers_objects().items()
+            ]
+        else:
+            entries = [
+                (name, obj['bsdgrp_gid'])
+                for name, obj in bsdGroups_objects().items()
+            ]
+        return self._sorted(entries)
+
+    def _load_directory(self):
+        if self.kind == 'user':
+            principals = FreeNAS_Users(local=False, flags=FLAGS_DBINIT |
+                FLAGS_CACHE_READ_USER | FLAGS_CACHE_WRITE_USER)
+            entries = [(p.pw_name, p.pw_uid) for p in principals if p]
+        else:
+            principals = FreeNAS_Groups(local=False, flags=FLAGS_DBINIT |
+                FLAGS_CACHE_READ_GROUP | FLAGS_CACHE_WRITE_GROUP)
+            entries = [(p.gr_name, p.gr_gid) for p in principals if p]
+        return self._sorted(entries)
+
+    def _build(self):
+        try:
+            directory = self._load_directory()
+            with self._lock:
+                self._directory = directory
+                self._built = time.time()
+
+        except Exception, e:
+            log.error("Could not index the directory %ss: %s", self.kind, e)
+
+        finally:
+            with self._lock:
+                self._thread = None
+            # The builder thread has got its own database connection
+            connection.close()
+
+    def _refresh(self):
+        if self._local is None:
+            self._local = self._load_local()
+
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            if not self._dirty and time.time() - self._built < self.REFRESH:
+                return
+
+            self._dirty = False
+            self._thread = threading.Thread(target=self._build)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __len__(self):
+        self._refresh()
+        return len(self._local[0]) + len(self._directory[0])
+
+    @staticmethod
+    def _match(index, query, substring):
+        keys, entries = index
+        if substring and query:
+            for i, key in enumerate(keys):
+                if query in key:
+                    yield keys[i], entries[i]
+            return
+
+        for i in xrange(bisect.bisect_left(keys, query), len(keys)):
+            if not keys[i].startswith(query):
+                break
+            yield keys[i], entries[i]
+
+    def search(self, query=None, limit=50, exclude=None, substring=False):
+        """
+        Names starting with ``query`` (case insensitive), or containing
+        it when ``substring`` is set, in name order.
+
+        Returns:
+            list of (name, uid or gid), at most ``limit`` long
+        """
+        self._refresh()
+
+        with self._lock:
+            local, directory = self._local, self._directory
+
+        query = (query or '').lower()
+        exclude = set(exclude or [])
+        seen = set()
+        results = []
+
+        for key, entry in heapq.merge(
+            self._match(local, query, substring),
+            self._match(directory, query, substring),
+        ):
+            if limit and len(results) >= limit:
+                break
+            if entry[0] in exclude or entry[0] in seen:
+                continue
+            seen.add(entry[0])
+            results.append(entry)
+
+        return results
+
+
+user_index = FreeNAS_PrincipalIndex('user')
+group_index = FreeNAS_PrincipalIndex('group')
@@ -0,0 +1,124 @@
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+"""
+Bulk name service lookups.
+
+Resolving a directory with tens of thousands of accounts through
+pwd.getpwnam()/grp.getgrnam() costs one nss (winbindd, nss_ldap) round
+trip per name from within the django process.  These helpers hand the
+whole list to getent(1) in a few large batches instead.
+"""
+import grp
+import logging
+import pwd
+
+from subprocess import Popen, PIPE
+
+log = logging.getLogger('common.nss')
+
+GETENT = "/usr/bin/getent"
+
+#
+# Keep well below ARG_MAX even for long DOMAIN\account names
+#
+GETENT_BATCH = 512
+
+
+def _getent(database, names):
+    entries = {}
+    names = [n.encode('utf-8') if isinstance(n, unicode) else n
+        for n in names if n]
+
+    for i in xrange(0, len(names), GETENT_BATCH):
+        batch = names[i:i + GETENT_BATCH]
+        try:
+            proc = Popen([GETENT, database] + batch, stdout=PIPE,
+                stderr=PIPE, close_fds=True)
+            out = proc.communicate()[0]
+
+        except OSError as e:
+            log.debug("getent %s failed: %s", database, e)
+            continue
+
+        #
+        # getent exits 2 when some of the keys were not found but still
+        # prints every entry it could resolve, so the output is all that
+        # matters here.
+        #
+        for line in out.splitlines():
+            parts = line.split(':')
+            if parts and parts[0]:
+                entries[parts[0].lower()] = parts
+
+    return entries
+
+
+def passwd_entry(name, passwd, uid, gid, gecos, home, shell):
+    return pwd.struct_passwd((name, passwd, int(uid), int(gid),
+        gecos, home, shell))
+
+
+def group_entry(name, passwd, gid, members):
+    if not isinstance(members, list):
+        members = [m for m in members.split(',') if m]
+    return grp.struct_group((name, passwd, int(gid), members))
+
+
+def getpwnam_many(names):
+    """
+    Resolve `names` in bulk.
+
+    Returns a dict mapping the lowercased account name to its
+    pwd.struct_passwd; names that do not resolve are left out.
+    """
+    users = {}
+    for key, parts in _getent('passwd', names).iteritems():
+        if len(parts) < 7:
+            continue
+        try:
+            users[key] = passwd_entry(*parts[:7])
+        except ValueError:
+            continue
+    return users
+
+
+def getgrnam_many(names):
+    """
+    Resolve `names` in bulk.
+
+    Returns a dict mapping the lowercased group name to its
+    grp.struct_group; names that do not resolve are left out.
+    """
+    groups = {}
+    for key, parts in _getent('group', names).iteritems():
+        if len(parts) < 4:
+            continue
+        try:
+            groups[key] = group_entry(*parts[:4])
+        except ValueError:
+            continue
+    return groups
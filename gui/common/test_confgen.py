@@ -0,0 +1,320 @@
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from freenasUI.common import confgen
+
+
+class FakeSnapshot(object):
+
+    def __init__(self, **rows):
+        self._rows = rows
+
+    def __getitem__(self, name):
+        return self._rows.get(name, [])
+
+    def first(self, name, default=None):
+        rows = self[name]
+        if rows:
+            return rows[0]
+        return default
+
+
+class ConfigSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.database = tempfile.mkstemp()
+        os.close(fd)
+        conn = sqlite3.connect(self.database)
+        conn.execute("CREATE TABLE t (id INTEGER, name TEXT)")
+        conn.executemany("INSERT INTO t VALUES (?, ?)", [(1, 'a'), (2, 'b')])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        os.unlink(self.database)
+
+    def test_queries(self):
+        snapshot = confgen.ConfigSnapshot({
+            'all': "SELECT id, name FROM t ORDER BY id",
+            'none': "SELECT id FROM t WHERE id > 2",
+            'missing': "SELECT id FROM missing",
+        }, database=self.database)
+        self.assertEqual([r['name'] for r in snapshot['all']], ['a', 'b'])
+        self.assertEqual(snapshot.first('all')['id'], 1)
+        self.assertEqual(snapshot.first('none', 'x'), 'x')
+        self.assertEqual(snapshot['missing'], [])
+
+
+class WriteIfChangedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'file')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_unchanged(self):
+        self.assertTrue(confgen.write_if_changed(self.path, 'a\n', 0600))
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+        self.assertFalse(confgen.write_if_changed(self.path, 'a\n'))
+
+    def test_install_failure(self):
+        confgen.write_if_changed(self.path, 'a\n')
+
+        def install(tmp, path):
+            raise IOError("failed")
+        self.assertRaises(
+            IOError, confgen.write_if_changed, self.path, 'b\n', 0644, install
+        )
+        # Left as it was, so the next run writes it again
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'a\n')
+        self.assertEqual(os.listdir(self.dir), ['file'])
+        self.assertTrue(confgen.write_if_changed(self.path, 'b\n'))
+
+
+class PasswdRendererTest(unittest.TestCase):
+
+    def user(self, name, uid, **kwargs):
+        user = {
+            'bsdusr_username': name,
+            'bsdusr_unixhash': '$6$hash',
+            'bsdusr_uid': uid,
+            'bsdgrp_gid': uid,
+            'bsdusr_full_name': name.title(),
+            'bsdusr_home': '/mnt/tank/%s' % name,
+            'bsdusr_shell': '/bin/csh',
+            'bsdusr_password_disabled': False,
+            'bsdusr_locked': False,
+        }
+        user.update(kwargs)
+        return user
+
+    def test_render(self):
+        files = confgen.PasswdRenderer().render(FakeSnapshot(
+            users=[
+                self.user('alice', 1000),
+                self.user('bob', 1001, bsdusr_password_disabled=True),
+                self.user('carol', 1002, bsdusr_locked=True),
+            ],
+            groups=[
+                {'id': 1, 'bsdgrp_group': 'staff', 'bsdgrp_gid': 20},
+                {'id': 2, 'bsdgrp_group': 'empty', 'bsdgrp_gid': 30},
+            ],
+            members=[
+                {'bsdgrpmember_group_id': 1, 'bsdusr_username': 'alice'},
+                {'bsdgrpmember_group_id': 1, 'bsdusr_username': 'bob'},
+            ],
+        ))
+        self.assertEqual(files['/etc/master.passwd'].splitlines(), [
+            'alice:$6$hash:1000:1000::0:0:Alice:/mnt/tank/alice:/bin/csh',
+            'bob:*:1001:1001::0:0:Bob:/mnt/tank/bob:/bin/csh',
+            'carol:*LOCKED*:1002:1002::0:0:Carol:/mnt/tank/carol:/bin/csh',
+        ])
+        self.assertEqual(files['/etc/group'].splitlines(), [
+            'staff:*:20:alice,bob',
+            'empty:*:30:',
+        ])
+
+    def test_nis(self):
+        files = confgen.PasswdRenderer().render(FakeSnapshot(
+            nis=[{'nis_enable': 1}],
+        ))
+        self.assertEqual(
+            files['/etc/master.passwd'], confgen.NIS_PWDSTR + '\n'
+        )
+        self.assertEqual(files['/etc/group'], confgen.NIS_GRPSTR + '\n')
+
+
+class FakePopen(object):
+
+    returncode = 1
+
+    def __init__(self, args, **kwargs):
+        self.args = args
+
+    def communicate(self):
+        return 'pwd_mkdb: corrupted entry\n', None
+
+
+class PasswdInstallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.Popen = confgen.subprocess.Popen
+        confgen.subprocess.Popen = FakePopen
+
+    def tearDown(self):
+        confgen.subprocess.Popen = self.Popen
+
+    def test_pwd_mkdb_failure(self):
+        # Raising keeps write_if_changed() from counting it as written
+        self.assertRaises(
+            IOError, confgen.PasswdRenderer().install,
+            '/etc/.master.passwd.tmp', '/etc/master.passwd',
+        )
+
+
+class FakeEntry(object):
+
+    def __init__(self, id):
+        self.pw_uid = self.gr_gid = id
+
+
+class ExportsRendererTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.getpwnam = confgen.pwd.getpwnam
+        self.getgrnam = confgen.grp.getgrnam
+        users = {'domain user': FakeEntry(1100)}
+        groups = {'domain users': FakeEntry(1200)}
+
+        def getpwnam(name):
+            return users[name]
+
+        def getgrnam(name):
+            return groups[name]
+        confgen.pwd.getpwnam = getpwnam
+        confgen.grp.getgrnam = getgrnam
+
+    def tearDown(self):
+        confgen.pwd.getpwnam = self.getpwnam
+        confgen.grp.getgrnam = self.getgrnam
+        shutil.rmtree(self.dir)
+
+    def share(self, id, **kwargs):
+        share = {
+            'id': id,
+            'nfs_network': '',
+            'nfs_hosts': '',
+            'nfs_alldirs': False,
+            'nfs_ro': False,
+            'nfs_quiet': False,
+            'nfs_maproot_user': None,
+            'nfs_maproot_group': None,
+            'nfs_mapall_user': None,
+            'nfs_mapall_group': None,
+            'nfs_security': '',
+        }
+        share.update(kwargs)
+        return share
+
+    def test_map_names_with_spaces(self):
+        self.assertEqual(confgen._map_user(u'domain user'), '1100')
+        self.assertEqual(confgen._map_group(u'domain users'), '1200')
+        # Unknown names are left for mountd to report
+        self.assertEqual(confgen._map_user(u'no such user'), u'no such user')
+        self.assertEqual(confgen._map_user(u'root'), u'root')
+        self.assertEqual(confgen._map_group(u'wheel'), u'wheel')
+
+    def test_render(self):
+        files = confgen.ExportsRenderer().render(FakeSnapshot(
+            nfs=[{'nfs_srv_v4': True}],
+            shares=[
+                self.share(
+                    2, nfs_ro=True, nfs_network='10.0.0.0/8 192.168.0.0/16',
+                    nfs_mapall_user=u'domain user',
+                    nfs_mapall_group=u'domain users',
+                    nfs_security='krb5,krb5i',
+                ),
+                self.share(
+                    1, nfs_alldirs=True, nfs_hosts='host1 host2',
+                    nfs_maproot_user=u'root', nfs_maproot_group=u'wheel',
+                ),
+                self.share(3),
+            ],
+            paths=[
+                {'share_id': 2, 'path': self.dir},
+                {'share_id': 1, 'path': self.dir},
+                {'share_id': 3, 'path': os.path.join(self.dir, 'missing')},
+            ],
+        ))
+        self.assertEqual(files['/etc/exports'].splitlines(), [
+            'V4: /',
+            '%s -ro -mapall=1100:1200 -sec=krb5:krb5i -network 10.0.0.0/8'
+            % self.dir,
+            '%s -ro -mapall=1100:1200 -sec=krb5:krb5i -network 192.168.0.0/16'
+            % self.dir,
+            '%s -alldirs -maproot=root:wheel host1 host2' % self.dir,
+        ])
+
+
+class CrontabRendererTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.base = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('# base\n')
+        self.renderer = confgen.CrontabRenderer()
+        self.renderer.base = self.base
+        self.renderer._update_check = lambda: None
+
+    def tearDown(self):
+        os.unlink(self.base)
+
+    def test_render(self):
+        files = self.renderer.render(FakeSnapshot(
+            cronjobs=[{
+                'cron_minute': u'*/5', 'cron_hour': u'*',
+                'cron_daymonth': u'*', 'cron_month': u'*',
+                'cron_dayweek': u'*', 'cron_user': u'root',
+                'cron_command': u'date +%s\n',
+                'cron_stdout': True, 'cron_stderr': False,
+            }],
+            scrubs=[{
+                'scrub_threshold': 35, 'scrub_minute': u'00',
+                'scrub_hour': u'00', 'scrub_daymonth': u'*',
+                'scrub_month': u'*', 'scrub_dayweek': u'7',
+                'vol_name': u'tank',
+            }],
+            snaptasks=[{'count': 0}],
+        ))
+        self.assertEqual(files['/etc/crontab'].splitlines(), [
+            '# base',
+            '*/5\t*\t*\t*\t*\troot\tPATH="%s" date +\\%%s > /dev/null'
+            % confgen.CRON_PATH,
+            '00\t00\t*\t*\t7\troot\tPATH="%s" /usr/local/sbin/scrub -t 35 tank'
+            % confgen.CRON_PATH,
+            '15\t4\t*\t*\t6\troot\t/usr/local/bin/python '
+            '/usr/local/www/freenasUI/tools/autosnap.py > /dev/null 2>&1',
+        ])
+
+    def test_autosnap_every_minute(self):
+        files = self.renderer.render(FakeSnapshot(snaptasks=[{'count': 2}]))
+        self.assertEqual(
+            files['/etc/crontab'].splitlines()[-1].split('\troot\t')[0],
+            '*\t*\t*\t*\t*',
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import os
+import pwd
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from freenasUI.common.freenascache import FreeNAS_BaseCache
+
+
+class FreeNAS_BaseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.cache = FreeNAS_BaseCache(self.cachedir)
+        self.pw = pwd.getpwuid(os.getuid())
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.cachedir)
+
+    def in_thread(self, target):
+        errors = []
+
+        def run():
+            try:
+                target()
+            except Exception as e:
+                errors.append(e)
+        t = threading.Thread(target=run)
+        t.start()
+        t.join()
+        if errors:
+            raise errors[0]
+
+    def test_write_from_thread(self):
+        self.in_thread(lambda: self.cache.write('root', self.pw))
+        self.assertEqual(self.cache['root'], self.pw)
+
+    def test_refill_from_threads(self):
+        self.cache['old'] = self.pw
+        with self.cache.refilling():
+            for key in ('a', 'b'):
+                self.in_thread(lambda: self.cache.write(key, self.pw))
+            # Not visible before commit()
+            self.assertEqual(self.cache.keys(), ['old'])
+        self.assertEqual(sorted(self.cache.keys()), ['a', 'b'])
+
+    def test_refill_lost_race(self):
+        other = FreeNAS_BaseCache(self.cachedir)
+        try:
+            other.begin()
+            start = time.time()
+            with self.cache.refilling():
+                for i in range(5):
+                    self.assertFalse(self.cache.write(str(i), self.pw))
+            # Only begin() waits for the lock, the writes are dropped
+            self.assertTrue(time.time() - start < 2)
+            other['x'] = self.pw
+            other.commit()
+        finally:
+            other.close()
+        self.assertEqual(self.cache.keys(), ['x'])
+
+
+if __name__ == '__main__':
+    unittest.main()
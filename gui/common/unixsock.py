@@ -0,0 +1,105 @@
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+import json
+import logging
+import os
+import socket
+import SocketServer
+
+log = logging.getLogger('common.unixsock')
+
+
+class UnixSockError(Exception):
+    pass
+
+
+class JSONRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Handle JSON encoded requests, one per line, dispatching them to
+    the public methods of the server instance
+    """
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+                method = request.get('method') or ''
+                if method.startswith('_'):
+                    raise ValueError("Invalid method: %s" % method)
+                func = getattr(self.server.instance, method, None)
+                if func is None:
+                    raise ValueError("Unknown method: %s" % method)
+                response = {'result': func(**request.get('params', {}))}
+            except Exception, e:
+                log.debug("Request failed: %s", e, exc_info=True)
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class UnixJSONServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Threaded JSON server listening on a UNIX socket, every public
+    method of ``instance`` can be called by clients
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, instance, mode=0o600):
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, JSONRequestHandler)
+        os.chmod(path, mode)
+        self.instance = instance
+
+
+def unixsock_call(path, method, timeout=None, **params):
+    """
+    Call ``method`` with keyword arguments ``params`` on the server
+    listening at ``path``
+
+    Raises:
+        socket.error: the server could not be reached
+        UnixSockError: the call failed on the server side
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        f = sock.makefile('rwb')
+        f.write(json.dumps({'method': method, 'params': params}) + '\n')
+        f.flush()
+        line = f.readline()
+        f.close()
+    finally:
+        sock.close()
+    if not line:
+        raise UnixSockError("Connection closed by %s" % path)
+    response = json.loads(line)
+    if 'error' in response:
+        raise UnixSockError(response['error'])
+    return response['result']
@@ -995,7 +995,27 @@ class warden_zfsrmsnap(warden_base):
             WARDEN_ZFSRMSNAP, flags, **kwargs)
 
 
+def _jails_changed():
+    """
+    The jails in the menu come from warden, model signals do not
+    tell the navtree about these changes
+    """
+    from freenasUI.freeadmin.navtree import navtree
+    navtree.invalidate()
+
+
 class Warden(warden_base):
+
+    # Commands changing the jails or their state
+    _changes = (
+        warden_auto,
+        warden_create,
+        warden_delete,
+        warden_set,
+        warden_start,
+        warden_stop,
+    )
+
     def __init__(self, flags=WARDEN_FLAGS_NONE, **kwargs):
         self.flags = flags
         self.obj = None
@@ -1030,7 +1050,11 @@ class Warden(warden_base):
 
     def __call(self, obj):
         if obj is not None:
-            tmp = obj.run()
+            try:
+                tmp = obj.run()
+            finally:
+                if isinstance(obj, self._changes):
+                    _jails_changed()
             if tmp is not None and len(tmp) > 1:
                 if hasattr(obj, "parse"):
                     return obj.parse(tmp)
@@ -39,12 +39,8 @@ from dojango import forms
 from dojango.forms import widgets
 from dojango.forms.widgets import DojoWidgetMixin
 from freenasUI.common.freenasldap import FLAGS_DBINIT
-from freenasUI.common.freenascache import (
-    FLAGS_CACHE_READ_USER, FLAGS_CACHE_WRITE_USER, FLAGS_CACHE_READ_GROUP,
-    FLAGS_CACHE_WRITE_GROUP
-)
 from freenasUI.common.freenasusers import (
-    FreeNAS_Users, FreeNAS_User, FreeNAS_Groups, FreeNAS_Group
+    FreeNAS_User, FreeNAS_Group, user_index, group_index
 )
 from freenasUI.storage.models import MountPoint
 
@@ -102,11 +98,7 @@ class UserField(forms.ChoiceField):
 
     def _reroll(self):
         from freenasUI.account.forms import FilteredSelectJSON
-        try:
-            users = FreeNAS_Users(flags=FLAGS_DBINIT|FLAGS_CACHE_READ_USER)
-        except:
-            users = []
-        if len(users) > 500:
+        if len(user_index) > 500:
             if self.initial:
                 self.choices = ((self.initial, self.initial),)
             kwargs = {}
@@ -119,17 +111,12 @@ class UserField(forms.ChoiceField):
             ulist = []
             if not self.required:
                 ulist.append(('-----', 'N/A'))
-            ulist.extend(
-                map(
-                    lambda x: (x.pw_name, x.pw_name, ),
-                    filter(
-                        lambda y: (
-                            y is not None and y.pw_name not in self._exclude
-                        ),
-                        users
-                    )
+            ulist.extend([
+                (name, name)
+                for name, uid in user_index.search(
+                    limit=None, exclude=self._exclude
                 )
-            )
+            ])
 
             self.widget = widgets.FilteringSelect()
             self.choices = ulist
@@ -165,11 +152,7 @@ class GroupField(forms.ChoiceField):
 
     def _reroll(self):
         from freenasUI.account.forms import FilteredSelectJSON
-        try:
-            groups = FreeNAS_Groups(flags=FLAGS_DBINIT|FLAGS_CACHE_READ_GROUP)
-        except:
-            groups = []
-        if len(groups) > 500:
+        if len(group_index) > 500:
             if self.initial:
                 self.choices = ((self.initial, self.initial),)
             self.widget = FilteredSelectJSON(url=("account_bsdgroup_json",))
@@ -177,9 +160,9 @@ class GroupField(forms.ChoiceField):
             glist = []
             if not self.required:
                 glist.append(('-----', 'N/A'))
-            glist.extend(
-                [(x.gr_name, x.gr_name) for x in groups]
-            )
+            glist.extend([
+                (name, name) for name, gid in group_index.search(limit=None)
+            ])
             self.widget = widgets.FilteringSelect()
             self.choices = glist
 
@@ -27,14 +27,17 @@
 import json
 import logging
 import re
+import threading
+import time
+import urllib2
 
 from django.conf import settings
 from django.core.urlresolvers import NoReverseMatch, resolve, reverse
 from django.db import models
+from django.db.models.signals import post_delete, post_save
 from django.forms import ModelForm
 from django.utils.translation import ugettext_lazy as _
 
-import eventlet
 from freenasUI.common.log import log_traceback
 from freenasUI.common.warden import (
     WARDEN_STATUS_RUNNING, WARDEN_TYPE_PLUGINJAIL
@@ -44,6 +47,7 @@ from freenasUI.freeadmin.tree import (
     tree_roots, TreeRoot, TreeNode, unserialize_tree
 )
 from freenasUI.jails.models import Jails
+from freenasUI.middleware import zfscache
 from freenasUI.plugins.models import Plugins
 from freenasUI.plugins.utils import get_base_url
 
@@ -82,12 +86,142 @@ class ModelFormsDict(dict):
             self[key] = val
 
 
+class PluginMenuCache(object):
+    """
+    Tree menu fragments served by plugin jails (/_s/treemenu).
+
+    Fragments are refreshed in the background once older than TTL so a
+    slow or dead plugin jail does not hold up the menu.  The first fetch of
+    a plugin is waited for, but no longer than COLD_WAIT seconds.
+    ``generation`` is bumped whenever a fragment changes.
+    """
+
+    TTL = 60
+    TIMEOUT = 5
+    COLD_WAIT = 1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.generation = 0
+
+    def _fetch(self, key, url, sessionid):
+        data = None
+        try:
+            opener = urllib2.build_opener()
+            opener.addheaders = [(
+                'Cookie', 'sessionid=%s' % (sessionid, )
+            )]
+            response = opener.open(url, None, self.TIMEOUT)
+            data = response.read()
+            if not data:
+                log.warn(_("Empty data returned from %s") % (url,))
+        except Exception, e:
+            log.warn(_("Couldn't retrieve %(url)s: %(error)s") % {
+                'url': url,
+                'error': e,
+            })
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            if data != entry['data']:
+                entry['data'] = data
+                self.generation += 1
+            entry['fetched'] = time.time()
+            entry['thread'] = None
+
+    def get(self, plugins, host, sessionid):
+        """
+        Get the fragments of ``plugins``, starting refreshes as needed.
+
+        Returns:
+            tuple(generation, list of (plugin, url, data))
+        """
+        now = time.time()
+        cold = []
+        with self._lock:
+            keys = set()
+            for plugin in plugins:
+                key = (plugin.plugin_name, plugin.id)
+                keys.add(key)
+                url = "%s/plugins/%s/%d/_s/treemenu" % (
+                    host, plugin.plugin_name, plugin.id,
+                )
+                entry = self._entries.get(key)
+                if entry is None or entry['url'] != url:
+                    entry = self._entries[key] = {
+                        'url': url,
+                        'data': None,
+                        'fetched': None,
+                        'thread': None,
+                    }
+                if entry['thread'] is None and (
+                    entry['fetched'] is None or
+                    now - entry['fetched'] > self.TTL
+                ):
+                    thread = threading.Thread(
+                        target=self._fetch, args=(key, url, sessionid)
+                    )
+                    thread.daemon = True
+                    thread.start()
+                    entry['thread'] = thread
+                    if entry['fetched'] is None:
+                        cold.append(thread)
+            for key in set(self._entries) - keys:
+                del self._entries[key]
+
+        deadline = now + self.COLD_WAIT
+        for thread in cold:
+            thread.join(max(deadline - time.time(), 0))
+
+        with self._lock:
+            results = []
+            for plugin in plugins:
+                entry = self._entries.get((plugin.plugin_name, plugin.id))
+                if entry and entry['data']:
+                    results.append((plugin, entry['url'], entry['data']))
+            return self.generation, results
+
+
 class NavTree(object):
 
+    # Rebuild the tree at least this often, in case something changed
+    # behind our back (e.g. another process writing to the database)
+    MAXAGE = 300
+
     def __init__(self):
         self._modelforms = ModelFormsDict()
         self._navs = {}
         self._generated = False
+        self._scanned = {}
+        self._lock = threading.RLock()
+        self._changes = 0
+        self._version = None
+        self._built = 0
+        self._options = {}
+        self._plugins = []
+        self._plugin_cache = PluginMenuCache()
+        post_save.connect(self._model_changed)
+        post_delete.connect(self._model_changed)
+
+    def _model_changed(self, sender, **kwargs):
+        module = getattr(sender, '__module__', '')
+        if module.startswith('freenasUI.') or module.split('.')[0] in [
+            app.split('.')[-1] for app in settings.INSTALLED_APPS
+        ]:
+            self._changes += 1
+
+    def invalidate(self):
+        """
+        Force the tree to be rebuilt on the next menu load, for changes
+        not tracked through model signals (e.g. jails changed through
+        warden, see freenasUI.common.warden).
+        """
+        self._changes += 1
+
+    def _current_version(self, plugin_generation):
+        return (self._changes, zfscache.generation(), plugin_generation)
 
     def isGenerated(self):
         return self._generated
@@ -160,6 +294,45 @@ class NavTree(object):
                 if parent is not False:
                     parent.append_child(opt)
 
+    def _scan_app(self, app):
+        """
+        Import app.nav and app.models and pick their TreeNode and Model
+        classes. This only needs to be done once per process.
+        """
+        if app in self._scanned:
+            return self._scanned[app]
+
+        navclasses = []
+        modnav = self._get_module(app, 'nav')
+        if modnav:
+            modname = "%s.nav" % app
+            for c in dir(modnav):
+                navc = getattr(modnav, c)
+                try:
+                    subclass = issubclass(navc, TreeNode)
+                except TypeError:
+                    continue
+                if navc.__module__ == modname and subclass:
+                    navclasses.append(navc)
+
+        modelclasses = []
+        modmodels = self._get_module(app, 'models')
+        if modmodels:
+            for c in dir(modmodels):
+                model = getattr(modmodels, c)
+                try:
+                    if issubclass(model, models.Model):
+                        if model._meta.app_label == app:
+                            continue
+                    else:
+                        continue
+                except TypeError:
+                    continue
+                modelclasses.append((c, model))
+
+        self._scanned[app] = (modnav, navclasses, modelclasses)
+        return self._scanned[app]
+
     def titlecase(self, s):
         return re.sub(
             r"[A-Za-z]+('[A-Za-z]+)?",
@@ -214,9 +387,29 @@ class NavTree(object):
                 - Objects
                 - Add (Model)
                 - View (Model)
-        """
 
+        The tree is only rebuilt if a model was saved or deleted, the zfs
+        state was changed or a plugin menu changed since the last time.
+        """
+        with self._lock:
+            plugin_generation, fragments = self._plugin_cache.get(
+                self._plugins,
+                get_base_url(request) if request else '',
+                request.COOKIES.get("sessionid", '') if request else '',
+            )
+            if (
+                self._generated and
+                self._version == self._current_version(plugin_generation) and
+                time.time() - self._built < self.MAXAGE
+            ):
+                return
+            self._generate(request)
+
+    def _generate(self, request):
+        changes = self._changes
+        zfs_generation = zfscache.generation()
         self._generated = True
+        self._options.clear()
         self._navs.clear()
         tree_roots.clear()
         childs_of = []
@@ -319,14 +512,17 @@ class NavTree(object):
             if j.jail_type == WARDEN_TYPE_PLUGINJAIL and \
                 j.jail_status == WARDEN_STATUS_RUNNING:
                 jails.append(j)
-        self._get_plugins_nodes(request, jails)
+        plugin_generation = self._get_plugins_nodes(request, jails)
+
+        self._version = (changes, zfs_generation, plugin_generation)
+        self._built = time.time()
 
     def _generate_app(self, app, request, tree_roots, childs_of):
 
         # Thats the root node for the app tree menu
         nav = TreeRoot(app.split(".")[-1])
 
-        modnav = self._get_module(app, 'nav')
+        modnav, navclasses, modelclasses = self._scan_app(app)
         if hasattr(modnav, 'BLACKLIST'):
             BLACKLIST = modnav.BLACKLIST
         else:
@@ -353,22 +549,15 @@ class NavTree(object):
             nav.url = reverse(modnav.URL)
 
         if modnav:
-            modname = "%s.nav" % app
-            for c in dir(modnav):
-                navc = getattr(modnav, c)
-                try:
-                    subclass = issubclass(navc, TreeNode)
-                except TypeError:
-                    continue
-                if navc.__module__ == modname and subclass:
-                    obj = navc(request=request)
+            for navc in navclasses:
+                obj = navc(request=request)
 
-                    if obj.skip is True:
-                        continue
-                    if not obj.append_to:
-                        self.register_option(obj, nav, replace=True)
-                    else:
-                        self._navs[obj.append_to + '.' + obj.gname] = obj
+                if obj.skip is True:
+                    continue
+                if not obj.append_to:
+                    self.register_option(obj, nav, replace=True)
+                else:
+                    self._navs[obj.append_to + '.' + obj.gname] = obj
 
             tree_roots.register(nav)  # We register it to the tree root
             if hasattr(modnav, 'init'):
@@ -379,21 +568,10 @@ class NavTree(object):
             log.debug("App %s has no nav.py module, skipping", app)
             return
 
-        modmodels = self._get_module(app, 'models')
-        if modmodels:
+        if modelclasses:
 
             modname = '%s.models' % app
-            for c in dir(modmodels):
-
-                model = getattr(modmodels, c)
-                try:
-                    if issubclass(model, models.Model):
-                        if model._meta.app_label == app:
-                            continue
-                    else:
-                        continue
-                except TypeError, e:
-                    continue
+            for c, model in modelclasses:
 
                 if c in BLACKLIST:
                     log.debug(
@@ -517,43 +695,18 @@ class NavTree(object):
                     subopt.type = 'viewmodel'
                     self.register_option(subopt, navopt)
 
-    def _plugin_fetch(self, args):
-        plugin, host, request = args
-        if re.match('^.+\[.+\]', host, re.I):
-            import urllib2
-        else:
-            from eventlet.green import urllib2
-
-        data = None
-        url = "%s/plugins/%s/%d/_s/treemenu" % (host, plugin.plugin_name, plugin.id)
-        try:
-            opener = urllib2.build_opener()
-            opener.addheaders = [(
-                'Cookie', 'sessionid=%s' % (
-                    request.COOKIES.get("sessionid", ''),
-                )
-            )]
-            #TODO: Increase timeout based on number of plugins
-            response = opener.open(url, None, 5)
-            data = response.read()
-            if not data:
-                log.warn(_("Empty data returned from %s") % (url,))
-        except Exception, e:
-            log.warn(_("Couldn't retrieve %(url)s: %(error)s") % {
-                'url': url,
-                'error': e,
-            })
-        return plugin, url, data
-
     def _get_plugins_nodes(self, request, jails):
 
-        host = get_base_url(request)
-        args = map(
-            lambda y: (y, host, request),
-            Plugins.objects.filter(plugin_enabled=True, plugin_jail__in=[jail.jail_host for jail in jails]))
-
-        pool = eventlet.GreenPool(20)
-        for plugin, url, data in pool.imap(self._plugin_fetch, args):
+        self._plugins = list(Plugins.objects.filter(
+            plugin_enabled=True,
+            plugin_jail__in=[jail.jail_host for jail in jails],
+        ))
+        generation, fragments = self._plugin_cache.get(
+            self._plugins,
+            get_base_url(request) if request else '',
+            request.COOKIES.get("sessionid", '') if request else '',
+        )
+        for plugin, url, data in fragments:
 
             if not data:
                 continue
@@ -599,6 +752,8 @@ class NavTree(object):
                     })
                 continue
 
+        return generation
+
     def _build_nav(self, user):
         navs = []
         for nav in tree_roots['main']:
@@ -690,6 +845,16 @@ class NavTree(object):
         return my
 
     def dijitTree(self, user):
+        """
+        Menu for ``user``, memoized until the tree is regenerated.
+        """
+        with self._lock:
+            key = getattr(user, 'pk', None)
+            if key not in self._options:
+                self._options[key] = self._dijitTree(user)
+            return self._options[key]
+
+    def _dijitTree(self, user):
 
         class ByRef(object):
             def __init__(self, val):
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+
+"""
+Retention planning of periodic snapshots (tools/autosnap.py)
+
+Every snapshot is read once, with its freenas:state, and indexed per
+(filesystem, retention policy) so deciding what to take and what to
+destroy does not rescan the list for every task.
+"""
+from datetime import datetime, timedelta
+from subprocess import Popen, PIPE
+import logging
+import re
+import time
+
+from freenasUI.common.pipesubr import pipeopen
+
+log = logging.getLogger('middleware.autosnap')
+
+AUTOSNAP_RE = re.compile(
+    r'^auto-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})\.'
+    r'(?P<hour>\d{2})(?P<minute>\d{2})-(?P<retcount>\d+)(?P<retunit>[hdwmy])$'
+)
+
+# Keep zfs destroy argument lists well below ARG_MAX
+DESTROY_BATCH = 64 * 1024
+
+
+def retention_delta(count, unit):
+    count = int(count)
+    if unit == 'h':
+        return timedelta(hours=count)
+    elif unit == 'd':
+        return timedelta(days=count)
+    elif unit == 'w':
+        return timedelta(days=7 * count)
+    elif unit == 'm':
+        return timedelta(days=int(30.436875 * count))
+    elif unit == 'y':
+        return timedelta(days=int(365.2425 * count))
+    return timedelta()
+
+
+class RetentionPlanner(object):
+    """
+    Decide which periodic snapshots are due and which expired
+
+    Arguments:
+        snaptime: datetime of this run
+        policies: set of (filesystem, retention policy) with a task
+            running now, retention policy being e.g. '2w'
+        recursive: filesystems of enabled recursive tasks
+        nonrecursive: filesystems of enabled non-recursive tasks
+    """
+
+    def __init__(self, snaptime, policies, recursive, nonrecursive):
+        self.snaptime = snaptime
+        self.policies = set(policies)
+        self.recursive = set(recursive)
+        self.nonrecursive = set(nonrecursive)
+        # (filesystem, retention policy) = datetime of the latest snapshot
+        self.latest = {}
+        # filesystem = [snapshot names]
+        self.expired = {}
+        self.timings = {}
+        self._owned = {}
+
+    def owned(self, fs):
+        """
+        Whether snapshots of ``fs`` are managed by an enabled task
+        """
+        try:
+            return self._owned[fs]
+        except KeyError:
+            pass
+        rv = fs in self.nonrecursive
+        if not rv:
+            path = fs
+            while True:
+                if path in self.recursive:
+                    rv = True
+                    break
+                if '/' not in path:
+                    break
+                path = path.rsplit('/', 1)[0]
+        self._owned[fs] = rv
+        return rv
+
+    def load(self, lines):
+        """
+        Index the output of ``zfs list -H -t snapshot -o name,freenas:state``
+        """
+        start = time.time()
+        count = 0
+        for line in lines:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            count += 1
+            fields = line.split('\t')
+            fs, snapname = fields[0].split('@', 1)
+            reg = AUTOSNAP_RE.match(snapname)
+            if reg is None:
+                continue
+            info = reg.groupdict()
+            created = datetime(
+                int(info['year']),
+                int(info['month']),
+                int(info['day']),
+                int(info['hour']),
+                int(info['minute']),
+            )
+            policy = '%s%s' % (info['retcount'], info['retunit'])
+            expires = created + retention_delta(
+                info['retcount'], info['retunit']
+            )
+            if expires <= self.snaptime:
+                # Only delete the snapshot if there's a snapshot task
+                # enabled that created it and it has been replicated
+                state = fields[1] if len(fields) > 1 else '-'
+                if state == '-' and self.owned(fs):
+                    self.expired.setdefault(fs, []).append(snapname)
+            elif (fs, policy) in self.policies:
+                latest = self.latest.get((fs, policy))
+                if latest is None or latest < created:
+                    self.latest[(fs, policy)] = created
+        self.timings['load'] = time.time() - start
+        self.timings['snapshots'] = count
+        return count
+
+    def due(self, tasks_map):
+        """
+        Remove from ``tasks_map`` the tasks whose interval has not yet
+        passed since the latest snapshot of the same policy
+
+        ``tasks_map`` maps (filesystem, retention policy) to tasks
+        """
+        start = time.time()
+        for key, tasklist in tasks_map.items():
+            latest = self.latest.get(key)
+            if latest is None:
+                continue
+            tasklist[:] = [
+                task for task in tasklist
+                if latest + timedelta(minutes=task.task_interval) <= self.snaptime
+            ]
+            if not tasklist:
+                del tasks_map[key]
+        self.timings['due'] = time.time() - start
+        return tasks_map
+
+    def destroy_batches(self, maxlen=DESTROY_BATCH):
+        """
+        Group the expired snapshots of each filesystem into
+        ``fs@a,b,c`` arguments of at most ``maxlen`` characters
+
+        Snapshots are destroyed recursively, those also expiring in a
+        parent filesystem are left to it.
+        """
+        planned = {}
+        for fs in sorted(self.expired):
+            parents = []
+            path = fs
+            while '/' in path:
+                path = path.rsplit('/', 1)[0]
+                if path in planned:
+                    parents.append(planned[path])
+            planned[fs] = set(self.expired[fs])
+            batch = []
+            length = len(fs) + 1
+            for snapname in self.expired[fs]:
+                if any(snapname in names for names in parents):
+                    continue
+                if batch and length + len(snapname) + 1 > maxlen:
+                    yield fs, batch
+                    batch = []
+                    length = len(fs) + 1
+                batch.append(snapname)
+                length += len(snapname) + 1
+            if batch:
+                yield fs, batch
+
+    def recheck(self, maxlen=DESTROY_BATCH):
+        """
+        Read the freenas:state of the expired snapshots again and keep
+        only those still not waiting for replication
+
+        The listing given to load() is taken before MNTLOCK is held,
+        autorepl may have marked snapshots NEW or LATEST since, so this
+        has to run under MNTLOCK right before destroy().
+
+        Returns:
+            number of snapshots dropped
+        """
+        start = time.time()
+        names = [
+            '%s@%s' % (fs, snapname)
+            for fs in sorted(self.expired)
+            for snapname in self.expired[fs]
+        ]
+        states = {}
+        chunk = []
+        length = 0
+        for name in names + [None]:
+            if chunk and (name is None or length + len(name) + 1 > maxlen):
+                proc = Popen(
+                    ['/sbin/zfs', 'get', '-H', '-o', 'name,value',
+                     'freenas:state'] + chunk,
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    close_fds=True,
+                )
+                # Snapshots gone since are not listed
+                for line in proc.communicate()[0].split('\n'):
+                    if '\t' in line:
+                        snapshot, value = line.split('\t', 1)
+                        states[snapshot] = value
+                chunk = []
+                length = 0
+            if name is not None:
+                chunk.append(name)
+                length += len(name) + 1
+
+        dropped = 0
+        for fs in self.expired.keys():
+            snapnames = [
+                snapname for snapname in self.expired[fs]
+                if states.get('%s@%s' % (fs, snapname)) == '-'
+            ]
+            dropped += len(self.expired[fs]) - len(snapnames)
+            if snapnames:
+                self.expired[fs] = snapnames
+            else:
+                del self.expired[fs]
+        self.timings['recheck'] = time.time() - start
+        return dropped
+
+    def destroy(self, logger=log):
+        """
+        Destroy the expired snapshots, one zfs destroy per batch
+
+        A batch that fails is retried one snapshot at a time so a single
+        busy snapshot does not keep the others around.
+
+        Returns:
+            number of zfs destroy commands run
+        """
+        start = time.time()
+        commands = 0
+        for fs, batch in self.destroy_batches():
+            # snapshots with clones will have destruction deferred
+            snapshot = '%s@%s' % (fs, ','.join(batch))
+            proc = pipeopen(
+                '/sbin/zfs destroy -r -d %s' % snapshot, logger=logger
+            )
+            err = proc.communicate()[1]
+            commands += 1
+            if proc.returncode == 0:
+                continue
+            if len(batch) == 1:
+                logger.error(
+                    "Failed to destroy snapshot '%s': %s", snapshot, err
+                )
+                continue
+            for snapname in batch:
+                snapshot = '%s@%s' % (fs, snapname)
+                proc = pipeopen(
+                    '/sbin/zfs destroy -r -d %s' % snapshot, logger=logger
+                )
+                err = proc.communicate()[1]
+                commands += 1
+                if proc.returncode != 0:
+                    logger.error(
+                        "Failed to destroy snapshot '%s': %s", snapshot, err
+                    )
+        self.timings['destroy'] = time.time() - start
+        self.timings['destroy_commands'] = commands
+        return commands
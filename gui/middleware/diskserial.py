@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+
+from multiprocessing.pool import ThreadPool
+import fcntl
+import json
+import logging
+import os
+import tempfile
+
+log = logging.getLogger('middleware.diskserial')
+
+
+class DiskSerialCache(object):
+    """
+    Persistent devname -> serial map shared across processes
+
+    Each entry is keyed on the device name and is only considered valid
+    while the GEOM ident and mediasize of the disk still match the ones
+    seen when the serial was probed, so a different disk showing up under
+    the same name is detected without having to probe it first.
+
+    Entries are dropped explicitly through ``invalidate`` when devd
+    reports a disk attach/detach.
+
+    The files are only readable by root and kept out of world writable
+    directories, the cache is written by root.
+    """
+
+    CACHE_FILE = '/var/run/.diskserial'
+    WORKERS = 8
+
+    def __init__(self, path=None, workers=None):
+        self.path = path or self.CACHE_FILE
+        self.workers = workers or self.WORKERS
+        self._entries = None
+
+    def _lock(self):
+        fd = os.open(
+            '%s.lock' % self.path,
+            os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW,
+            0600,
+        )
+        lockfile = os.fdopen(fd, 'w')
+        fcntl.lockf(lockfile, fcntl.LOCK_EX)
+        return lockfile
+
+    def _load(self):
+        entries = {}
+        try:
+            fd = os.open(self.path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:
+            return entries
+        with os.fdopen(fd, 'rb') as f:
+            try:
+                entries = json.load(f)
+            except Exception, e:
+                log.warn("Failed to load disk serial cache: %s", e)
+        return entries
+
+    def _save(self, entries):
+        # mkstemp() creates the file with mode 0600
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(self.path),
+            prefix='.diskserial',
+        )
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(entries, f)
+        os.rename(tmp, self.path)
+
+    def _update(self, changes=None, remove=None):
+        """
+        Merge changes into the cache file under an exclusive lock,
+        other processes may have updated it in the meantime
+        """
+        lockfile = self._lock()
+        try:
+            entries = self._load()
+            for devname in (remove or ()):
+                entries.pop(devname, None)
+            if changes:
+                entries.update(changes)
+            self._save(entries)
+            self._entries = entries
+        finally:
+            lockfile.close()
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def get(self, devname, ident, mediasize):
+        """
+        Get the cached serial of ``devname``
+
+        Returns:
+            The serial (None if the disk has no serial) or
+            KeyError if the entry is missing or stale
+        """
+        entry = self.entries.get(devname)
+        if (
+            entry is None or
+            entry['ident'] != ident or
+            entry['mediasize'] != mediasize
+        ):
+            raise KeyError(devname)
+        serial = entry['serial']
+        if isinstance(serial, unicode):
+            serial = serial.encode('utf-8')
+        return serial
+
+    def set(self, devname, ident, mediasize, serial):
+        self.set_many([(devname, ident, mediasize, serial)])
+
+    def set_many(self, items):
+        changes = {}
+        for devname, ident, mediasize, serial in items:
+            changes[devname] = {
+                'ident': ident,
+                'mediasize': mediasize,
+                'serial': serial,
+            }
+        if changes:
+            self._update(changes=changes)
+
+    def invalidate(self, devnames):
+        """
+        Drop the entries of ``devnames``, e.g. on devd attach/detach
+        """
+        devnames = [d for d in devnames if d in self.entries]
+        if devnames:
+            self._update(remove=devnames)
+
+    def prune(self, present):
+        """
+        Drop the entries of every disk not in ``present``
+        """
+        present = set(present)
+        self.invalidate([d for d in self.entries if d not in present])
+
+    def probe(self, devnames, func):
+        """
+        Run ``func(devname)`` concurrently for every device in
+        ``devnames`` using a bounded pool of worker threads
+
+        Returns:
+            dict(devname) = func(devname)
+        """
+        devnames = list(devnames)
+        if not devnames:
+            return {}
+        if len(devnames) == 1:
+            return {devnames[0]: func(devnames[0])}
+        pool = ThreadPool(min(self.workers, len(devnames)))
+        try:
+            results = pool.map(func, devnames)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip(devnames, results))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2011 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+
+from collections import defaultdict
+
+
+class GeomTopology(object):
+    """
+    Indexed view of the GEOM tree as exported by kern.geom.confxml
+
+    The document is walked a single time and the relations the middleware
+    cares about (providers, geoms per class, partition uuids and labels)
+    are kept in dicts, so lookups do not need to scan the whole tree
+    through xpath for every disk.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        # provider id -> provider node
+        self._providers = {}
+        # provider id -> (class name, geom node)
+        self._provider_geom = {}
+        # (class name, geom name) -> geom node
+        self._geoms = {}
+        # class name -> [geom nodes], in document order
+        self._classes = defaultdict(list)
+        # partition rawuuid -> [PART geom names]
+        self._rawuuids = defaultdict(list)
+        # PART provider name -> provider node
+        self._parts = {}
+        # LABEL provider name -> LABEL geom node
+        self._labels = {}
+        self._build()
+
+    def _build(self):
+        for klass in self.doc.iterfind('class'):
+            cname = klass.findtext('name')
+            for geom in klass.iterfind('geom'):
+                gname = geom.findtext('name')
+                self._geoms.setdefault((cname, gname), geom)
+                self._classes[cname].append(geom)
+                for prov in geom.iterfind('provider'):
+                    pid = prov.get('id')
+                    pname = prov.findtext('name')
+                    self._providers[pid] = prov
+                    self._provider_geom[pid] = (cname, geom)
+                    if cname == 'PART':
+                        self._parts.setdefault(pname, prov)
+                        rawuuid = prov.findtext('config/rawuuid')
+                        if rawuuid:
+                            self._rawuuids[rawuuid].append(gname)
+                    elif cname == 'LABEL':
+                        self._labels.setdefault(pname, geom)
+
+    def geom(self, klass, name):
+        """
+        Get the geom node of class ``klass`` named ``name``, None otherwise
+        """
+        return self._geoms.get((klass, name))
+
+    def geoms(self, klass):
+        """
+        Get all geom nodes of a given class
+        """
+        return self._classes.get(klass, [])
+
+    def provider(self, pid):
+        """
+        Get the provider node for a given provider id
+        """
+        return self._providers.get(pid)
+
+    def provider_class(self, pid):
+        """
+        Get the class name of the geom owning a provider id
+        """
+        entry = self._provider_geom.get(pid)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def provider_geom_name(self, pid):
+        """
+        Get the name of the geom owning a provider id
+        """
+        entry = self._provider_geom.get(pid)
+        if entry is None:
+            return None
+        return entry[1].findtext('name')
+
+    def consumer_refs(self, geom):
+        """
+        Get the provider ids consumed by a geom node
+        """
+        return [
+            prov.get('ref')
+            for prov in geom.iterfind('consumer/provider')
+        ]
+
+    def label_geom(self, label):
+        """
+        Get the LABEL geom node providing the label ``label``
+        e.g. gptid/<uuid>, ufs/<name>
+        """
+        return self._labels.get(label)
+
+    def geoms_by_rawuuid(self, rawuuid):
+        """
+        Get the names of the PART geoms holding a partition with ``rawuuid``
+        """
+        return self._rawuuids.get(rawuuid, [])
+
+    def part_rawuuid(self, name, parttype):
+        """
+        Get the rawuuid of the first partition of type ``parttype``
+        of a PART geom (disk) or of a partition itself named ``name``
+        """
+        geom = self.geom('PART', name)
+        if geom is not None:
+            provs = geom.iterfind('provider')
+        elif name in self._parts:
+            provs = [self._parts[name]]
+        else:
+            return None
+        for prov in provs:
+            if prov.findtext('config/type') == parttype:
+                return prov.findtext('config/rawuuid')
+        return None
+
+    def part_name(self, name, parttype):
+        """
+        Get the name of the first partition of type ``parttype``
+        in the PART geom named ``name``
+        """
+        geom = self.geom('PART', name)
+        if geom is None:
+            return None
+        for prov in geom.iterfind('provider'):
+            if prov.findtext('config/type') == parttype:
+                return prov.findtext('name')
+        return None
+
+    def disk_mediasize(self, name):
+        """
+        Get the media size of the DISK geom named ``name``
+        """
+        geom = self.geom('DISK', name)
+        if geom is None:
+            return None
+        return geom.findtext('provider/mediasize')
+
+    def disk_ident(self, name):
+        """
+        Get the GEOM ident (usually the serial) of the DISK geom named ``name``
+        """
+        geom = self.geom('DISK', name)
+        if geom is None:
+            return None
+        return geom.findtext('provider/config/ident')
+
+    def disk_lunid(self, name):
+        """
+        Get the LUN ID of the DISK geom named ``name``
+        """
+        geom = self.geom('DISK', name)
+        if geom is None:
+            return None
+        return geom.findtext('provider/config/lunid')
@@ -35,9 +35,12 @@ actions.
 """
 
 from collections import defaultdict, OrderedDict
+from multiprocessing.pool import ThreadPool
 from decimal import Decimal
 import base64
 from Crypto.Cipher import AES
+from Crypto.Hash import MD4
+import crypt
 import ctypes
 import errno
 import glob
@@ -87,6 +90,7 @@ cache.get_apps()
 from django.utils.translation import ugettext as _
 
 from freenasUI.common.acl import ACL_FLAGS_OS_WINDOWS, ACL_WINDOWS_FILE, ACL_MAC_FILE
+from freenasUI.common.confgen import file_digest
 from freenasUI.common.freenasacl import ACL
 from freenasUI.common.jail import Jls, Jexec
 from freenasUI.common.locks import mntlock
@@ -109,8 +113,10 @@ from freenasUI.common.system import (
 from freenasUI.common.warden import (Warden, WardenJail,
     WARDEN_TYPE_PLUGINJAIL, WARDEN_STATUS_RUNNING)
 from freenasUI.freeadmin.hook import HookMetaclass
-from freenasUI.middleware import zfs
+from freenasUI.middleware import servicequeue, zfs, zfscache
+from freenasUI.middleware.diskserial import DiskSerialCache
 from freenasUI.middleware.encryption import random_wipe
+from freenasUI.middleware.geom import GeomTopology
 from freenasUI.middleware.exceptions import MiddlewareError
 from freenasUI.middleware.multipath import Multipath
 import sysctl
@@ -179,6 +185,24 @@ class StartNotify(threading.Thread):
         os.close(fd)
 
 
+def _zfs_name_chunks(names, overhead=0, maxlen=32768):
+    """
+    Split ``names`` in lists whose comma-joined length stays under
+    ``maxlen``, to keep zfs(8) command lines bounded
+    """
+    chunk = []
+    length = overhead
+    for name in names:
+        if chunk and length + len(name) + 1 > maxlen:
+            yield chunk
+            chunk = []
+            length = overhead
+        chunk.append(name)
+        length += len(name) + 1
+    if chunk:
+        yield chunk
+
+
 class notifier:
 
     __metaclass__ = HookMetaclass
@@ -335,14 +359,44 @@ class notifier:
             f = getattr(self, '_destroy_' + what)
             f(objectid)
 
-    def start(self, what):
+    def _service_action(self, action, what):
+        """
+        Actually run ``action`` on service ``what``.
+        This is called by the service queue, use start/stop/restart/reload.
+        """
+        if action == 'reload':
+            try:
+                self._simplecmd("reload", what)
+            except:
+                self._service_action("restart", what)
+            return self.started(what)
+        sn = self._started_notify(action, what)
+        self._simplecmd(action, what)
+        return self.started(what, sn)
+
+    def _queue_service(self, action, what, wait, delay):
+        """
+        Submit ``action`` to the service queue, where it is merged with
+        pending requests for the same service.
+
+        If wait is True block until it ran and return whether the service
+        is running, otherwise return the ServiceRequest handle.
+        """
+        if delay is None:
+            delay = 0 if wait else servicequeue.DEBOUNCE
+        req = servicequeue.get_queue(_service_action).submit(
+            action, what, delay=delay
+        )
+        if wait:
+            return req.wait()
+        return req
+
+    def start(self, what, wait=True, delay=None):
         """ Start the service specified by "what".
 
         The helper will use method self._start_[what]() to start the service.
         If the method does not exist, it would fallback using service(8)."""
-        sn = self._started_notify("start", what)
-        self._simplecmd("start", what)
-        return self.started(what, sn)
+        return self._queue_service("start", what, wait, delay)
 
     def started(self, what, sn=None):
         """ Test if service specified by "what" has been started. """
@@ -352,35 +406,30 @@ class notifier:
         else:
             return self._started(what, sn)
 
-    def stop(self, what):
+    def stop(self, what, wait=True, delay=None):
         """ Stop the service specified by "what".
 
         The helper will use method self._stop_[what]() to stop the service.
         If the method does not exist, it would fallback using service(8)."""
-        sn = self._started_notify("stop", what)
-        self._simplecmd("stop", what)
-        return self.started(what, sn)
+        return self._queue_service("stop", what, wait, delay)
 
-    def restart(self, what):
+    def restart(self, what, wait=True, delay=None):
         """ Restart the service specified by "what".
 
         The helper will use method self._restart_[what]() to restart the service.
         If the method does not exist, it would fallback using service(8)."""
-        sn = self._started_notify("restart", what)
-        self._simplecmd("restart", what)
-        return self.started(what, sn)
+        return self._queue_service("restart", what, wait, delay)
 
-    def reload(self, what):
+    def reload(self, what, wait=True, delay=None):
         """ Reload the service specified by "what".
 
         The helper will use method self._reload_[what]() to reload the service.
         If the method does not exist, the helper will try self.restart of the
-        service instead."""
-        try:
-            self._simplecmd("reload", what)
-        except:
-            self.restart(what)
-        return self.started(what)
+        service instead.
+
+        Pass wait=False from code paths that may be called many times in a
+        row (e.g. bulk edits) to have the reloads coalesced."""
+        return self._queue_service("reload", what, wait, delay)
 
     def change(self, what):
         """ Notify the service specified by "what" about a change.
@@ -435,8 +484,12 @@ class notifier:
         self._system("/usr/sbin/service ctld forcestop")
 
     def _reload_iscsitarget(self):
+        # ix-ctld leaves ctl.conf untouched when nothing changed, ctld
+        # does not need to rescan its LUNs in that case
+        digest = file_digest('/etc/ctl.conf')
         self._system("/usr/sbin/service ix-ctld quietstart")
-        self._system("/usr/sbin/service ctld reload")
+        if digest is None or file_digest('/etc/ctl.conf') != digest:
+            self._system("/usr/sbin/service ctld reload")
 
     def _start_collectd(self):
         self._system("/usr/sbin/service ix-collectd quietstart")
@@ -446,6 +499,15 @@ class notifier:
         self._system("/usr/sbin/service ix-collectd quietstart")
         self._system("/usr/sbin/service collectd restart")
 
+    def _reload_collectd(self):
+        # collectd cannot reload its configuration, only restart it when
+        # the set of monitored mountpoints has actually changed
+        digest = file_digest('/usr/local/etc/collectd.conf')
+        self._system("/usr/sbin/service ix-collectd quietstart")
+        if digest is None or \
+                file_digest('/usr/local/etc/collectd.conf') != digest:
+            self._system("/usr/sbin/service collectd restart")
+
     def _start_sysctl(self):
         self._system("/usr/sbin/service sysctl start")
         self._system("/usr/sbin/service ix-sysctl quietstart")
@@ -1441,6 +1503,7 @@ class notifier:
 
         return vdevs
 
+    @zfscache.invalidates
     def __create_zfs_volume(self, volume, swapsize, groups, path=None, init_rand=False):
         """Internal procedure to create a ZFS volume identified by volume id"""
         z_name = str(volume.vol_name)
@@ -1534,6 +1597,7 @@ class notifier:
         swapsize = Advanced.objects.latest('id').adv_swapondrive
         return swapsize
 
+    @zfscache.invalidates
     def zfs_volume_attach_group(self, volume, group, encrypt=False):
         """Attach a disk group to a zfs volume"""
 
@@ -1575,6 +1639,7 @@ class notifier:
         # TODO: geli detach -l
         self._reload_disk()
 
+    @zfscache.invalidates
     def create_zfs_vol(self, name, size, props=None, sparse=False):
         """Internal procedure to create ZFS volume"""
         if sparse is True:
@@ -1591,6 +1656,7 @@ class notifier:
         zfs_error = zfsproc.wait()
         return zfs_error, zfs_err
 
+    @zfscache.invalidates
     def create_zfs_dataset(self, path, props=None, _restart_collectd=True):
         """Internal procedure to create ZFS volume"""
         options = " "
@@ -1609,14 +1675,14 @@ class notifier:
     def list_zfs_vols(self, volname, sort=None):
         """Return a dictionary that contains all ZFS volumes list"""
 
-        if sort is None:
-            sort = ''
-        else:
-            sort = '-s %s' % sort
-
-        zfsproc = self._pipeopen("/sbin/zfs list -p -H -o name,volsize,used,avail,refer,compression,compressratio %s -t volume -r '%s'" % (sort, str(volname),))
-        zfs_output, zfs_err = zfsproc.communicate()
-        zfs_output = zfs_output.split('\n')
+        args = [
+            "/sbin/zfs", "list", "-p", "-H",
+            "-o", "name,volsize,used,avail,refer,compression,compressratio",
+        ]
+        if sort:
+            args.extend(["-s", sort])
+        args.extend(["-t", "volume", "-r", str(volname)])
+        zfs_output = zfscache.zfs_command(args)[1].split('\n')
         retval = {}
         for line in zfs_output:
             if line == "":
@@ -1633,13 +1699,14 @@ class notifier:
         return retval
 
     def list_zfs_fsvols(self, system=False):
-        proc = self._pipeopen("/sbin/zfs list -H -o name -t volume,filesystem")
-        out, err = proc.communicate()
+        returncode, out = zfscache.zfs_command(
+            ["/sbin/zfs", "list", "-H", "-o", "name", "-t", "volume,filesystem"]
+        )
         out = out.split('\n')
         retval = OrderedDict()
         if system is False:
             systemdataset, volume, basename = self.system_dataset_settings()
-        if proc.returncode == 0:
+        if returncode == 0:
             for line in out:
                 if not line:
                     continue
@@ -1662,24 +1729,41 @@ class notifier:
                 return True
         return False
 
-    def repl_remote_snapshots(self, repl):
-        """
-        Get a list of snapshots in the remote side
-        """
+    def __repl_remote(self, repl):
         if repl.repl_remote.ssh_remote_dedicateduser_enabled:
             user = repl.repl_remote.ssh_remote_dedicateduser
         else:
             user = 'root'
-        proc = self._pipeopen('/usr/bin/ssh -i /data/ssh/replication -o ConnectTimeout=3 -p %s "%s"@"%s" "zfs list -Ht snapshot -o name"' % (
-            repl.repl_remote.ssh_remote_port,
-            user,
-            repl.repl_remote.ssh_remote_hostname,
-        ))
-        data = proc.communicate()[0]
-        if proc.returncode != 0:
-            return []
-        return data.strip('\n').split('\n')
+        return {
+            'hostname': repl.repl_remote.ssh_remote_hostname,
+            'port': repl.repl_remote.ssh_remote_port,
+            'user': user,
+        }
+
+    def repl_remote_snapshots(self, repl):
+        """
+        Get the set of snapshots in the remote side
+        """
+        return zfscache.remote_snapshots([self.__repl_remote(repl)])[0]
+
+    def repl_remote_snapshots_many(self, repls):
+        """
+        Get the set of snapshots in the remote side of every replication
 
+        Remote lists are cached and refreshed in the background, hosts
+        shared by several tasks are only queried once, all of them
+        concurrently.
+
+        Returns:
+            dict(repl) = frozenset of remote snapshot names
+        """
+        repls = list(repls)
+        names = zfscache.remote_snapshots(
+            [self.__repl_remote(repl) for repl in repls]
+        )
+        return dict(zip(repls, names))
+
+    @zfscache.invalidates
     def destroy_zfs_dataset(self, path, recursive=False):
         retval = None
         if '@' in path:
@@ -1722,6 +1806,114 @@ class notifier:
 
         return retval
 
+    def __snapshot_states(self, snapshots):
+        """
+        Get the freenas:state property of many snapshots, with a single
+        zfs get per batch of names.  Snapshots that do not exist are
+        left out.
+        DISCLAIMER: mntlock has to be acquired before this call
+        """
+        states = {}
+        for chunk in _zfs_name_chunks(snapshots):
+            proc = Popen(
+                ["/sbin/zfs", "get", "-H", "-o", "name,value",
+                 "freenas:state"] + chunk,
+                stdout=PIPE,
+                stderr=PIPE,
+                close_fds=True,
+            )
+            for line in proc.communicate()[0].split('\n'):
+                if '\t' in line:
+                    name, value = line.split('\t', 1)
+                    states[name] = value
+        return states
+
+    def __destroy_snapshots(self, dataset, names):
+        """
+        Destroy snapshots ``names`` of ``dataset`` through the
+        ``zfs destroy dataset@a,b,c`` syntax.  ZFS destroys the list
+        atomically, so when a batch fails its snapshots are retried one
+        by one to find out which of them could not be destroyed.
+        """
+        results = {}
+        for chunk in _zfs_name_chunks(names, len(dataset) + 1):
+            proc = Popen(
+                ["/sbin/zfs", "destroy", "%s@%s" % (dataset, ','.join(chunk))],
+                stdout=PIPE,
+                stderr=PIPE,
+                close_fds=True,
+            )
+            err = proc.communicate()[1]
+            if proc.returncode == 0:
+                for name in chunk:
+                    results['%s@%s' % (dataset, name)] = ''
+                continue
+            if len(chunk) == 1:
+                results['%s@%s' % (dataset, chunk[0])] = err
+                continue
+            for name in chunk:
+                results.update(self.__destroy_snapshots(dataset, [name]))
+        return results
+
+    @zfscache.invalidates
+    def destroy_zfs_snapshots(self, snapshots, workers=4):
+        """
+        Destroy many snapshots at once
+
+        Snapshots of the same dataset are destroyed together, datasets of
+        different pools concurrently with at most ``workers`` pools at a
+        time.  Snapshots held by the replication system are kept.
+
+        Returns:
+            OrderedDict(snapshot) = error message, empty if destroyed
+        """
+        retval = OrderedDict()
+        for snapshot in snapshots:
+            if '@' not in snapshot:
+                retval[snapshot] = 'Invalid snapshot.'
+            else:
+                retval[snapshot] = None
+
+        candidates = [s for s, err in retval.items() if err is None]
+        try:
+            with mntlock(blocking=False):
+                states = self.__snapshot_states(candidates)
+        except IOError:
+            for snapshot in candidates:
+                retval[snapshot] = 'Try again later.'
+            return retval
+
+        pools = OrderedDict()
+        for snapshot in candidates:
+            state = states.get(snapshot)
+            if state is None:
+                retval[snapshot] = 'Snapshot does not exist.'
+                continue
+            if state != '-' and state != 'NEW':
+                retval[snapshot] = 'Held by replication system.'
+                continue
+            dataset, name = snapshot.split('@', 1)
+            datasets = pools.setdefault(dataset.split('/', 1)[0], OrderedDict())
+            datasets.setdefault(dataset, []).append(name)
+
+        def destroy_pool(datasets):
+            results = {}
+            for dataset, names in datasets.items():
+                results.update(self.__destroy_snapshots(dataset, names))
+            return results
+
+        if pools:
+            pool = ThreadPool(min(workers, len(pools)))
+            try:
+                for results in pool.map(destroy_pool, pools.values()):
+                    retval.update(results)
+            finally:
+                pool.close()
+                pool.join()
+
+        return retval
+
+    @zfscache.invalidates
     def destroy_zfs_vol(self, name):
         mp = self.__get_mountpath(name, 'ZFS')
         if self.contains_jail_root(mp):
@@ -1730,6 +1922,7 @@ class notifier:
         retval = zfsproc.communicate()[1]
         return retval
 
+    @zfscache.invalidates
     def __destroy_zfs_volume(self, volume):
         """Internal procedure to destroy a ZFS volume identified by volume id"""
         vol_name = str(volume.vol_name)
@@ -1781,6 +1974,7 @@ class notifier:
         assert volume.vol_fstype == 'ZFS'
         self.__create_zfs_volume(volume, swapsize, kwargs.pop('groups', False), kwargs.pop('path', None), init_rand=kwargs.pop('init_rand', False))
 
+    @zfscache.invalidates
     def zfs_replace_disk(self, volume, from_label, to_disk, passphrase=None):
         """Replace disk in zfs called `from_label` to `to_disk`"""
         from freenasUI.storage.models import Disk, EncryptedDisk
@@ -1878,6 +2072,7 @@ class notifier:
 
         return ret
 
+    @zfscache.invalidates
     def zfs_offline_disk(self, volume, label):
         from freenasUI.storage.models import EncryptedDisk
 
@@ -1904,6 +2099,7 @@ class notifier:
                 encrypted_provider=label[:-4]
             ).delete()
 
+    @zfscache.invalidates
     def zfs_detach_disk(self, volume, label):
         """Detach a disk from zpool
            (more technically speaking, a replaced disk.  The replacement actually
@@ -1930,6 +2126,7 @@ class notifier:
             self.__gpt_unlabeldisk(from_disk)
         return ret
 
+    @zfscache.invalidates
     def zfs_remove_disk(self, volume, label):
         """
         Remove a disk from zpool
@@ -2093,6 +2290,55 @@ class notifier:
         smbpasswd.communicate("%s\n%s\n" % (password, password))
         return smbpasswd.returncode == 0
 
+    def __homedir_create(self, homedir, homedir_mode):
+        """
+        Create ``homedir`` for a new user.
+
+        Returns:
+            True if the directory was created, False if it already existed
+            or no home directory is wanted (/nonexistent).
+        """
+        # Is this a new directory or not? Let's not nuke existing directories,
+        # e.g. /, /root, /mnt/tank/my-dataset, etc ;).
+        new_homedir = False
+
+        if homedir != '/nonexistent':
+            # Kept separate for cleanliness between formulating what to do
+            # and executing the formulated plan.
+
+            # You're probably wondering why pw -m doesn't suffice. Here's why:
+            # 1. pw(8) doesn't create home directories if the base directory
+            #    doesn't exist; example: if /mnt/tank/homes doesn't exist and
+            #    the user specified /mnt/tank/homes/user, then the home
+            #    directory won't be created.
+            # 2. pw(8) allows me to specify /mnt/md_size (a regular file) for
+            #    the home directory.
+            # 3. If some other random path creation error occurs, it's already
+            #    too late to roll back the user create.
+            try:
+                os.makedirs(homedir, mode=homedir_mode)
+                if os.stat(homedir).st_dev == os.stat('/mnt').st_dev:
+                    # HACK: ensure the user doesn't put their homedir under
+                    # /mnt
+                    # XXX: fix the GUI code and elsewhere to enforce this, then
+                    # remove the hack.
+                    raise MiddlewareError('Path for the home directory (%s) '
+                                          'must be under a volume or dataset'
+                                          % (homedir, ))
+            except OSError as oe:
+                if oe.errno == errno.EEXIST:
+                    if not os.path.isdir(homedir):
+                        raise MiddlewareError('Path for home directory already '
+                                              'exists and is not a directory')
+                else:
+                    raise MiddlewareError('Failed to create the home directory '
+                                          '(%s) for user: %s'
+                                          % (homedir, str(oe)))
+            else:
+                new_homedir = True
+
+        return new_homedir
+
     def __issue_pwdchange(self, username, command, password):
         self.__pw_with_password(command, password)
         self.__smbpasswd(username, password)
@@ -2171,44 +2417,7 @@ class notifier:
             # Populate the home directory with files from /usr/share/skel .
             command += ' -m'
 
-        # Is this a new directory or not? Let's not nuke existing directories,
-        # e.g. /, /root, /mnt/tank/my-dataset, etc ;).
-        new_homedir = False
-
-        if homedir != '/nonexistent':
-            # Kept separate for cleanliness between formulating what to do
-            # and executing the formulated plan.
-
-            # You're probably wondering why pw -m doesn't suffice. Here's why:
-            # 1. pw(8) doesn't create home directories if the base directory
-            #    doesn't exist; example: if /mnt/tank/homes doesn't exist and
-            #    the user specified /mnt/tank/homes/user, then the home
-            #    directory won't be created.
-            # 2. pw(8) allows me to specify /mnt/md_size (a regular file) for
-            #    the home directory.
-            # 3. If some other random path creation error occurs, it's already
-            #    too late to roll back the user create.
-            try:
-                os.makedirs(homedir, mode=homedir_mode)
-                if os.stat(homedir).st_dev == os.stat('/mnt').st_dev:
-                    # HACK: ensure the user doesn't put their homedir under
-                    # /mnt
-                    # XXX: fix the GUI code and elsewhere to enforce this, then
-                    # remove the hack.
-                    raise MiddlewareError('Path for the home directory (%s) '
-                                          'must be under a volume or dataset'
-                                          % (homedir, ))
-            except OSError as oe:
-                if oe.errno == errno.EEXIST:
-                    if not os.path.isdir(homedir):
-                        raise MiddlewareError('Path for home directory already '
-                                              'exists and is not a directory')
-                else:
-                    raise MiddlewareError('Failed to create the home directory '
-                                          '(%s) for user: %s'
-                                          % (homedir, str(oe)))
-            else:
-                new_homedir = True
+        new_homedir = self.__homedir_create(homedir, homedir_mode)
 
         try:
             self.__issue_pwdchange(username, command, password)
@@ -2233,6 +2442,111 @@ class notifier:
         user = self.___getpwnam(username)
         return (user.pw_uid, user.pw_gid, user.pw_passwd, smb_hash)
 
+    def user_hash_many(self, users):
+        """Compute the password hashes of many users at once, for bulk imports.
+
+        Unlike user_create this does not call pw(8) or smbpasswd for every
+        user: hashes are computed in process.  The caller is expected to
+        save the users to the database, create their home directories with
+        user_homedir_create_many(), then regenerate the passwd database once
+        (reload("user")) followed by user_import_smbhashes().
+
+        users - list of dicts with the user_create() keyword arguments;
+                uid is required.
+
+        Returns:
+            A list of (unixhash, smbhash) tuples, in order.
+        """
+        dc = domaincontroller_enabled()
+        results = []
+        for user in users:
+            if user.get('password_disabled', False):
+                unixhash = '*'
+                smbhash = '*'
+            else:
+                password = user['password']
+                unixhash = crypt.crypt(password, '$6$%s' % (
+                    base64.b64encode(os.urandom(12), './'),
+                ))
+                smbhash = '*' if dc else self.__smbhash(
+                    user['username'], user['uid'], password
+                )
+            results.append((unixhash, smbhash))
+        return results
+
+    def user_homedir_create_many(self, users):
+        """Create and populate the home directories of many users at once,
+        from /usr/share/skel the way pw -m does.
+
+        users - list of dicts with the user_create() keyword arguments;
+                uid and gid are required.
+
+        Raises:
+            MiddlewareError - a home directory could not be created, in which
+                              case home directories already created by this
+                              call are removed.
+        """
+        created = []
+        try:
+            for user in users:
+                homedir = user.get('homedir', '/mnt')
+                if self.__homedir_create(
+                    homedir, user.get('homedir_mode', 0o755)
+                ):
+                    created.append(homedir)
+                if homedir != '/nonexistent':
+                    self.__homedir_populate(homedir, user['uid'], user['gid'])
+        except:
+            for homedir in created:
+                shutil.rmtree(homedir, ignore_errors=True)
+            raise
+
+    def __homedir_populate(self, homedir, uid, gid):
+        """Copy /usr/share/skel into homedir the way pw -m does."""
+        skel = '/usr/share/skel'
+        for name in os.listdir(skel):
+            dst = os.path.join(
+                homedir, name[3:] if name.startswith('dot.') else name
+            )
+            if os.path.exists(dst):
+                continue
+            shutil.copy(os.path.join(skel, name), dst)
+            os.chown(dst, uid, gid)
+        os.chown(homedir, uid, gid)
+
+    def __smbhash(self, username, uid, password):
+        """
+        Build the smbpasswd(5) line for ``username'', the same format
+        pdbedit -w prints and generate_smb4_conf imports.
+        """
+        nthash = MD4.new(
+            password.decode('utf-8').encode('utf-16-le')
+        ).hexdigest().upper()
+        return '%s:%d:%s:%s:[U          ]:LCT-%08X:' % (
+            username, uid, 'X' * 32, nthash, int(time.time()),
+        )
+
+    def user_import_smbhashes(self, smbhashes):
+        """
+        Import smbpasswd(5) lines into the samba passdb with a single
+        pdbedit -i run. Users have to exist in the passwd database.
+        """
+        smbhashes = [h for h in smbhashes if h and h != '*']
+        if not smbhashes or domaincontroller_enabled():
+            return True
+        with tempfile.NamedTemporaryFile(prefix='smbpasswd.') as f:
+            os.chmod(f.name, 0o600)
+            f.write('\n'.join(smbhashes) + '\n')
+            f.flush()
+            proc = self._pipeopen(
+                "/usr/local/bin/pdbedit -d 0 -i smbpasswd:%s" % f.name
+            )
+            err = proc.communicate()[1]
+        if proc.returncode != 0:
+            log.warn("Failed to import samba users: %s", err)
+            return False
+        return True
+
     def group_create(self, name):
         command = '/usr/sbin/pw group add "%s"' % (
             name,
@@ -3297,9 +3611,11 @@ class notifier:
     def get_volume_status(self, name, fs):
         status = 'UNKNOWN'
         if fs == 'ZFS':
-            p1 = self._pipeopen('zpool list -H -o health %s' % str(name))
-            if p1.wait() == 0:
-                status = p1.communicate()[0].strip('\n')
+            returncode, output = zfscache.zfs_command(
+                ["/sbin/zpool", "list", "-H", "-o", "health", str(name)]
+            )
+            if returncode == 0:
+                status = output.strip('\n')
         elif fs == 'UFS':
 
             provider = self.get_label_consumer('ufs', name)
@@ -3506,6 +3822,7 @@ class notifier:
 
         return volumes
 
+    @zfscache.invalidates
     def zfs_import(self, name, id=None):
         if id is not None:
             imp = self._pipeopen('zpool import -f -R /mnt %s' % id)
@@ -3536,6 +3853,7 @@ class notifier:
             for ed in volume.encrypteddisk_set.all():
                 self.geli_detach(ed.encrypted_provider)
 
+    @zfscache.invalidates
     def volume_detach(self, volume):
         """Detach a volume from the system
 
@@ -3643,6 +3961,7 @@ class notifier:
                 raise MiddlewareError('Failed to remove mountpoint %s: %s'
                                       % (path, str(ose), ))
 
+    @zfscache.invalidates
     def zfs_scrub(self, name, stop=False):
         if stop:
             imp = self._pipeopen('zpool scrub -s %s' % str(name))
@@ -3657,34 +3976,41 @@ class notifier:
         from freenasUI.storage.models import Volume
         fsinfo = dict()
 
-        if sort is None:
-            sort = ''
-        else:
-            sort = '-s %s' % sort
-
         if system is False:
             systemdataset, volume, basename = self.system_dataset_settings()
 
-        zfsproc = self._pipeopen("/sbin/zfs list -t volume -o name %s -H" % sort)
-        zvols = filter(lambda y: y != '', zfsproc.communicate()[0].split('\n'))
+        args = ["/sbin/zfs", "list", "-t", "volume", "-o", "name", "-H"]
+        if sort:
+            args.extend(["-s", sort])
+        zvols = filter(
+            lambda y: y != '',
+            zfscache.zfs_command(args)[1].split('\n'),
+        )
 
         volnames = [
             o.vol_name for o in Volume.objects.filter(vol_fstype='ZFS')
         ]
 
-        fieldsflag = '-o name,used,available,referenced,mountpoint,freenas:vmsynced'
+        zvols = set(zvols)
+        volnames = set(volnames)
+
+        args = [
+            "/sbin/zfs", "list", "-p", "-t", "snapshot", "-H",
+            "-S", "creation",
+            "-o", "name,used,available,referenced,mountpoint,"
+            "freenas:vmsynced,creation",
+        ]
         if path:
-            zfsproc = self._pipeopen("/sbin/zfs list -p -r -t snapshot %s -H -S creation '%s'" % (fieldsflag, path))
-        else:
-            zfsproc = self._pipeopen("/sbin/zfs list -p -t snapshot -H -S creation %s" % (fieldsflag))
-        lines = zfsproc.communicate()[0].split('\n')
-        for line in lines:
+            args.extend(["-r", path])
+        for line in zfscache.zfs_lines(args):
+            line = line.rstrip('\n')
             if line != '':
                 _list = line.split('\t')
                 snapname = _list[0]
                 used = _list[1]
                 refer = _list[3]
                 vmsynced = _list[5]
+                creation = int(_list[6]) if _list[6].isdigit() else None
                 fs, name = snapname.split('@')
 
                 if system is False and basename:
@@ -3700,21 +4026,9 @@ class notifier:
                 except:
                     snaplist = []
                     mostrecent = True
-                replication = None
-                if replications:
-                    for repl, snaps in replications.iteritems():
-                        if fs != repl.repl_filesystem:
-                            break
-                        remotename = '%s@%s' % (
-                            repl.repl_zfs,
-                            name,
-                        )
-                        if remotename in snaps:
-                            replication = 'OK'
-                            # TODO: Multiple replication tasks
-                            break
 
-                snaplist.insert(0,
+                # Listed newest first, reversed once done
+                snaplist.append(
                     zfs.Snapshot(
                         name=name,
                         filesystem=fs,
@@ -3722,12 +4036,55 @@ class notifier:
                         refer=refer,
                         mostrecent=mostrecent,
                         parent_type='filesystem' if fs not in zvols else 'volume',
-                        replication=replication,
-                        vmsynced=(vmsynced == 'Y')
+                        vmsynced=(vmsynced == 'Y'),
+                        creation=creation,
                     ))
                 fsinfo[fs] = snaplist
+
+        for snaplist in fsinfo.values():
+            snaplist.reverse()
+            if replications:
+                self.zfs_snapshot_replication(snaplist, replications)
         return fsinfo
 
+    def zfs_snapshot_replication(self, snapshots, replications):
+        """
+        Set the replication status of ``snapshots``
+
+        ``replications`` maps each Replication to the snapshot names
+        found on its remote side
+        """
+        byfs = defaultdict(list)
+        for repl, snaps in replications.iteritems():
+            if not isinstance(snaps, (set, frozenset)):
+                snaps = set(snaps)
+            byfs[repl.repl_filesystem].append((repl.repl_zfs, snaps))
+
+        for snap in snapshots:
+            snap.replication = None
+            for remotefs, snaps in byfs.get(snap.filesystem, ()):
+                if '%s@%s' % (remotefs, snap.name) in snaps:
+                    snap.replication = 'OK'
+                    # TODO: Multiple replication tasks
+                    break
+
+    def zfs_snapshot_store(self, maxage=zfscache.MAXAGE):
+        """
+        Get a SnapshotStore of every snapshot
+
+        The store is reused for ``maxage`` seconds within the process
+        unless the zfs state has been changed through the middleware.
+        Replication status is not set, see zfs_snapshot_replication.
+        """
+        def build():
+            snapshots = []
+            fsinfo = self.zfs_snapshot_list()
+            for fs in sorted(fsinfo):
+                snapshots.extend(fsinfo[fs])
+            return zfs.SnapshotStore(snapshots)
+        return zfs.SnapshotStore.cached(build, maxage)
+
+    @zfscache.invalidates
     def zfs_mksnap(self, dataset, name, recursive=False, vmsnaps_count=0):
         if vmsnaps_count > 0:
             vmflag = '-o freenas:vmsynced=Y '
@@ -3742,11 +4099,13 @@ class notifier:
             raise MiddlewareError("Snapshot could not be taken: %s" % err)
         return True
 
+    @zfscache.invalidates
     def zfs_clonesnap(self, snapshot, dataset):
         zfsproc = self._pipeopen("zfs clone '%s' '%s'" % (snapshot, dataset))
         retval = zfsproc.communicate()[1]
         return retval
 
+    @zfscache.invalidates
     def rollback_zfs_snapshot(self, snapshot):
         zfsproc = self._pipeopen("zfs rollback '%s'" % (snapshot))
         retval = zfsproc.communicate()[1]
@@ -3795,13 +4154,15 @@ class notifier:
         if zfstype is None:
             zfstype = 'filesystem,volume'
 
-        zfsproc = self._pipeopen("/sbin/zfs get %s -H -o name,property,value,source -t %s %s %s" % (
-            '-r' if recursive else '',
-            zfstype,
-            props,
-            "'%s'" % str(name) if name else '',
-        ))
-        zfs_output = zfsproc.communicate()[0]
+        args = ["/sbin/zfs", "get"]
+        if recursive:
+            args.append("-r")
+        args.extend([
+            "-H", "-o", "name,property,value,source", "-t", zfstype, props,
+        ])
+        if name:
+            args.append(str(name))
+        zfs_output = zfscache.zfs_command(args)[1]
         retval = {}
         for line in zfs_output.split('\n'):
             if not line:
@@ -3822,6 +4183,7 @@ class notifier:
                 dval[data[1]] = (data[2], data[2], data[3])
         return retval
 
+    @zfscache.invalidates
     def zfs_set_option(self, name, item, value, recursive=False):
         """
         Set a ZFS attribute using zfs set
@@ -3843,6 +4205,7 @@ class notifier:
             return True, None
         return False, err
 
+    @zfscache.invalidates
     def zfs_inherit_option(self, name, item, recursive=False):
         """
         Inherit a ZFS attribute using zfs inherit
@@ -3864,6 +4227,7 @@ class notifier:
             return True, None
         return False, err
 
+    @zfscache.invalidates
     def zfs_dataset_release_snapshots(self, name, recursive=False):
         name = str(name)
         retval = None
@@ -3887,6 +4251,7 @@ class notifier:
         return retval
 
     # Reactivate replication on all snapshots
+    @zfscache.invalidates
     def zfs_dataset_reset_replicated_snapshots(self, name, recursive=False):
         name = str(name)
         retval = None
@@ -4060,8 +4425,10 @@ class notifier:
 
     def __init__(self):
         self.__confxml = None
+        self.__geomtopology = None
         self.__camcontrol = None
         self.__diskserial = {}
+        self.__diskserialcache = DiskSerialCache()
         self.__twcli = {}
 
     def __del__(self):
@@ -4072,6 +4439,17 @@ class notifier:
             self.__confxml = etree.fromstring(self.sysctl('kern.geom.confxml'))
         return self.__confxml
 
+    def _geom_topology(self):
+        """
+        Indexed GEOM topology of the current confxml
+
+        It is rebuilt whenever the confxml cache has been invalidated
+        """
+        doc = self._geom_confxml()
+        if self.__geomtopology is None or self.__geomtopology.doc is not doc:
+            self.__geomtopology = GeomTopology(doc)
+        return self.__geomtopology
+
     def __get_twcli(self, controller):
         if controller in self.__twcli:
             return self.__twcli[controller]
@@ -4090,7 +4468,66 @@ class notifier:
     def serial_from_device(self, devname):
         if devname in self.__diskserial:
             return self.__diskserial.get(devname)
+        return self.serials_from_devices([devname]).get(devname)
+
+    def serials_from_devices(self, devnames):
+        """
+        Get the serial of many disks at once
+
+        Serials are looked up in the persistent cache first, checked
+        against the GEOM ident and mediasize of the disk. The remaining
+        disks are probed concurrently.
+
+        Returns:
+            dict(devname) = serial
+        """
+        topology = self._geom_topology()
+        serials = {}
+        missing = []
+        for devname in devnames:
+            if devname in self.__diskserial:
+                serials[devname] = self.__diskserial[devname]
+                continue
+            try:
+                serials[devname] = self.__diskserialcache.get(
+                    devname,
+                    topology.disk_ident(devname),
+                    topology.disk_mediasize(devname),
+                )
+            except KeyError:
+                missing.append(devname)
+
+        if missing:
+            # Gather controllers info before the workers need it
+            self._camcontrol_list()
+            probed = self.__diskserialcache.probe(
+                missing, self.__probe_serial
+            )
+            # Disks without a serial are not persisted, it might have
+            # been a transient failure
+            self.__diskserialcache.set_many([
+                (
+                    devname,
+                    topology.disk_ident(devname),
+                    topology.disk_mediasize(devname),
+                    serial,
+                )
+                for devname, serial in probed.items() if serial
+            ])
+            serials.update(probed)
+
+        self.__diskserial.update(serials)
+        return serials
+
+    def invalidate_serials(self, devnames):
+        """
+        Forget the known serial of ``devnames``, e.g. on disk attach
+        """
+        for devname in devnames:
+            self.__diskserial.pop(devname, None)
+        self.__diskserialcache.invalidate(devnames)
 
+    def __probe_serial(self, devname):
         args = ["/dev/%s" % devname]
         camcontrol = self._camcontrol_list()
         info = camcontrol.get(devname)
@@ -4136,9 +4573,7 @@ class notifier:
         output = p1.communicate()[0]
         search = re.search(r'Serial Number:\s+(?P<serial>.+)', output, re.I)
         if search:
-            serial = search.group("serial")
-            self.__diskserial[devname] = serial
-            return serial
+            return search.group("serial")
         return None
 
     def label_to_disk(self, name):
@@ -4146,46 +4581,46 @@ class notifier:
         Given a label go through the geom tree to find out the disk name
         label = a geom label or a disk partition
         """
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
         # try to find the provider from GEOM_LABEL
-        search = doc.xpath("//class[name = 'LABEL']//provider[name = '%s']/../consumer/provider/@ref" % name)
-        if len(search) > 0:
-            provider = search[0]
-        else:
+        geom = topology.label_geom(name)
+        if geom is None:
             # the label does not exist, try to find it in GEOM DEV
-            search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']//provider/@ref" % name)
-            if len(search) > 0:
-                provider = search[0]
-            else:
+            geom = topology.geom('DEV', name)
+            if geom is None:
                 return None
-        search = doc.xpath("//provider[@id = '%s']/../name" % provider)
-        disk = search[0].text
-        if search[0].getparent().getparent().xpath("./name")[0].text in ('ELI', ):
+        refs = topology.consumer_refs(geom)
+        if not refs:
+            return None
+        provider = refs[0]
+        disk = topology.provider_geom_name(provider)
+        if disk is None:
+            return None
+        if topology.provider_class(provider) in ('ELI', ):
             return self.label_to_disk(disk.replace(".eli", ""))
         return disk
 
     def device_to_identifier(self, name):
         name = str(name)
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
         serial = self.serial_from_device(name)
         if serial:
             return "{serial}%s" % serial
 
-        search = doc.xpath("//class[name = 'PART']/..//*[name = '%s']//config[type = 'freebsd-zfs']/rawuuid" % name)
-        if len(search) > 0:
-            return "{uuid}%s" % search[0].text
-        search = doc.xpath("//class[name = 'PART']/geom/..//*[name = '%s']//config[type = 'freebsd-ufs']/rawuuid" % name)
-        if len(search) > 0:
-            return "{uuid}%s" % search[0].text
+        for parttype in ('freebsd-zfs', 'freebsd-ufs'):
+            rawuuid = topology.part_rawuuid(name, parttype)
+            if rawuuid:
+                return "{uuid}%s" % rawuuid
 
-        search = doc.xpath("//class[name = 'LABEL']/geom[name = '%s']/provider/name" % name)
-        if len(search) > 0:
-            return "{label}%s" % search[0].text
+        geom = topology.geom('LABEL', name)
+        if geom is not None:
+            label = geom.findtext('provider/name')
+            if label:
+                return "{label}%s" % label
 
-        search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']" % name)
-        if len(search) > 0:
+        if topology.geom('DEV', name) is not None:
             return "{devicename}%s" % name
 
         return ''
@@ -4195,7 +4630,7 @@ class notifier:
         if not ident:
             return None
 
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
         search = re.search(r'\{(?P<type>.+?)\}(?P<value>.+)', ident)
         if not search:
@@ -4205,29 +4640,27 @@ class notifier:
         value = search.group("value")
 
         if tp == 'uuid':
-            search = doc.xpath("//class[name = 'PART']/geom//config[rawuuid = '%s']/../../name" % value)
-            if len(search) > 0:
-                for entry in search:
-                    if not entry.text.startswith('label'):
-                        return entry.text
+            for geomname in topology.geoms_by_rawuuid(value):
+                if not geomname.startswith('label'):
+                    return geomname
             return None
 
         elif tp == 'label':
-            search = doc.xpath("//class[name = 'LABEL']/geom//provider[name = '%s']/../name" % value)
-            if len(search) > 0:
-                return search[0].text
+            geom = topology.label_geom(value)
+            if geom is not None:
+                return geom.findtext('name')
             return None
 
         elif tp == 'serial':
-            for devname in self.__get_disks():
-                serial = self.serial_from_device(devname)
-                if serial == value:
+            disks = self.__get_disks()
+            serials = self.serials_from_devices(disks)
+            for devname in disks:
+                if serials.get(devname) == value:
                     return devname
             return None
 
         elif tp == 'devicename':
-            search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']" % value)
-            if len(search) > 0:
+            if topology.geom('DEV', value) is not None:
                 return value
             return None
         else:
@@ -4238,13 +4671,10 @@ class notifier:
         Given a partition a type and a disk name (adaX)
         get the first partition that matches the type
         """
-        doc = self._geom_confxml()
         # TODO get from MBR as well?
-        search = doc.xpath("//class[name = 'PART']/geom[name = '%s']//config[type = 'freebsd-%s']/../name" % (device, name))
-        if len(search) > 0:
-            return search[0].text
-        else:
-            return ''
+        return self._geom_topology().part_name(
+            device, 'freebsd-%s' % name
+        ) or ''
 
     def get_allswapdev(self):
         from freenasUI.storage.models import Volume, Disk
@@ -4273,12 +4703,14 @@ class notifier:
         Returns:
             The provider xmlnode if found, None otherwise
         """
-        doc = self._geom_confxml()
-        xpath = doc.xpath("//class[name = 'LABEL']//provider[name = '%s']/../consumer/provider/@ref" % "%s/%s" % (geom, name))
-        if not xpath:
+        topology = self._geom_topology()
+        label = topology.label_geom("%s/%s" % (geom, name))
+        if label is None:
+            return None
+        refs = topology.consumer_refs(label)
+        if not refs:
             return None
-        providerid = xpath[0]
-        provider = doc.xpath("//provider[@id = '%s']" % providerid)[0]
+        provider = topology.provider(refs[0])
 
         class_name = provider.xpath("../../name")[0].text
 
@@ -4286,7 +4718,7 @@ class notifier:
         # So we need to recurse one more time
         if class_name == 'PART':
             providerid = provider.xpath("../consumer/provider/@ref")[0]
-            newprovider = doc.xpath("//provider[@id = '%s']" % providerid)[0]
+            newprovider = topology.provider(providerid)
             class_name = newprovider.xpath("../../name")[0].text
             # if this PART is really backed up by softraid the hypothesis was correct
             if class_name in ('STRIPE', 'MIRROR', 'RAID3'):
@@ -4300,10 +4732,9 @@ class notifier:
         if geomname in ('DISK', 'PART'):
             disks.append(provider.xpath("../name")[0].text)
         elif geomname in ('STRIPE', 'MIRROR', 'RAID3'):
-            doc = self._geom_confxml()
+            topology = self._geom_topology()
             for prov in provider.xpath("../consumer/provider/@ref"):
-                prov2 = doc.xpath("//provider[@id = '%s']" % prov)[0]
-                disks.append(prov2.xpath("../name")[0].text)
+                disks.append(topology.provider_geom_name(prov))
         else:
             # TODO log, could not get disks
             pass
@@ -4311,8 +4742,7 @@ class notifier:
 
     def zpool_parse(self, name):
         doc = self._geom_confxml()
-        p1 = self._pipeopen("zpool status %s" % name)
-        res = p1.communicate()[0]
+        res = zfscache.zfs_command(["/sbin/zpool", "status", name])[1]
         parse = zfs.parse_status(name, doc, res)
         return parse
 
@@ -4333,6 +4763,7 @@ class notifier:
         except:
             return res
 
+    @zfscache.invalidates
     def zpool_upgrade(self, name):
         p1 = self._pipeopen("zpool upgrade %s" % name)
         res = p1.communicate()[0]
@@ -4407,7 +4838,7 @@ class notifier:
         if devname.find("/") != -1:
             return
 
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         disks = self.__get_disks()
         self.__diskserial.clear()
         self.__camcontrol = None
@@ -4433,9 +4864,9 @@ class notifier:
         if reg:
             disk.disk_subsystem = reg.group(1)
             disk.disk_number = int(reg.group(2))
-        mediasize = doc.xpath("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % devname)
+        mediasize = topology.disk_mediasize(devname)
         if mediasize:
-            disk.disk_size = mediasize[0].text
+            disk.disk_size = mediasize
         disk.save()
 
     def sync_disk_extra(self, disk, add=False):
@@ -4444,11 +4875,15 @@ class notifier:
     def sync_disks(self):
         from freenasUI.storage.models import Disk
 
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         disks = self.__get_disks()
         self.__diskserial.clear()
         self.__camcontrol = None
 
+        # Detached disks no longer need their serial cached
+        self.__diskserialcache.prune(self.sysctl('kern.disks').split())
+        self.serials_from_devices(disks)
+
         in_disks = {}
         serials = []
         for disk in Disk.objects.order_by('disk_enabled'):
@@ -4473,9 +4908,9 @@ class notifier:
             if disk.disk_serial:
                 serials.append(disk.disk_serial)
 
-            mediasize = doc.xpath("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % dskname)
+            mediasize = topology.disk_mediasize(dskname)
             if mediasize:
-                disk.disk_size = mediasize[0].text
+                disk.disk_size = mediasize
 
             self.sync_disk_extra(disk, add=False)
 
@@ -4496,9 +4931,9 @@ class notifier:
                 d.disk_name = disk
                 d.disk_identifier = self.device_to_identifier(disk)
                 d.disk_serial = self.serial_from_device(disk) or ''
-                mediasize = doc.xpath("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % disk)
+                mediasize = topology.disk_mediasize(disk)
                 if mediasize:
-                    d.disk_size = mediasize[0].text
+                    d.disk_size = mediasize
                 if d.disk_serial:
                     if d.disk_serial in serials:
                         # Probably dealing with multipath here, do not add another
@@ -4624,13 +5059,12 @@ class notifier:
         """
         from freenasUI.storage.models import Volume, Disk
 
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
         mp_disks = []
-        for geom in doc.xpath("//class[name = 'MULTIPATH']/geom"):
-            for provref in geom.xpath("./consumer/provider/@ref"):
-                prov = doc.xpath("//provider[@id = '%s']" % provref)[0]
-                class_name = prov.xpath("../../name")[0].text
+        for geom in topology.geoms('MULTIPATH'):
+            for provref in topology.consumer_refs(geom):
+                class_name = topology.provider_class(provref)
                 # For now just DISK is allowed
                 if class_name != 'DISK':
                     log.warn(
@@ -4639,7 +5073,7 @@ class notifier:
                         class_name
                     )
                     continue
-                disk = prov.xpath("../name")[0].text
+                disk = topology.provider_geom_name(provref)
                 mp_disks.append(disk)
 
         reserved = self._find_root_devs()
@@ -4648,24 +5082,27 @@ class notifier:
         for vol in Volume.objects.all():
             reserved.extend(vol.get_disks())
 
-        serials = defaultdict(list)
-        active_active = []
         RE_CD = re.compile('^cd[0-9]')
-        for geom in doc.xpath("//class[name = 'DISK']/geom"):
-            name = geom.xpath("./name")[0].text
+        candidates = []
+        for geom in topology.geoms('DISK'):
+            name = geom.findtext('name')
             if RE_CD.match(name) or name in reserved or name in mp_disks:
                 continue
+            candidates.append((name, geom))
+
+        disk_serials = self.serials_from_devices([c[0] for c in candidates])
+
+        serials = defaultdict(list)
+        active_active = []
+        for name, geom in candidates:
             if self._multipath_is_active(name, geom):
                 active_active.append(name)
-            serial = self.serial_from_device(name) or ''
-            try:
-                lunid = geom.xpath("./provider/config/lunid")[0].text
-            except:
-                lunid = ''
+            serial = disk_serials.get(name) or ''
+            lunid = geom.findtext('provider/config/lunid') or ''
             serial = serial + lunid
             if not serial:
                 continue
-            size = geom.xpath("./provider/mediasize")[0].text
+            size = geom.findtext('provider/mediasize')
             serials[(serial, size)].append(name)
 
         for disks in serials.values():
@@ -4675,17 +5112,15 @@ class notifier:
             self.multipath_create(name, disks, active_active)
 
         # Grab confxml again to take new multipaths into account
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         mp_ids = []
-        for geom in doc.xpath("//class[name = 'MULTIPATH']/geom"):
+        for geom in topology.geoms('MULTIPATH'):
             _disks = []
-            for provref in geom.xpath("./consumer/provider/@ref"):
-                prov = doc.xpath("//provider[@id = '%s']" % provref)[0]
-                class_name = prov.xpath("../../name")[0].text
+            for provref in topology.consumer_refs(geom):
                 # For now just DISK is allowed
-                if class_name != 'DISK':
+                if topology.provider_class(provref) != 'DISK':
                     continue
-                disk = prov.xpath("../name")[0].text
+                disk = topology.provider_geom_name(provref)
                 _disks.append(disk)
             qs = Disk.objects.filter(
                 Q(disk_name__in=_disks) | Q(disk_multipath_member__in=_disks)
@@ -4693,7 +5128,7 @@ class notifier:
             if qs.exists():
                 diskobj = qs[0]
                 mp_ids.append(diskobj.id)
-                diskobj.disk_multipath_name = geom.xpath("./name")[0].text
+                diskobj.disk_multipath_name = geom.findtext('name')
                 if diskobj.disk_name in _disks:
                     _disks.remove(diskobj.disk_name)
                 if _disks:
@@ -5114,17 +5549,6 @@ class notifier:
         else:
             return False
 
-    def rsync_command(self, obj_or_id):
-        """
-        Helper method used in ix-crontab to generate the rsync command
-        avoiding code duplication.
-        This should be removed once ix-crontab is rewritten in python.
-        """
-        from freenasUI.tasks.models import Rsync
-        oid = int(obj_or_id)
-        rsync = Rsync.objects.get(id=oid)
-        return rsync.commandline()
-
     def system_dataset_settings(self):
         from freenasUI.storage.models import Volume
         from freenasUI.system.models import SystemDataset
@@ -5164,6 +5588,7 @@ class notifier:
         basename = '%s/.system' % volume.vol_name
         return systemdataset, volume, basename
 
+    @zfscache.invalidates
     def system_dataset_create(self, mount=True):
 
         if (
@@ -5229,6 +5654,7 @@ class notifier:
 
         return systemdataset
 
+    @zfscache.invalidates
     def system_dataset_rename(self, basename=None, sysdataset=None):
         if basename is None:
             basename = self.system_dataset_settings()[2]
@@ -5370,6 +5796,7 @@ class notifier:
                     os.unlink(item)
                 self._createlink(syspath, item)
 
+    @zfscache.invalidates
     def system_dataset_migrate(self, _from, _to):
 
         rsyncs = (
@@ -5424,8 +5851,9 @@ class notifier:
         """
         status = ''
         message = ""
-        p1 = self._pipeopen("/sbin/zpool status -x %s" % pool_name)
-        zpool_result = p1.communicate()[0]
+        zpool_result = zfscache.zfs_command(
+            ["/sbin/zpool", "status", "-x", pool_name]
+        )[1]
         if zpool_result.find("pool '%s' is healthy" % pool_name) != -1:
             status = 'HEALTHY'
         else:
@@ -5535,6 +5963,7 @@ class notifier:
         )
         return cipher.decrypt(encrypted).rstrip(PWENC_PADDING)
 
+    @zfscache.invalidates
     def bootenv_attach_disk(self, label, devname):
         """Attach a new disk to the pool"""
 
@@ -5572,6 +6001,7 @@ class notifier:
 
         return True
 
+    @zfscache.invalidates
     def bootenv_replace_disk(self, label, devname):
         """Attach a new disk to the pool"""
 
@@ -5610,6 +6040,10 @@ class notifier:
         return True
 
 
+def _service_action(action, what):
+    return notifier()._service_action(action, what)
+
+
 def usage():
     usage_str = """usage: %s action command
     Action is one of:
@@ -0,0 +1,99 @@
+#!/usr/local/bin/python
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+
+"""
+Command line entry point of the notifier, served by notifierd
+
+    notifier_client.py <method> [args...]
+
+Same usage and output as running middleware/notifier.py directly, but
+the method runs in notifierd (tools/notifierd.py) which has Django and
+every app loaded already. Only the standard library is imported here
+so the call costs no more than starting the interpreter.
+
+Falls back to running notifier.py when notifierd is not available.
+"""
+import errno
+import os
+import socket
+import sys
+
+sys.path.append('/usr/local/www')
+
+from freenasUI.common.unixsock import UnixSockError, unixsock_call
+
+SOCKFILE = '/var/run/notifierd.sock'
+PIDFILE = '/var/run/notifierd.pid'
+NOTIFIER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'notifier.py')
+
+# connect() errors, the request has not been sent
+UNAVAILABLE = (errno.ENOENT, errno.ECONNREFUSED)
+
+
+class NotifierError(Exception):
+    pass
+
+
+def call(method, *args):
+    """
+    Run notifier().method(*args) in notifierd
+
+    Returns:
+        The output notifier.py would print, without the trailing newline
+
+    Raises:
+        socket.error: notifierd is not available (errno in UNAVAILABLE)
+            or the connection failed during the call
+        NotifierError: the method failed
+    """
+    try:
+        rv = unixsock_call(SOCKFILE, 'call', action=method, args=list(args))
+    except UnixSockError, e:
+        raise NotifierError(str(e))
+    # latin-1 round trips any byte string through JSON
+    return rv.encode('latin-1')
+
+
+def main(argv):
+    if not argv:
+        os.execv(sys.executable, [sys.executable, NOTIFIER])
+    try:
+        output = call(argv[0], *argv[1:])
+    except socket.error, e:
+        if e.errno in UNAVAILABLE:
+            os.execv(sys.executable, [sys.executable, NOTIFIER] + argv)
+        # The method may have run already, running it again is not safe
+        sys.stderr.write("notifierd: %s\n" % e)
+        sys.exit(1)
+    except NotifierError, e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+    sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
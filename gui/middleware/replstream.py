@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+
+"""
+Replication stream stage
+
+Moves a zfs send stream to the ssh process running zfs receive on the
+remote side, in place of the throttle and dd processes of the shell
+pipeline. The stream is relayed through one preallocated buffer, rate
+limited with a token bucket and metered; the counters are published
+to a stats file read by the replication status.
+"""
+import errno
+import io
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+
+log = logging.getLogger('middleware.replstream')
+
+# Size of the relay buffer, same as the former dd obs=1m
+BUFSIZE = 1024 * 1024
+# How often the stats file is rewritten
+STATS_INTERVAL = 1
+
+
+class Compressor(object):
+    """
+    Compression of the stream: ``compress`` is run locally without
+    a shell, ``decompress`` is the remote command it is piped to
+    """
+
+    def __init__(self, compress, decompress):
+        self.compress = compress
+        self.decompress = decompress
+
+
+COMPRESSORS = {
+    'pigz': Compressor(['/usr/local/bin/pigz'], '/usr/local/bin/pigz -d'),
+    'plzip': Compressor(['/usr/local/bin/plzip'], '/usr/local/bin/plzip -d'),
+    'lz4': Compressor(['/usr/local/bin/lz4c'], '/usr/local/bin/lz4c -d'),
+}
+
+
+def register_compressor(name, compress, decompress):
+    COMPRESSORS[name] = Compressor(compress, decompress)
+
+
+class TokenBucket(object):
+    """
+    Limit a stream to ``rate`` bytes per second, allowing bursts of
+    ``burst`` bytes
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            # A quarter of a second worth of data keeps the flow smooth
+            burst = max(int(rate / 4), 4096)
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+
+    def consume(self, count):
+        while True:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last) * self.rate
+            )
+            self.last = now
+            if self.tokens >= count:
+                self.tokens -= count
+                return
+            time.sleep((count - self.tokens) / self.rate)
+
+
+class StreamMeter(object):
+    """
+    Byte counters of a replication task
+
+    The counters add up over every stream sent for the task, so the
+    progress is kept when a task goes on with another stream.
+    """
+
+    def __init__(self, statsfile=None):
+        self.statsfile = statsfile
+        self.bytes = 0
+        self.seconds = 0.0
+        self.snapshot = None
+        self._started = None
+        self._written = 0
+
+    def start(self, snapshot):
+        self.snapshot = snapshot
+        self._started = time.time()
+        self.publish()
+
+    def update(self, count):
+        self.bytes += count
+        now = time.time()
+        if now - self._written >= STATS_INTERVAL:
+            self.publish(now)
+
+    def stop(self):
+        if self._started is not None:
+            self.seconds += time.time() - self._started
+            self._started = None
+        self.publish()
+
+    @property
+    def elapsed(self):
+        if self._started is None:
+            return self.seconds
+        return self.seconds + time.time() - self._started
+
+    @property
+    def rate(self):
+        """
+        Average throughput in bytes per second
+        """
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0
+        return int(self.bytes / elapsed)
+
+    def stats(self):
+        return {
+            'snapshot': self.snapshot,
+            'bytes': self.bytes,
+            'seconds': self.elapsed,
+            'bytes_per_second': self.rate,
+            'mb_per_second': round(self.rate / 1048576.0, 2),
+            'updated': time.time(),
+        }
+
+    def publish(self, now=None):
+        self._written = now or time.time()
+        if not self.statsfile:
+            return
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.statsfile))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.stats(), f)
+            os.rename(tmp, self.statsfile)
+        except (IOError, OSError), e:
+            log.debug("Failed to write %s: %s", self.statsfile, e)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def clear(self):
+        if self.statsfile and os.path.exists(self.statsfile):
+            os.unlink(self.statsfile)
+
+
+def relay(src, dst, bucket=None, meter=None, bufsize=BUFSIZE):
+    """
+    Copy everything from file descriptor ``src`` to ``dst`` through
+    a single buffer
+
+    Returns:
+        tuple(bytes copied, False if ``dst`` was closed before the end
+        of the stream)
+    """
+    if bucket is not None:
+        bufsize = min(bufsize, bucket.burst)
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    reader = io.FileIO(src, 'r', closefd=False)
+    total = 0
+    while True:
+        count = reader.readinto(buf)
+        if not count:
+            return total, True
+        if bucket is not None:
+            bucket.consume(count)
+        offset = 0
+        while offset < count:
+            try:
+                offset += os.write(dst, view[offset:count])
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EPIPE:
+                    return total + offset, False
+                raise
+        total += count
+        if meter is not None:
+            meter.update(count)
+
+
+def send(sendargs, sshargs, receive, logfile, limit=0, compression=None,
+         meter=None, pidfile=None):
+    """
+    Send the stream of the ``sendargs`` zfs send command to the
+    ``receive`` command run over ``sshargs``
+
+    Arguments:
+        limit: rate limit in kB/s, 0 for unlimited
+        compression: name of a registered compressor
+        pidfile: where to write the pid of zfs send
+        logfile: file object getting the output of the remote side
+
+    Returns:
+        tuple(returncode of ssh, bytes sent)
+    """
+    compressor = COMPRESSORS.get(compression)
+    if compressor is not None:
+        receive = '%s | %s' % (compressor.decompress, receive)
+
+    procs = []
+    try:
+        zfsproc = subprocess.Popen(
+            sendargs,
+            stdout=subprocess.PIPE,
+            close_fds=True,
+            bufsize=0,
+        )
+        procs.append(zfsproc)
+        if pidfile:
+            with open(pidfile, 'w') as f:
+                f.write(str(zfsproc.pid))
+        source = zfsproc.stdout
+        if compressor is not None:
+            compproc = subprocess.Popen(
+                compressor.compress,
+                stdin=source,
+                stdout=subprocess.PIPE,
+                close_fds=True,
+                bufsize=0,
+            )
+            procs.append(compproc)
+            # The compressor owns the send side now
+            source.close()
+            source = compproc.stdout
+        sshproc = subprocess.Popen(
+            sshargs + [receive],
+            stdin=subprocess.PIPE,
+            stdout=logfile,
+            stderr=subprocess.STDOUT,
+            close_fds=True,
+            bufsize=0,
+        )
+        procs.append(sshproc)
+
+        bucket = TokenBucket(limit * 1024) if limit else None
+        sent, complete = relay(
+            source.fileno(), sshproc.stdin.fileno(),
+            bucket=bucket, meter=meter,
+        )
+        if not complete:
+            log.warn("Remote side closed the stream of %s", sendargs[-1])
+        sshproc.stdin.close()
+        source.close()
+        sshproc.wait()
+        return sshproc.returncode, sent
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                try:
+                    proc.terminate()
+                except OSError:
+                    pass
+            proc.wait()
+        if pidfile and os.path.exists(pidfile):
+            os.unlink(pidfile)
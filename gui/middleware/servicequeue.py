@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+Coalescing queue for service start/stop/restart/reload requests.
+
+Requests for the same service submitted while one is still pending are
+merged into a single action (e.g. ten reloads of "user" become one,
+a reload followed by a restart becomes a restart).  Each submit returns
+a ServiceRequest handle which can be waited upon for the result.
+
+Requests are executed one at a time by a worker thread, in submission
+order, except that services listed in PREREQUISITES are run before the
+services depending on them when both are pending.
+"""
+import atexit
+import logging
+import threading
+import time
+
+log = logging.getLogger('middleware.servicequeue')
+
+# Seconds a request waits for more identical requests before running.
+# Every new request extends the window, up to MAX_DELAY since the first.
+DEBOUNCE = 1.0
+MAX_DELAY = 5.0
+
+# Pending action, new action -> single action satisfying both
+MERGE = {
+    ('reload', 'reload'): 'reload',
+    ('reload', 'restart'): 'restart',
+    ('reload', 'start'): 'restart',
+    ('restart', 'reload'): 'restart',
+    ('restart', 'restart'): 'restart',
+    ('restart', 'start'): 'restart',
+    ('start', 'start'): 'start',
+    ('start', 'restart'): 'restart',
+    ('stop', 'stop'): 'stop',
+    ('stop', 'start'): 'restart',
+    ('stop', 'restart'): 'restart',
+}
+
+# service -> services that have to be run first if they are pending,
+# because the former reads configuration generated by the latter
+PREREQUISITES = {
+    'afp': ('user', ),
+    'cifs': ('user', ),
+    'ftp': ('user', ),
+    'nfs': ('user', ),
+    'webdav': ('user', ),
+}
+
+
+class ServiceRequest(object):
+
+    def __init__(self, action, what, due):
+        self.action = action
+        self.what = what
+        self.created = time.time()
+        self.due = due
+        self.merged = 1
+        self.result = None
+        self.error = None
+        self._event = threading.Event()
+
+    def __repr__(self):
+        return '<ServiceRequest %s %s>' % (self.action, self.what)
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the action to complete and return its result, raising
+        whatever exception the action raised.
+
+        Returns None if it did not complete within timeout.
+        """
+        if not self._event.wait(timeout):
+            return None
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def _finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._event.set()
+
+
+class ServiceQueue(object):
+
+    def __init__(self, runner):
+        self._runner = runner
+        self._cond = threading.Condition()
+        self._pending = []
+        self._thread = None
+        self._local = threading.local()
+
+    def submit(self, action, what, delay=DEBOUNCE):
+        """
+        Queue ``action`` for service ``what`` to run after ``delay``
+        seconds, merging it into a pending request if possible.
+
+        Requests made from within a running action (e.g. _reload_user
+        reloading cifs) are executed right away to preserve ordering.
+        """
+        if getattr(self._local, 'inline', False):
+            req = ServiceRequest(action, what, time.time())
+            self._execute(req)
+            return req
+
+        with self._cond:
+            now = time.time()
+            req = None
+            for pending in reversed(self._pending):
+                if pending.what == what:
+                    req = pending
+                    break
+            merged = MERGE.get((req.action, action)) if req else None
+            if merged:
+                req.action = merged
+                req.merged += 1
+                if delay:
+                    req.due = min(
+                        max(req.due, now + delay), req.created + MAX_DELAY
+                    )
+                else:
+                    req.due = now
+            else:
+                req = ServiceRequest(action, what, now + (delay or 0))
+                self._pending.append(req)
+            self._start()
+            self._cond.notify()
+        return req
+
+    def flush(self):
+        """
+        Run every pending request now, in the calling thread.
+        """
+        while True:
+            with self._cond:
+                req = self._next(float('inf'))
+                if req is None:
+                    return
+                self._pending.remove(req)
+            self._execute(req)
+
+    def _start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._worker, name='servicequeue'
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _next(self, now):
+        """
+        Return the next request that may run at ``now``, pulling pending
+        prerequisites forward.  Must be called with the lock held.
+        """
+        for idx, req in enumerate(self._pending):
+            if req.due > now:
+                continue
+            # Keep the order of requests for the same service
+            if [p for p in self._pending[:idx] if p.what == req.what]:
+                continue
+            for p in self._pending[:]:
+                if p.what in PREREQUISITES.get(req.what, ()):
+                    return p
+            return req
+        return None
+
+    def _worker(self):
+        from django.db import connection
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    req = self._next(now)
+                    if req is not None:
+                        break
+                    if self._pending:
+                        timeout = min(p.due for p in self._pending) - now
+                        self._cond.wait(max(timeout, 0.05))
+                    else:
+                        self._cond.wait()
+                self._pending.remove(req)
+            self._execute(req)
+            connection.close()
+
+    def _execute(self, req):
+        if req.merged > 1:
+            log.debug(
+                "Running %s %s for %d requests", req.action, req.what,
+                req.merged,
+            )
+        nested = getattr(self._local, 'inline', False)
+        self._local.inline = True
+        try:
+            result = self._runner(req.action, req.what)
+        except Exception, e:
+            log.warn("Failed to %s %s: %s", req.action, req.what, e)
+            req._finish(error=e)
+        else:
+            req._finish(result=result)
+        finally:
+            self._local.inline = nested
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue(runner):
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = ServiceQueue(runner)
+            atexit.register(_queue.flush)
+        return _queue
@@ -0,0 +1,163 @@
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from freenasUI.common.unixsock import UnixJSONServer
+from freenasUI.middleware import zfscache
+
+ARGS = ['/sbin/zfs', 'list', '-H']
+
+
+class ZFSStateCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.runs = []
+        self._run = zfscache._run
+
+        def run(args):
+            self.runs.append(args)
+            return 0, 'run %d\n' % len(self.runs)
+        zfscache._run = run
+        self.cache = zfscache.ZFSStateCache()
+
+    def tearDown(self):
+        zfscache._run = self._run
+
+    def age(self, seconds):
+        for entry in self.cache._entries.values():
+            entry.updated -= seconds
+
+    def wait_refresh(self):
+        for entry in self.cache._entries.values():
+            event = entry.refreshing
+            if event is not None:
+                event.wait()
+
+    def test_fresh(self):
+        self.assertEqual(self.cache.get(ARGS)[1], 'run 1\n')
+        self.assertEqual(self.cache.get(ARGS)[1], 'run 1\n')
+        self.assertEqual(len(self.runs), 1)
+
+    def test_stale_while_revalidate(self):
+        self.cache.get(ARGS)
+        self.age(20)
+        returncode, output, age = self.cache.get(ARGS)
+        self.assertEqual(output, 'run 1\n')
+        self.assertTrue(age >= 20)
+        self.wait_refresh()
+        self.assertEqual(self.cache.get(ARGS)[1], 'run 2\n')
+
+    def test_maxage_zero(self):
+        self.cache.get(ARGS)
+        self.age(20)
+        returncode, output, age = self.cache.get(ARGS, maxage=0)
+        self.assertEqual(output, 'run 2\n')
+        self.assertTrue(age < 20)
+
+    def test_maxstale_below_maxage(self):
+        self.cache.get(ARGS)
+        self.age(20)
+        output = self.cache.get(ARGS, maxage=30, maxstale=5)[1]
+        self.assertEqual(output, 'run 1\n')
+        self.age(20)
+        output = self.cache.get(ARGS, maxage=30, maxstale=5)[1]
+        self.assertEqual(output, 'run 2\n')
+
+    def test_invalidate(self):
+        self.cache.get(ARGS)
+        self.cache.invalidate()
+        self.assertEqual(self.cache.get(ARGS)[1], 'run 2\n')
+
+
+class HungServer(object):
+
+    def query(self, **kwargs):
+        time.sleep(5)
+
+
+class ZFSCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sockfile = zfscache.SOCKFILE
+        self.timeout = zfscache.QUERY_TIMEOUT
+        self._run = zfscache._run
+        zfscache.SOCKFILE = os.path.join(self.tmpdir, 'zfscached.sock')
+        zfscache.QUERY_TIMEOUT = 0.5
+        zfscache._run = lambda args: (0, 'direct\n')
+        self.server = UnixJSONServer(zfscache.SOCKFILE, HungServer())
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        zfscache.SOCKFILE = self.sockfile
+        zfscache.QUERY_TIMEOUT = self.timeout
+        zfscache._run = self._run
+        shutil.rmtree(self.tmpdir)
+
+    def test_hung_daemon(self):
+        start = time.time()
+        self.assertEqual(zfscache.zfs_command(ARGS), (0, 'direct\n'))
+        self.assertTrue(time.time() - start < 3)
+
+
+
+class ZFSLinesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sockfile = zfscache.SOCKFILE
+        self._normalize = zfscache._normalize
+        zfscache.SOCKFILE = '/nonexistent/zfscached.sock'
+        # More on stderr than a pipe can hold
+        zfscache._normalize = lambda args: (
+            '/bin/sh', '-c', 'head -c 200000 /dev/zero >&2; echo out',
+        )
+
+    def tearDown(self):
+        zfscache.SOCKFILE = self.sockfile
+        zfscache._normalize = self._normalize
+
+    def test_stderr(self):
+        lines = []
+        thread = threading.Thread(
+            target=lambda: lines.extend(zfscache.zfs_lines(ARGS))
+        )
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertEqual(lines, ['out\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
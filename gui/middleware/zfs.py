@@ -25,14 +25,19 @@
 # SUCH DAMAGE.
 #
 from decimal import Decimal
+from fnmatch import fnmatch
+from operator import attrgetter
 import bisect
 import logging
 import re
 import subprocess
+import time
 
 from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext_lazy as _
 
+from freenasUI.middleware import zfscache
+
 log = logging.getLogger('middleware.zfs')
 
 ZPOOL_NAME_RE = r'[a-z][a-z0-9_\-\.]*'
@@ -427,8 +432,9 @@ class ZFSList(SortedDict):
         super(ZFSList, self).__init__(*args, **kwargs)
 
     def append(self, new):
+        # zfs list output is sorted by name, no need to insort
         if new.pool in self.pools:
-            bisect.insort(self.pools.get(new.pool), new)
+            self.pools.get(new.pool).append(new)
         else:
             self.pools[new.pool] = [new]
         self[new.path] = new
@@ -471,25 +477,20 @@ class ZFSList(SortedDict):
 
 class ZFSDataset(object):
 
+    __slots__ = (
+        'name', 'path', 'pool', 'used', 'usedsnap', 'usedds',
+        'usedrefreserv', 'usedchild', 'avail', 'refer', 'mountpoint',
+        'parent', 'children',
+    )
+
     category = 'filesystem'
-    name = None
-    path = None
-    pool = None
-    used = None
-    usedsnap = None
-    usedds = None
-    usedrefreserv = None
-    usedchild = None
-    avail = None
-    refer = None
-    mountpoint = None
-    parent = None
-    children = None
 
     def __init__(self, path=None, used=None, usedsnap=None, usedds=None,
                  usedrefreserv=None, usedchild=None, avail=None, refer=None,
                  mountpoint=None):
         self.path = path
+        self.pool = None
+        self.name = None
         if path:
             if '/' in path:
                 self.pool, self.name = path.split('/', 1)
@@ -531,25 +532,20 @@ class ZFSDataset(object):
 
 class ZFSVol(object):
 
+    __slots__ = (
+        'name', 'path', 'pool', 'used', 'usedsnap', 'usedds',
+        'usedrefreserv', 'usedchild', 'avail', 'refer', 'volsize',
+        'parent', 'children',
+    )
+
     category = 'volume'
-    name = None
-    path = None
-    pool = None
-    used = None
-    usedsnap = None
-    usedds = None
-    usedrefreserv = None
-    usedchild = None
-    avail = None
-    refer = None
-    volsize = None
-    parent = None
-    children = None
 
     def __init__(self, path=None, used=None, usedsnap=None, usedds=None,
                  usedrefreserv=None, usedchild=None, avail=None, refer=None,
                  volsize=None):
         self.path = path
+        self.pool = None
+        self.name = None
         if path:
             if '/' in path:
                 self.pool, self.name = path.split('/', 1)
@@ -599,6 +595,7 @@ class Snapshot(object):
     parent_type = None
     replication = None
     vmsynced = False
+    creation = None
 
     def __init__(
         self,
@@ -609,7 +606,8 @@ class Snapshot(object):
         mostrecent=False,
         parent_type=None,
         replication=None,
-        vmsynced=False
+        vmsynced=False,
+        creation=None,
     ):
         self.name = name
         self.filesystem = filesystem
@@ -619,6 +617,7 @@ class Snapshot(object):
         self.parent_type = parent_type
         self.replication = replication
         self.vmsynced = vmsynced
+        self.creation = creation
 
     def __repr__(self):
         return u"<Snapshot: %s>" % self.fullname
@@ -628,6 +627,158 @@ class Snapshot(object):
         return "%s@%s" % (self.filesystem, self.name)
 
 
+class SnapshotStore(object):
+    """
+    Indexed, read-only set of snapshots
+
+    Snapshots are indexed by filesystem so dataset lookups do not scan
+    every snapshot. Each ordering is sorted once, the first time it is
+    asked for, so getting a page out of it is only a slice.
+    """
+
+    _cache = None
+
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+        self.filesystems = {}
+        for snap in snapshots:
+            self.filesystems.setdefault(snap.filesystem, []).append(snap)
+        self._fsnames = sorted(self.filesystems)
+        self._orders = {}
+        self._positions = {}
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    @classmethod
+    def cached(cls, build, maxage):
+        """
+        Get the store returned by ``build``, reusing the last one for
+        ``maxage`` seconds unless zfs state was invalidated meanwhile
+        """
+        now = time.time()
+        generation = zfscache.generation()
+        cache = cls._cache
+        if cache is None or cache[0] != generation or now - cache[1] > maxage:
+            cache = cls._cache = (generation, now, build())
+        return cache[2]
+
+    def ordered(self, field=None, reverse=False):
+        """
+        Get every snapshot sorted by ``field``
+        """
+        if field is None:
+            return self.snapshots
+        key = (field, reverse)
+        if key not in self._orders:
+            self._orders[key] = sorted(
+                self.snapshots, key=attrgetter(field), reverse=reverse
+            )
+        return self._orders[key]
+
+    def datasets(self, dataset, recursive=False):
+        """
+        Get the filesystems holding snapshots of ``dataset``
+        and of its children if ``recursive``
+        """
+        names = []
+        if dataset in self.filesystems:
+            names.append(dataset)
+        if recursive:
+            prefix = dataset + '/'
+            idx = bisect.bisect_left(self._fsnames, prefix)
+            while (
+                idx < len(self._fsnames) and
+                self._fsnames[idx].startswith(prefix)
+            ):
+                names.append(self._fsnames[idx])
+                idx += 1
+        return names
+
+    def query(self, dataset=None, recursive=False, prefix=None,
+              pattern=None, created_after=None, created_before=None,
+              ordering=None):
+        """
+        Get the snapshots matching every given filter
+
+        ``ordering`` is a list of fields, prefixed by '-' for descending
+        order, applied as successive sorts.
+
+        Returns:
+            A list of Snapshot
+        """
+        orders = []
+        for field in (ordering or []):
+            if field.startswith('-'):
+                orders.append((field[1:], True))
+            else:
+                orders.append((field, False))
+
+        if dataset is not None:
+            results = []
+            for fs in self.datasets(dataset, recursive=recursive):
+                results.extend(self.filesystems[fs])
+            presorted = False
+        elif len(orders) == 1:
+            results = self.ordered(*orders[0])
+            presorted = True
+        else:
+            results = self.snapshots
+            presorted = False
+
+        if prefix:
+            results = [s for s in results if s.name.startswith(prefix)]
+        if pattern:
+            results = [s for s in results if fnmatch(s.name, pattern)]
+        if created_after is not None:
+            results = [
+                s for s in results
+                if s.creation is not None and s.creation >= created_after
+            ]
+        if created_before is not None:
+            results = [
+                s for s in results
+                if s.creation is not None and s.creation < created_before
+            ]
+
+        if not presorted and orders:
+            results = list(results)
+            for field, reverse in orders:
+                results.sort(key=attrgetter(field), reverse=reverse)
+        return results
+
+    def offset_after(self, results, fullname):
+        """
+        Get the offset of the snapshot following ``fullname`` in
+        ``results``, for keyset pagination
+        """
+        positions = None
+        for key, ordered in self._orders.items():
+            if ordered is results:
+                positions = self._positions.get(key)
+                if positions is None:
+                    positions = self._positions[key] = dict(
+                        (s.fullname, i) for i, s in enumerate(ordered)
+                    )
+                break
+        if positions is None:
+            if results is self.snapshots:
+                positions = self._positions.get(None)
+                if positions is None:
+                    positions = self._positions[None] = dict(
+                        (s.fullname, i) for i, s in enumerate(results)
+                    )
+            else:
+                for i, snap in enumerate(results):
+                    if snap.fullname == fullname:
+                        return i + 1
+                return 0
+        idx = positions.get(fullname)
+        if idx is None:
+            return 0
+        return idx + 1
+
+
 def parse_status(name, doc, data):
 
     """
@@ -887,47 +1038,61 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
     if path:
         args.append(path)
 
-    zfsproc = subprocess.Popen(
-        args,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
+    return parse_zfs_list(
+        zfscache.zfs_lines(args),
+        hierarchical=hierarchical,
+        include_root=include_root,
+    )
+
 
-    zfs_output, zfs_err = zfsproc.communicate()
-    zfs_output = zfs_output.split('\n')
+def _int(value):
+    return int(value) if value.isdigit() else None
+
+
+def parse_zfs_list(lines, hierarchical=False, include_root=False):
+    """
+    Build a ZFSList out of ``zfs list -p -H -o
+    space,refer,mountpoint,type,volsize`` output lines
+
+    Lines are consumed one at a time, so the output does not need to be
+    buffered. In hierarchical mode every dataset is appended to its
+    closest listed ancestor, found through a path -> node dict.
+    """
     zfslist = ZFSList()
-    for line in zfs_output:
+    nodes = {}
+    for line in lines:
+        line = line.rstrip('\n')
         if not line:
             continue
         data = line.split('\t')
-        names = data[0].split('/')
-        depth = len(names)
+        path = data[0]
         # root filesystem is not treated as dataset by us
-        if depth == 1 and not include_root:
+        if '/' not in path and not include_root:
             continue
         _type = data[9]
         if _type == 'filesystem':
             item = ZFSDataset(
-                path=data[0],
-                avail=int(data[1]) if data[1].isdigit() else None,
-                used=int(data[2]) if data[2].isdigit() else None,
-                usedsnap=int(data[3]) if data[3].isdigit() else None,
-                usedds=int(data[4]) if data[4].isdigit() else None,
-                usedrefreserv=int(data[5]) if data[5].isdigit() else None,
-                usedchild=int(data[6]) if data[6].isdigit() else None,
-                refer=int(data[7]) if data[7].isdigit() else None,
+                path=path,
+                avail=_int(data[1]),
+                used=_int(data[2]),
+                usedsnap=_int(data[3]),
+                usedds=_int(data[4]),
+                usedrefreserv=_int(data[5]),
+                usedchild=_int(data[6]),
+                refer=_int(data[7]),
                 mountpoint=data[8],
             )
         elif _type == 'volume':
             item = ZFSVol(
-                path=data[0],
-                avail=int(data[1]) if data[1].isdigit() else None,
-                used=int(data[2]) if data[2].isdigit() else None,
-                usedsnap=int(data[3]) if data[3].isdigit() else None,
-                usedds=int(data[4]) if data[4].isdigit() else None,
-                usedrefreserv=int(data[5]) if data[5].isdigit() else None,
-                usedchild=int(data[6]) if data[6].isdigit() else None,
-                refer=int(data[7]) if data[7].isdigit() else None,
-                volsize=int(data[10]) if data[10].isdigit() else None,
+                path=path,
+                avail=_int(data[1]),
+                used=_int(data[2]),
+                usedsnap=_int(data[3]),
+                usedds=_int(data[4]),
+                usedrefreserv=_int(data[5]),
+                usedchild=_int(data[6]),
+                refer=_int(data[7]),
+                volsize=_int(data[10]),
             )
         else:
             raise NotImplementedError
@@ -936,8 +1101,15 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
             zfslist.append(item)
             continue
 
-        parentds = zfslist.find(names, root=include_root)
-        if parentds:
+        parentds = None
+        parent = path
+        while '/' in parent:
+            parent = parent.rsplit('/', 1)[0]
+            parentds = nodes.get(parent)
+            if parentds is not None:
+                break
+        nodes[path] = item
+        if parentds is not None:
             parentds.append(item)
         else:
             zfslist.append(item)
@@ -957,16 +1129,15 @@ def list_datasets(path="", recursive=False, hierarchical=False,
 
 
 def zpool_list():
-    zfsproc = subprocess.Popen([
-        'zpool',
+    returncode, output = zfscache.zfs_command([
+        '/sbin/zpool',
         'list',
         '-o', 'name,size,alloc,free,cap',
         '-p',
         '-H',
-    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    output = zfsproc.communicate()[0].strip('\n')
-    if zfsproc.returncode != 0:
+    ])
+    output = output.strip('\n')
+    if returncode != 0:
         raise SystemError('zpool list failed')
 
     rv = {}
@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+
+"""
+Cache of zfs/zpool state shared by every consumer through zfscached
+
+zfscached (tools/zfscached.py) keeps the output of read-only zfs and
+zpool commands in memory. Results younger than ``maxage`` are served
+right away. Older ones, up to ``maxstale``, are still served while
+they are refreshed in the background (stale-while-revalidate). Only
+missing or invalidated results make the caller wait for the command,
+as does ``maxage=0``, which always asks for a fresh result.
+
+Entries used recently are refreshed periodically so they are warm
+when asked for again, the others eventually expire.
+
+When zfscached is not running the commands are run in-process.
+
+The names of the snapshots on replication targets are cached the same
+way, one set per remote host, so listing local snapshots does not wait
+on ssh round-trips.
+"""
+from functools import wraps
+from multiprocessing.pool import ThreadPool
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+
+from freenasUI.common.unixsock import UnixSockError, unixsock_call
+
+log = logging.getLogger('middleware.zfscache')
+
+# Number of invalidations issued by this process
+_generation = 0
+
+SOCKFILE = '/var/run/zfscached.sock'
+PIDFILE = '/var/run/zfscached.pid'
+
+# Results younger than this are served without being refreshed
+MAXAGE = 10
+# Stale results older than this are never served
+MAXSTALE = 300
+# Period of the background refresh of recently used results
+REFRESH_INTERVAL = 15
+# Only results used within this window are kept warm
+KEEPWARM = 300
+# Results not used within this window are dropped
+EXPIRE = 3600
+
+# Remote snapshot lists younger than this are served without being refreshed
+REMOTE_TTL = 120
+# Maximum number of remote hosts queried at the same time
+REMOTE_WORKERS = 8
+
+# Give up on zfscached after this many seconds and run the command
+# in-process, so a hung daemon does not hang its callers
+QUERY_TIMEOUT = 120
+
+COMMANDS = {
+    'zfs': ('/sbin/zfs', ('list', 'get')),
+    'zpool': ('/sbin/zpool', ('list', 'status', 'get')),
+}
+
+
+def _normalize(args):
+    """
+    Validate a read-only zfs/zpool command and return its key
+    """
+    args = [
+        a.encode('utf8') if isinstance(a, unicode) else str(a)
+        for a in args
+    ]
+    if len(args) < 2 or os.path.basename(args[0]) not in COMMANDS:
+        raise ValueError("Not a zfs/zpool command: %s" % ' '.join(args))
+    path, subcommands = COMMANDS[os.path.basename(args[0])]
+    if args[1] not in subcommands:
+        raise ValueError("Not a read-only command: %s" % ' '.join(args))
+    return (path, ) + tuple(args[1:])
+
+
+def _run(args):
+    proc = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        close_fds=True,
+    )
+    output = proc.communicate()[0]
+    return proc.returncode, output
+
+
+class CacheEntry(object):
+
+    __slots__ = (
+        'args', 'returncode', 'output', 'updated', 'used', 'valid',
+        'refreshing',
+    )
+
+    def __init__(self, args):
+        self.args = args
+        self.returncode = None
+        self.output = None
+        self.updated = 0
+        self.used = 0
+        self.valid = False
+        self.refreshing = None
+
+
+def _remote_key(remote):
+    return (
+        str(remote['hostname']),
+        int(remote['port']),
+        str(remote.get('user') or 'root'),
+    )
+
+
+def _remote_snapshots(key):
+    """
+    Get the names of the snapshots on a remote host over ssh
+
+    Returns:
+        frozenset of names, None if the host could not be queried
+    """
+    hostname, port, user = key
+    try:
+        proc = subprocess.Popen([
+            '/usr/bin/ssh',
+            '-i', '/data/ssh/replication',
+            '-o', 'ConnectTimeout=3',
+            '-o', 'BatchMode=yes',
+            '-p', str(port),
+            '%s@%s' % (user, hostname),
+            'zfs list -Ht snapshot -o name',
+        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    except OSError, e:
+        log.warn("Failed to run ssh: %s", e)
+        return None
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        return None
+    return frozenset(output.split())
+
+
+class RemoteEntry(object):
+
+    __slots__ = ('key', 'names', 'updated', 'used', 'refreshing')
+
+    def __init__(self, key):
+        self.key = key
+        self.names = frozenset()
+        self.updated = 0
+        self.used = 0
+        self.refreshing = None
+
+
+class RemoteSnapshotCache(object):
+    """
+    Names of the snapshots on replication targets, one set per remote
+
+    Lists younger than ``ttl`` are served as is. Older ones are served
+    while every stale remote is refreshed concurrently in the background,
+    only remotes never queried before are waited for.
+    """
+
+    def __init__(self, ttl=REMOTE_TTL, workers=REMOTE_WORKERS):
+        self.ttl = ttl
+        self.workers = workers
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _refresh(self, entries):
+        def fetch(entry):
+            return entry, _remote_snapshots(entry.key)
+
+        if len(entries) == 1:
+            results = [fetch(entries[0])]
+        else:
+            pool = ThreadPool(min(self.workers, len(entries)))
+            try:
+                results = pool.map(fetch, entries)
+            finally:
+                pool.close()
+                pool.join()
+
+        now = time.time()
+        with self._lock:
+            for entry, names in results:
+                # Keep the last known list if the host is unreachable
+                if names is not None:
+                    entry.names = names
+                entry.updated = now
+                entry.refreshing.set()
+                entry.refreshing = None
+
+    def get(self, keys, ttl=None):
+        """
+        Get the snapshot names of every remote in ``keys``
+
+        Returns:
+            list of frozenset, in the same order as ``keys``
+        """
+        if ttl is None:
+            ttl = self.ttl
+        now = time.time()
+        entries = []
+        stale = []
+        wait = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._entries[key] = RemoteEntry(key)
+                entry.used = now
+                entries.append(entry)
+                if now - entry.updated <= ttl:
+                    continue
+                if entry.refreshing is None:
+                    entry.refreshing = threading.Event()
+                    stale.append(entry)
+                if entry.updated == 0:
+                    wait.append(entry.refreshing)
+
+        if stale:
+            if wait:
+                self._refresh(stale)
+            else:
+                thread = threading.Thread(target=self._refresh, args=(stale, ))
+                thread.daemon = True
+                thread.start()
+        for event in wait:
+            event.wait()
+        return [e.names for e in entries]
+
+    def tick(self):
+        """
+        Refresh the recently used remotes and drop the unused ones
+        """
+        now = time.time()
+        refresh = []
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry.refreshing is not None:
+                    continue
+                if now - entry.used > EXPIRE:
+                    del self._entries[key]
+                elif (
+                    now - entry.used <= KEEPWARM and
+                    now - entry.updated >= self.ttl
+                ):
+                    entry.refreshing = threading.Event()
+                    refresh.append(entry)
+        if refresh:
+            self._refresh(refresh)
+
+
+class ZFSStateCache(object):
+    """
+    In-memory cache of zfs/zpool command results, as served by zfscached
+    """
+
+    def __init__(self, remote_ttl=REMOTE_TTL):
+        self._entries = {}
+        self._lock = threading.Lock()
+        # Bumped on every invalidation, results of commands started
+        # before that are not trusted
+        self._generation = 0
+        self.remote = RemoteSnapshotCache(ttl=remote_ttl)
+
+    def _schedule(self, entry):
+        """
+        Mark ``entry`` as being refreshed, must hold the lock
+        """
+        entry.refreshing = threading.Event()
+        return entry.refreshing, self._generation
+
+    def _refresh(self, entry, event, generation):
+        try:
+            returncode, output = _run(entry.args)
+        except OSError, e:
+            log.warn("Failed to run %s: %s", ' '.join(entry.args), e)
+            returncode, output = -1, ''
+        with self._lock:
+            entry.returncode = returncode
+            entry.output = output
+            entry.updated = time.time()
+            entry.valid = generation == self._generation
+            entry.refreshing = None
+        event.set()
+
+    def get(self, args, maxage=MAXAGE, maxstale=MAXSTALE):
+        """
+        Get the result of a read-only zfs/zpool command
+
+        Returns:
+            tuple(returncode, output, age)
+        """
+        args = _normalize(args)
+        while True:
+            now = time.time()
+            with self._lock:
+                entry = self._entries.get(args)
+                if entry is None:
+                    entry = self._entries[args] = CacheEntry(args)
+                entry.used = now
+                age = now - entry.updated
+                if entry.valid and age <= maxage:
+                    return entry.returncode, entry.output, age
+
+                # maxage=0 asks for a fresh result, never serve stale
+                stale = (
+                    entry.valid and
+                    0 < maxage <= maxstale and
+                    age <= maxstale
+                )
+                if stale:
+                    result = (entry.returncode, entry.output, age)
+                event = entry.refreshing
+                if event is None:
+                    event, generation = self._schedule(entry)
+                    start = True
+                else:
+                    start = False
+
+            if stale:
+                if start:
+                    thread = threading.Thread(
+                        target=self._refresh,
+                        args=(entry, event, generation),
+                    )
+                    thread.daemon = True
+                    thread.start()
+                return result
+
+            if start:
+                self._refresh(entry, event, generation)
+            else:
+                event.wait()
+            with self._lock:
+                # Try again if invalidated while the command was running
+                if entry.valid:
+                    return (
+                        entry.returncode,
+                        entry.output,
+                        time.time() - entry.updated,
+                    )
+
+    def query(self, args, maxage=MAXAGE, maxstale=MAXSTALE):
+        returncode, output, age = self.get(
+            args, maxage=maxage, maxstale=maxstale
+        )
+        # latin-1 round trips any byte string through JSON
+        return {
+            'returncode': returncode,
+            'output': output.decode('latin-1'),
+            'age': age,
+        }
+
+    def remote_snapshots(self, remotes, ttl=None):
+        names = self.remote.get(
+            [_remote_key(remote) for remote in remotes], ttl=ttl
+        )
+        return [sorted(n) for n in names]
+
+    def invalidate(self):
+        """
+        Force every result to be refreshed before being served again
+        """
+        with self._lock:
+            self._generation += 1
+            for entry in self._entries.values():
+                entry.valid = False
+        return True
+
+    def tick(self):
+        """
+        Refresh recently used results and drop the unused ones
+        """
+        now = time.time()
+        refresh = []
+        with self._lock:
+            for args, entry in self._entries.items():
+                if entry.refreshing is not None:
+                    continue
+                if now - entry.used > EXPIRE:
+                    del self._entries[args]
+                elif (
+                    now - entry.used <= KEEPWARM and
+                    now - entry.updated >= REFRESH_INTERVAL
+                ):
+                    refresh.append((entry, ) + self._schedule(entry))
+        for entry, event, generation in refresh:
+            self._refresh(entry, event, generation)
+        self.remote.tick()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return [{
+                'args': list(entry.args),
+                'age': now - entry.updated,
+                'idle': now - entry.used,
+                'valid': entry.valid,
+            } for entry in self._entries.values()]
+
+
+def zfs_command(args, maxage=MAXAGE, maxstale=MAXSTALE):
+    """
+    Run a read-only zfs/zpool command, through zfscached if available
+
+    Returns:
+        tuple(returncode, output)
+    """
+    try:
+        rv = unixsock_call(
+            SOCKFILE,
+            'query',
+            timeout=QUERY_TIMEOUT,
+            args=list(args),
+            maxage=maxage,
+            maxstale=maxstale,
+        )
+        return rv['returncode'], rv['output'].encode('latin-1')
+    except socket.timeout:
+        log.warn("zfscached query timed out: %r", args)
+    except socket.error, e:
+        log.debug("zfscached not available: %s", e)
+    except UnixSockError, e:
+        log.warn("zfscached query failed: %s", e)
+    return _run(_normalize(args))
+
+
+def zfs_lines(args, maxage=MAXAGE, maxstale=MAXSTALE):
+    """
+    Iterate over the output lines of a read-only zfs/zpool command
+
+    The output is streamed from the process when zfscached is not
+    available.
+    """
+    try:
+        rv = unixsock_call(
+            SOCKFILE,
+            'query',
+            timeout=QUERY_TIMEOUT,
+            args=list(args),
+            maxage=maxage,
+            maxstale=maxstale,
+        )
+    except socket.timeout:
+        log.warn("zfscached query timed out: %r", args)
+    except socket.error, e:
+        log.debug("zfscached not available: %s", e)
+    except UnixSockError, e:
+        log.warn("zfscached query failed: %s", e)
+    else:
+        for line in rv['output'].encode('latin-1').splitlines(True):
+            yield line
+        return
+
+    # Nobody reads stderr while the output is streamed, a full pipe
+    # would block the command
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(
+            _normalize(args),
+            stdout=subprocess.PIPE,
+            stderr=devnull,
+            close_fds=True,
+        )
+    try:
+        for line in iter(proc.stdout.readline, ''):
+            yield line
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+# Used when zfscached is not available
+_remote_cache = RemoteSnapshotCache()
+
+
+def remote_snapshots(remotes, ttl=None):
+    """
+    Get the names of the snapshots on remote hosts, through zfscached
+    if available
+
+    ``remotes`` is a list of dict with hostname, port and user keys.
+
+    Returns:
+        list of frozenset, in the same order as ``remotes``
+    """
+    remotes = list(remotes)
+    if not remotes:
+        return []
+    try:
+        rv = unixsock_call(
+            SOCKFILE,
+            'remote_snapshots',
+            timeout=QUERY_TIMEOUT,
+            remotes=remotes,
+            ttl=ttl,
+        )
+        return [frozenset(n.encode('utf8') for n in names) for names in rv]
+    except socket.timeout:
+        log.warn("zfscached remote query timed out")
+    except socket.error, e:
+        log.debug("zfscached not available: %s", e)
+    except UnixSockError, e:
+        log.warn("zfscached remote query failed: %s", e)
+    return _remote_cache.get(
+        [_remote_key(remote) for remote in remotes], ttl=ttl
+    )
+
+
+def generation():
+    """
+    Get the number of invalidations issued by this process, for data
+    derived from zfs state that is kept in-process
+    """
+    return _generation
+
+
+def invalidate():
+    """
+    Tell zfscached the zfs state has changed
+    """
+    global _generation
+    _generation += 1
+    try:
+        unixsock_call(SOCKFILE, 'invalidate', timeout=5)
+    except (socket.error, UnixSockError), e:
+        log.debug("Could not invalidate zfscached: %s", e)
+
+
+def invalidates(func):
+    """
+    Decorator for methods changing the zfs state
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            invalidate()
+    return wrapper
@@ -120,7 +120,7 @@ class CIFS_ShareForm(ModelForm):
                     }
                 ))
         obj.save()
-        notifier().reload("cifs")
+        notifier().reload("cifs", wait=False)
         return obj
 
     def done(self, request, events):
@@ -239,7 +239,7 @@ class AFP_ShareForm(ModelForm):
 
     def save(self):
         ret = super(AFP_ShareForm, self).save()
-        notifier().reload("afp")
+        notifier().reload("afp", wait=False)
         return ret
 
     def done(self, request, events):
@@ -424,7 +424,7 @@ class NFS_ShareForm(ModelForm):
         super(NFS_ShareForm, self).save(*args, **kwargs)
 
     def done(self, request, events):
-        notifier().reload("nfs")
+        notifier().reload("nfs", wait=False)
         if not services.objects.get(srv_service='nfs').srv_enable:
             events.append('ask_service("nfs")')
         super(NFS_ShareForm, self).done(request, events)
@@ -127,7 +127,7 @@ class CIFS_Share(Model):
 
     def delete(self, *args, **kwargs):
         super(CIFS_Share, self).delete(*args, **kwargs)
-        notifier().reload("cifs")
+        notifier().reload("cifs", wait=False)
 
     class Meta:
         verbose_name = _("Windows (CIFS) Share")
@@ -235,7 +235,7 @@ class AFP_Share(Model):
 
     def delete(self, *args, **kwargs):
         super(AFP_Share, self).delete(*args, **kwargs)
-        notifier().reload("afp")
+        notifier().reload("afp", wait=False)
 
     class Meta:
         verbose_name = _("Apple (AFP) Share")
@@ -338,7 +338,7 @@ class NFS_Share(Model):
 
     def delete(self, *args, **kwargs):
         super(NFS_Share, self).delete(*args, **kwargs)
-        notifier().reload("nfs")
+        notifier().reload("nfs", wait=False)
 
     @property
     def nfs_paths(self):
@@ -25,8 +25,9 @@
 #
 #####################################################################
 
-from datetime import time
+from datetime import datetime, time
 import cPickle
+import json
 import logging
 import os
 import re
@@ -43,6 +44,7 @@ from freenasUI.freeadmin.models import Model, UserField
 
 log = logging.getLogger('storage.models')
 REPL_RESULTFILE = '/tmp/.repl-result'
+REPL_STATSFILE = '/tmp/.repl_stats_%d'
 
 
 class Volume(Model):
@@ -960,6 +962,38 @@ class Replication(Model):
         except:
             return None
 
+    @property
+    def repl_lastthroughput(self):
+        """
+        Bytes sent, seconds spent and snapshots replicated by the last run
+        """
+        if not os.path.exists(REPL_RESULTFILE):
+            return None
+        with open(REPL_RESULTFILE, 'rb') as f:
+            data = f.read()
+        try:
+            results = cPickle.loads(data)
+            return results['throughput'][self.id]
+        except:
+            return None
+
+    @property
+    def repl_progress(self):
+        """
+        Byte counters of the replication in progress
+        """
+        statsfile = REPL_STATSFILE % self.id
+        try:
+            with open(statsfile, 'r') as f:
+                stats = json.load(f)
+            updated = datetime.fromtimestamp(os.path.getmtime(statsfile))
+        except (IOError, OSError, ValueError):
+            return None
+        # Left behind by an interrupted run
+        if (datetime.now() - updated).total_seconds() > 60:
+            return None
+        return stats
+
     @property
     def status(self):
         progressfile = '/tmp/.repl_progress_%d' % self.id
@@ -593,7 +593,7 @@ def snapshot_delete(request, dataset, snapname):
     if request.method == 'POST':
         retval = notifier().destroy_zfs_dataset(path=str(snapshot))
         if retval == '':
-            notifier().restart("collectd")
+            notifier().reload("collectd", wait=False)
             return JsonResp(
                 request,
                 message=_("Snapshot successfully deleted."))
@@ -611,12 +611,17 @@ def snapshot_delete_bulk(request):
     snaps = request.POST.get("snaps", None)
     delete = request.POST.get("delete", None)
     if snaps and delete == "true":
-        snap_list = snaps.split('|')
-        for snapshot in snap_list:
-            retval = notifier().destroy_zfs_dataset(path=str(snapshot))
-            if retval != '':
-                return JsonResp(request, error=True, message=retval)
-        notifier().restart("collectd")
+        results = notifier().destroy_zfs_snapshots(
+            [str(snapshot) for snapshot in snaps.split('|')]
+        )
+        errors = [
+            '%s: %s' % (snapshot, err)
+            for snapshot, err in results.items() if err
+        ]
+        if len(errors) < len(results):
+            notifier().reload("collectd", wait=False)
+        if errors:
+            return JsonResp(request, error=True, message='\n'.join(errors))
         return JsonResp(request, message=_("Snapshots successfully deleted."))
 
     return render(request, 'storage/snapshot_confirm_delete_bulk.html', {
@@ -3,8 +3,11 @@ import hashlib
 import imp
 import logging
 import os
+import Queue
+import threading
 import time
 
+from django.db import connection
 from django.utils.translation import ugettext_lazy as _
 
 from freenasUI.common.system import send_mail
@@ -28,8 +31,11 @@ class BaseAlert(object):
     __metaclass__ = BaseAlertMetaclass
 
     alert = None
+    # Minutes between two runs, 0 to run every time alerts are checked
     interval = 0
     name = None
+    # Seconds the module is given to run before its result is given up
+    timeout = 60
 
     def __init__(self, alert):
         self.alert = alert
@@ -97,6 +103,7 @@ class AlertPlugins:
     __metaclass__ = HookMetaclass
 
     ALERT_FILE = '/var/tmp/alert'
+    MAX_WORKERS = 4
 
     def __init__(self):
         self.basepath = os.path.abspath(
@@ -104,6 +111,8 @@ class AlertPlugins:
         )
         self.modspath = os.path.join(self.basepath, 'alertmods/')
         self.mods = []
+        # Threads of modules still running, by module name
+        self._inflight = {}
 
     def rescan(self):
         self.mods = []
@@ -136,6 +145,41 @@ class AlertPlugins:
         send_mail(subject=_("Critical Alerts").encode('utf8'),
                   text='\n'.join(msgs))
 
+    def _run_module(self, instance, done):
+        start = time.time()
+        rv = error = None
+        try:
+            rv = instance.run()
+        except Exception, e:
+            log.error("Alert module '%s' failed: %s", instance, e)
+            error = e
+        finally:
+            # Modules querying the database got a connection for this thread
+            connection.close()
+            if self._inflight.get(instance.name) is threading.current_thread():
+                del self._inflight[instance.name]
+        done.put((instance, rv, error, time.time() - start))
+
+    def due(self, results, now=None):
+        """
+        Get the modules whose next run, as scheduled by their interval,
+        has come
+        """
+        if now is None:
+            now = time.time()
+        mods = []
+        for instance in self.mods:
+            result = results.get(instance.name)
+            if result is None:
+                mods.append(instance)
+                continue
+            nextrun = result.get('nextrun')
+            if nextrun is None:
+                nextrun = result.get('lastrun', 0) + instance.interval * 60
+            if nextrun <= now:
+                mods.append(instance)
+        return mods
+
     def run(self):
 
         obj = None
@@ -150,25 +194,83 @@ class AlertPlugins:
             results = {}
         else:
             results = obj['results']
+
+        def record(instance, status, rv, duration):
+            now = time.time()
+            result = results.get(instance.name) or {}
+            if status == 'OK':
+                result['alerts'] = rv
+            else:
+                # Keep the alerts of the last successful run
+                result.setdefault('alerts', None)
+            result.update({
+                'lastrun': int(now),
+                'nextrun': now + max(
+                    instance.interval * 60,
+                    # Do not hammer a module that just gave up
+                    instance.timeout if status == 'TIMEOUT' else 0,
+                ),
+                'duration': duration,
+                'status': status,
+            })
+            results[instance.name] = result
+
+        # Due modules run concurrently, at most MAX_WORKERS at a time, each
+        # given up after its own timeout without holding the others back
+        pending = self.due(results)
+        running = {}
+        done = Queue.Queue()
+        while pending or running:
+            while pending and len(running) < self.MAX_WORKERS:
+                instance = pending.pop(0)
+                if instance.name in self._inflight:
+                    log.warn(
+                        "Alert module '%s' still running from a previous "
+                        "check, skipping", instance.name,
+                    )
+                    continue
+                thread = threading.Thread(
+                    target=self._run_module, args=(instance, done),
+                )
+                thread.daemon = True
+                self._inflight[instance.name] = thread
+                running[instance] = (time.time(), instance.timeout)
+                thread.start()
+
+            if not running:
+                continue
+            wait = min(
+                start + timeout for start, timeout in running.values()
+            ) - time.time()
+            try:
+                instance, rv, error, duration = done.get(
+                    timeout=max(wait, 0.01)
+                )
+            except Queue.Empty:
+                now = time.time()
+                for instance, (start, timeout) in running.items():
+                    if start + timeout <= now:
+                        log.error(
+                            "Alert module '%s' timed out after %ds",
+                            instance.name, timeout,
+                        )
+                        del running[instance]
+                        record(instance, 'TIMEOUT', None, now - start)
+                continue
+            if instance not in running:
+                # Finished after it was given up
+                continue
+            del running[instance]
+            if error is not None:
+                record(instance, 'ERROR', None, duration)
+            else:
+                record(instance, 'OK', rv, duration)
+
         rvs = []
         for instance in self.mods:
-            try:
-                if instance.name in results:
-                    if results.get(instance.name).get(
-                        'lastrun'
-                    ) > time.time() - (instance.interval * 60):
-                        rvs.extend(results.get(instance.name).get('alerts'))
-                        continue
-                rv = instance.run()
-                if rv:
-                    rvs.extend(filter(None, rv))
-                results[instance.name] = {
-                    'lastrun': int(time.time()),
-                    'alerts': rv,
-                }
-
-            except Exception, e:
-                log.error("Alert module '%s' failed: %s", instance, e)
+            result = results.get(instance.name)
+            if result and result.get('alerts'):
+                rvs.extend(filter(None, result['alerts']))
 
         crits = sorted([a for a in rvs if a and a.getLevel() == Alert.CRIT])
         if obj and crits:
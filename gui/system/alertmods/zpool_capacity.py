@@ -1,7 +1,6 @@
-import subprocess
-
 from django.utils.translation import ugettext as _
 
+from freenasUI.middleware import zfscache
 from freenasUI.system.alert import alertPlugins, Alert, BaseAlert
 from freenasUI.storage.models import Volume
 
@@ -11,14 +10,13 @@ class ZpoolCapAlert(BaseAlert):
     def run(self):
         alerts = []
         for vol in Volume.objects.filter(vol_fstype='ZFS'):
-            proc = subprocess.Popen([
+            returncode, data = zfscache.zfs_command([
                 "/sbin/zpool",
                 "list",
                 "-H",
                 vol.vol_name.encode('utf8'),
-            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            data = proc.communicate()[0]
-            if proc.returncode != 0:
+            ])
+            if returncode != 0:
                 continue
             try:
                 cap = int(data.split('\t')[4].replace('%', ''))
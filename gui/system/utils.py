@@ -153,6 +153,28 @@ class UpdateHandler(object):
             )
         self.dump()
 
+    def get_download_handler(
+        self, method, filename, size=None, progress=None, download_rate=None
+    ):
+        """
+        Packages are downloaded concurrently, progress is for all
+        of them together.
+        """
+        filename = filename.rsplit('/', 1)[-1]
+        self.step = 1
+        if progress is not None:
+            self.progress = progress or 1
+            self.details = '%s %s<br />%s(%d%%)%s' % (
+                _('Downloading'),
+                filename,
+                '%s ' % humanize_size(size)
+                if size else '',
+                progress,
+                '  %s/s' % humanize_size(download_rate)
+                if download_rate else '',
+            )
+        self.dump()
+
     def install_handler(self, index, name, packages):
         if self.apply:
             self.step = 2
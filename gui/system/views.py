@@ -1249,8 +1249,7 @@ def update_check(request):
                         DownloadUpdate(
                             updateobj.get_train(),
                             path,
-                            check_handler=handler.get_handler,
-                            get_handler=handler.get_file_handler,
+                            get_handler=handler.get_download_handler,
                         )
                     log.debug("Update/DownloadUpdate finished")
                 except Exception, e:
@@ -1302,7 +1301,11 @@ def update_verify(request):
         handler = VerifyHandler()
         try:
             log.debug("Starting VerifyUpdate")
-            error_flag, ed, warn_flag, wl = Configuration.do_verify(handler.verify_handler)
+            # Forking worker processes off the threaded fcgi server is
+            # not safe, hash the files in this thread.
+            error_flag, ed, warn_flag, wl = Configuration.do_verify(
+                handler.verify_handler, workers=1,
+            )
         except Exception, e:
             log.debug("VerifyUpdate Exception ApplyUpdate: %s" %e)
             handler.error = unicode(e)
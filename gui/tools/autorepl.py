@@ -29,8 +29,11 @@ import cPickle
 import datetime
 import logging
 import os
+import shlex
 import subprocess
 import sys
+import threading
+import time
 
 sys.path.extend([
     '/usr/local/www',
@@ -43,12 +46,17 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
 from django.db.models.loading import cache
 cache.get_apps()
 
+from django.db import connection
+
 from freenasUI.freeadmin.apppool import appPool
-from freenasUI.storage.models import Replication, REPL_RESULTFILE
+from freenasUI.storage.models import (
+    Replication, REPL_RESULTFILE, REPL_STATSFILE,
+)
 from freenasUI.common.timesubr import isTimeBetween
 from freenasUI.common.pipesubr import pipeopen, system
 from freenasUI.common.locks import mntlock
 from freenasUI.common.system import send_mail
+from freenasUI.middleware import replstream
 
 # DESIGN NOTES
 #
@@ -63,6 +71,53 @@ log = logging.getLogger('tools.autorepl')
 # Set to True if verbose log desired
 debug = False
 
+# Replication tasks running at the same time, overall and per remote host
+MAX_STREAMS = 4
+MAX_STREAMS_PER_REMOTE = 2
+
+# Commands sent to the same remote share one ssh connection, kept open
+# for the next runs
+SSH_CONTROLPATH = '/var/run/.autorepl-ssh-%s-%%r@%%h:%%p'
+SSH_CONTROLPERSIST = 300
+
+
+class ThreadedLock(object):
+    """
+    flock(2) locks are held per process, serialize our threads as well
+    """
+
+    def __init__(self, lock):
+        self._lock = lock
+        self._tlock = threading.Lock()
+
+    def lock(self):
+        self._tlock.acquire()
+        try:
+            self._lock.lock()
+        except:
+            self._tlock.release()
+            raise
+
+    def lock_try(self):
+        if not self._tlock.acquire(False):
+            raise IOError("Lock held by another thread")
+        try:
+            self._lock.lock_try()
+        except:
+            self._tlock.release()
+            raise
+
+    def unlock(self):
+        self._lock.unlock()
+        self._tlock.release()
+
+    def __enter__(self):
+        self.lock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlock()
+
 # Detect if another instance is running
 def exit_if_running(pid):
     log.debug("Checking if process %d is still alive" % (pid, ))
@@ -76,10 +131,9 @@ def exit_if_running(pid):
 
 appPool.hook_tool_run('autorepl')
 
-MNTLOCK = mntlock()
+MNTLOCK = ThreadedLock(mntlock())
 
 mypid = os.getpid()
-templog = '/tmp/repl-%d' % (mypid)
 
 now = datetime.datetime.now().replace(microsecond=0)
 if now.second < 30 or now.minute == 59:
@@ -115,7 +169,6 @@ MNTLOCK.unlock()
 # At this point, we are sure that only one autorepl instance is running.
 
 log.debug("Autosnap replication started")
-log.debug("temp log file: %s" % (templog, ))
 
 try:
     with open(REPL_RESULTFILE, 'rb') as f:
@@ -124,15 +177,67 @@ try:
 except:
     results = {}
 
-# Traverse all replication tasks
-replication_tasks = Replication.objects.all()
-for replication in replication_tasks:
-    if not isTimeBetween(now, replication.repl_begin, replication.repl_end):
-        continue
+# Replication of each task
+#
+# The tasks run concurrently, see the scheduler at the bottom.
+
+SSH_MASTERS = set()
+SSH_MASTERS_LOCKS = {}
+SSH_MASTERS_LOCK = threading.Lock()
+
+
+def ssh_master(sshcmd, port, remote):
+    """
+    Make sure a master connection is open for ``sshcmd``, the other
+    commands are multiplexed over it or connect on their own otherwise
+    """
+    key = (sshcmd, port, remote)
+    # Connecting may take a while, only hold up the tasks sharing it
+    with SSH_MASTERS_LOCK:
+        lock = SSH_MASTERS_LOCKS.setdefault(key, threading.Lock())
+    with lock:
+        if key in SSH_MASTERS:
+            return
+        SSH_MASTERS.add(key)
+        args = sshcmd.split() + ['-p', str(port)]
+        with open(os.devnull, 'r+') as devnull:
+            # A master kept from a previous run
+            if subprocess.call(
+                args + ['-O', 'check', remote],
+                stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True,
+            ) == 0:
+                return
+            # The backgrounded master must not hold our pipes open
+            subprocess.call(
+                args + [
+                    '-o', 'ControlMaster=yes',
+                    '-o', 'ControlPersist=%d' % SSH_CONTROLPERSIST,
+                    '-f', '-N', remote,
+                ],
+                stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True,
+            )
 
-    if not replication.repl_enabled:
-        log.warn("%s replication not enabled" % replication)
-        continue
+
+def mark_replicated(replicated, latest):
+    """
+    Release the ``replicated`` snapshots and mark ``latest`` as the one
+    the next replication starts from
+    """
+    with MNTLOCK:
+        if replicated:
+            system('/sbin/zfs inherit freenas:state %s' % (' '.join(replicated)))
+            system('/sbin/zfs release -r freenas:repl %s' % (' '.join(replicated)))
+        system('/sbin/zfs set freenas:state=LATEST %s' % (latest))
+        #
+        # Place a hold.  This is harmless when it's already held but important if
+        # there is no hold.
+        #
+        system('/sbin/zfs hold -r freenas:repl %s' % (latest))
+
+
+def replicate(replication, results, throughput):
 
     remote = replication.repl_remote.ssh_remote_hostname.__str__()
     remote_port = replication.repl_remote.ssh_remote_port
@@ -168,10 +273,8 @@ for replication in replication_tasks:
             dedicateduser.encode('utf-8'),
             )
 
-    if replication.repl_userepl:
-        Rflag = '-R '
-    else:
-        Rflag = ''
+    sshcmd = '%s -o ControlPath=%s' % (sshcmd, SSH_CONTROLPATH % cipher)
+    ssh_master(sshcmd, remote_port, remote)
 
     wanted_list = []
     known_latest_snapshot = ''
@@ -181,72 +284,64 @@ for replication in replication_tasks:
 
     if len(localfs_split) > 1:
         remotefs_final = "%s/%s" % (remotefs, "/".join(localfs_split[1:]))
-        if len(localfs_split) > 2:
-            remotefs_parent = "%s/%s" % (remotefs, "/".join(localfs_split[1:-1]))
-        else:
-            remotefs_parent = "%s/%s" % (remotefs, localfs_split[1])
     else:
         remotefs_final = remotefs
-        remotefs_parent = remotefs
 
     # Test if there is work to do, if so, own them
-    MNTLOCK.lock()
-    log.debug("Checking dataset %s" % (localfs))
-    zfsproc = pipeopen('/sbin/zfs list -Ht snapshot -o name,freenas:state -r -d 1 %s' % (localfs), debug)
-    output, error = zfsproc.communicate()
-    if zfsproc.returncode:
-        log.warn('Could not determine last available snapshot for dataset %s: %s' % (
-            localfs,
-            error,
-            ))
-        MNTLOCK.unlock()
-        continue
-    if output != '':
-        snapshots_list = output.split('\n')
-        snapshots_list.reverse()
-        found_latest = False
-        for snapshot_item in snapshots_list:
-            if snapshot_item != '':
-                snapshot, state = snapshot_item.split('\t')
-                if found_latest:
-                    # assert (known_latest_snapshot != '') because found_latest
-                    if state != '-':
-                        system('/sbin/zfs set freenas:state=NEW %s' % (known_latest_snapshot))
-                        system('/sbin/zfs set freenas:state=LATEST %s' % (snapshot))
-                        system('/sbin/zfs hold -r freenas:repl %s' % (known_latest_snapshot))
-                        system('/sbin/zfs hold -r freenas:repl %s' % (snapshot))
-                        wanted_list.insert(0, known_latest_snapshot)
-                        log.debug("Snapshot %s added to wanted list (was LATEST)" % (snapshot))
-                        known_latest_snapshot = snapshot
-                        log.warn("Snapshot %s became latest snapshot" % (snapshot))
-                else:
-                    log.debug("Snapshot: %s State: %s" % (snapshot, state))
-                    if state == 'LATEST' and not resetonce:
-                        found_latest = True
-                        known_latest_snapshot = snapshot
-                        log.debug("Snapshot %s is the recorded latest snapshot" % (snapshot))
-                    elif state == 'NEW' or resetonce:
-                        wanted_list.insert(0, snapshot)
-                        log.debug("Snapshot %s added to wanted list" % (snapshot))
-                    elif state.startswith('INPROGRESS'):
-                        # For compatibility with older versions
-                        wanted_list.insert(0, snapshot)
-                        system('/sbin/zfs set freenas:state=NEW %s' % (snapshot))
-                        system('/sbin/zfs hold -r freenas:repl %s' % (snapshot))
-                        log.debug("Snapshot %s added to wanted list (stale)" % (snapshot))
-                    elif state == '-':
-                        # The snapshot is already replicated, or is not
-                        # an automated snapshot.
-                        log.debug("Snapshot %s unwanted" % (snapshot))
+    with MNTLOCK:
+        log.debug("Checking dataset %s" % (localfs))
+        zfsproc = pipeopen('/sbin/zfs list -Ht snapshot -o name,freenas:state -r -d 1 %s' % (localfs), debug)
+        output, error = zfsproc.communicate()
+        if zfsproc.returncode:
+            log.warn('Could not determine last available snapshot for dataset %s: %s' % (
+                localfs,
+                error,
+                ))
+            return
+        if output != '':
+            snapshots_list = output.split('\n')
+            snapshots_list.reverse()
+            found_latest = False
+            for snapshot_item in snapshots_list:
+                if snapshot_item != '':
+                    snapshot, state = snapshot_item.split('\t')
+                    if found_latest:
+                        # assert (known_latest_snapshot != '') because found_latest
+                        if state != '-':
+                            system('/sbin/zfs set freenas:state=NEW %s' % (known_latest_snapshot))
+                            system('/sbin/zfs set freenas:state=LATEST %s' % (snapshot))
+                            system('/sbin/zfs hold -r freenas:repl %s' % (known_latest_snapshot))
+                            system('/sbin/zfs hold -r freenas:repl %s' % (snapshot))
+                            wanted_list.insert(0, known_latest_snapshot)
+                            log.debug("Snapshot %s added to wanted list (was LATEST)" % (snapshot))
+                            known_latest_snapshot = snapshot
+                            log.warn("Snapshot %s became latest snapshot" % (snapshot))
                     else:
-                        # This should be exception but skip for now.
-                        MNTLOCK.unlock()
-                        continue
-    MNTLOCK.unlock()
+                        log.debug("Snapshot: %s State: %s" % (snapshot, state))
+                        if state == 'LATEST' and not resetonce:
+                            found_latest = True
+                            known_latest_snapshot = snapshot
+                            log.debug("Snapshot %s is the recorded latest snapshot" % (snapshot))
+                        elif state == 'NEW' or resetonce:
+                            wanted_list.insert(0, snapshot)
+                            log.debug("Snapshot %s added to wanted list" % (snapshot))
+                        elif state.startswith('INPROGRESS'):
+                            # For compatibility with older versions
+                            wanted_list.insert(0, snapshot)
+                            system('/sbin/zfs set freenas:state=NEW %s' % (snapshot))
+                            system('/sbin/zfs hold -r freenas:repl %s' % (snapshot))
+                            log.debug("Snapshot %s added to wanted list (stale)" % (snapshot))
+                        elif state == '-':
+                            # The snapshot is already replicated, or is not
+                            # an automated snapshot.
+                            log.debug("Snapshot %s unwanted" % (snapshot))
+                        else:
+                            # This should be exception but skip for now.
+                            continue
 
     # If there is nothing to do, go through next replication entry
     if len(wanted_list) == 0:
-        continue
+        return
 
     if known_latest_snapshot != '' and not resetonce:
         # Check if it matches remote snapshot
@@ -265,31 +360,29 @@ for replication in replication_tasks:
             else:
                 # Do we have it locally? if yes then mark it immediately
                 log.info("Can not locate expected snapshot %s, looking more carefully" % (expected_local_snapshot))
-                MNTLOCK.lock()
-                zfsproc = pipeopen('/sbin/zfs list -Ht snapshot -o name,freenas:state %s' % (expected_local_snapshot), debug)
-                output = zfsproc.communicate()[0]
-                if output != '':
-                    last_snapshot, state = output.split('\n')[0].split('\t')
-                    log.info("Marking %s as latest snapshot" % (last_snapshot))
-                    if state == '-':
-                        system('/sbin/zfs inherit freenas:state %s' % (known_latest_snapshot))
-                        system('/sbin/zfs release -r freenas:repl %s' % (snapshot))
-                        system('/sbin/zfs set freenas:state=LATEST %s' % (last_snapshot))
-                        known_latest_snapshot = last_snapshot
-                else:
-                    log.warn("Can not locate a proper local snapshot for %s" % (localfs))
-                    # Can NOT proceed any further.  Report this situation.
-                    error, errmsg = send_mail(
-                        subject="Replication failed! (%s)" % remote,
-                        text="""
+                with MNTLOCK:
+                    zfsproc = pipeopen('/sbin/zfs list -Ht snapshot -o name,freenas:state %s' % (expected_local_snapshot), debug)
+                    output = zfsproc.communicate()[0]
+                    if output != '':
+                        last_snapshot, state = output.split('\n')[0].split('\t')
+                        log.info("Marking %s as latest snapshot" % (last_snapshot))
+                        if state == '-':
+                            system('/sbin/zfs inherit freenas:state %s' % (known_latest_snapshot))
+                            system('/sbin/zfs release -r freenas:repl %s' % (snapshot))
+                            system('/sbin/zfs set freenas:state=LATEST %s' % (last_snapshot))
+                            known_latest_snapshot = last_snapshot
+                    else:
+                        log.warn("Can not locate a proper local snapshot for %s" % (localfs))
+                        # Can NOT proceed any further.  Report this situation.
+                        error, errmsg = send_mail(
+                            subject="Replication failed! (%s)" % remote,
+                            text="""
 Hello,
     The replication failed for the local ZFS %s because the remote system
     has diverged snapshots with us.
-                        """ % (localfs), interval=datetime.timedelta(hours=2), channel='autorepl')
-                    MNTLOCK.unlock()
-                    results[replication.id] = 'Remote system has diverged snapshots with us'
-                    continue
-                MNTLOCK.unlock()
+                            """ % (localfs), interval=datetime.timedelta(hours=2), channel='autorepl')
+                        results[replication.id] = 'Remote system has diverged snapshots with us'
+                        return
         elif sshproc.returncode == 0:
             log.log(logging.NOTICE, "Can not locate %s on remote system, starting from there" % (known_latest_snapshot))
             # Reset the "latest" snapshot to a new one.
@@ -309,7 +402,7 @@ Hello,
     have returned an error code of %d
                         """ % (localfs, sshcmd, sshproc.returncode,), interval=datetime.timedelta(hours=2), channel='autorepl')
             results[replication.id] = 'SSH Failed'
-            continue
+            return
 
     if resetonce:
         log.log(logging.NOTICE, "Destroying remote %s" % (remotefs_final))
@@ -319,12 +412,22 @@ Hello,
 
     last_snapshot = known_latest_snapshot
 
-    for snapname in wanted_list:
-        local_fs, local_snap = snapname.split('@')
-        if replication.repl_limit != 0:
-            limit = '/usr/local/bin/throttle -K %d | ' % replication.repl_limit
+    templog = '/tmp/repl-%d-%d' % (mypid, replication.id)
+    progressfile = '/tmp/.repl_progress_%d' % replication.id
+    meter = replstream.StreamMeter(REPL_STATSFILE % replication.id)
+    sent_snapshots = 0
+
+    # The wanted snapshots follow each other, a single -I stream from the
+    # latest replicated one carries all of them. Fall back to one stream
+    # per snapshot if only part of them made it.
+    collapse = True
+    pending = list(wanted_list)
+    while pending:
+        if last_snapshot == '' or not collapse:
+            snapname = pending[0]
         else:
-            limit = ''
+            snapname = pending[-1]
+        local_fs, local_snap = snapname.split('@')
         cmd = ['/sbin/zfs', 'send', '-V']
         if replication.repl_userepl:
             cmd.append('-R')
@@ -333,83 +436,55 @@ Hello,
         else:
             cmd.extend(['-I', last_snapshot, snapname])
 
-        progressfile = '/tmp/.repl_progress_%d' % replication.id
-        # subprocess.Popen does not handle large stream of data between
-        # processes very well, do it on our own
-        readfd, writefd = os.pipe()
-        zproc_pid = os.fork()
-        if zproc_pid == 0:
-            os.close(readfd)
-            os.dup2(writefd, 1)
-            os.close(writefd)
-            os.execv('/sbin/zfs', cmd)
-            # NOTREACHED
-        else:
-            with open(progressfile, 'w') as f2:
-                f2.write(str(zproc_pid))
-            os.close(writefd)
-
-        if compression == 'pigz':
-            compress = '/usr/local/bin/pigz | '
-            decompress = '/usr/local/bin/pigz -d | '
-        elif compression == 'plzip':
-            compress = '/usr/local/bin/plzip | '
-            decompress = '/usr/local/bin/plzip -d | '
-        elif compression == 'lz4':
-            compress = '/usr/local/bin/lz4c | '
-            decompress = '/usr/local/bin/lz4c -d | '
-        else: #off
-            compress = ''
-            decompress = ''
-
-        replcmd = '%s%s/bin/dd obs=1m 2> /dev/null | /bin/dd obs=1m 2> /dev/null | %s -p %d %s "%s/sbin/zfs receive -F -d %s && echo Succeeded"' % (compress, limit, sshcmd, remote_port, remote, decompress, remotefs)
+        meter.start(snapname)
         with open(templog, 'w+') as f:
-            readobj = os.fdopen(readfd, 'r', 0)
-            proc = subprocess.Popen(
-                replcmd,
-                shell=True,
-                stdin=readobj,
-                stdout=f,
-                stderr=subprocess.STDOUT,
+            replstream.send(
+                cmd,
+                shlex.split(sshcmd) + ['-p', str(remote_port), remote],
+                '/sbin/zfs receive -F -d %s && echo Succeeded' % remotefs,
+                f,
+                limit=replication.repl_limit,
+                compression=compression,
+                meter=meter,
+                pidfile=progressfile,
             )
-            proc.wait()
-            os.waitpid(zproc_pid, os.WNOHANG)
-            readobj.close()
-            os.remove(progressfile)
             f.seek(0)
             msg = f.read().strip('\n').strip('\r')
+        meter.stop()
         os.remove(templog)
         log.debug("Replication result: %s" % (msg))
         msg = msg.replace('WARNING: enabled NONE cipher\n', '')
         results[replication.id] = msg
 
-        # Determine if the remote side have the snapshot we have now.
+        # Determine which of the wanted snapshots the remote side have now.
+        sent = [s.split('@')[1] for s in pending[:pending.index(snapname) + 1]]
         rzfscmd = '"zfs list -Hr -o name -t snapshot -d 1 %s | tail -n 1 | cut -d@ -f2"' % (remotefs_final)
         sshproc = pipeopen('%s -p %d %s %s' % (sshcmd, remote_port, remote, rzfscmd))
         output = sshproc.communicate()[0]
         if output != '':
             remote_snap = output.split('\n')[0]
-            if local_snap == remote_snap:
-                system('%s -p %d %s "/sbin/zfs inherit freenas:state %s@%s"' % (sshcmd, remote_port, remote, remotefs_final, remote_snap))
+            if remote_snap in sent:
+                done = pending[:sent.index(remote_snap) + 1]
+                system('%s -p %d %s "/sbin/zfs inherit freenas:state %s"' % (sshcmd, remote_port, remote, ' '.join(
+                    '%s@%s' % (remotefs_final, s.split('@')[1]) for s in done
+                )))
                 # system('%s -p %d %s "/sbin/zfs hold -r freenas:repl %s@%s"' % (sshcmd, remote_port, remote, remotefs_final, remote_snap))
                 # TODO: release all older snapshots
                 # Replication was successful, mark as such
-                MNTLOCK.lock()
+                replicated = done[:-1]
                 if last_snapshot != '':
-                    system('/sbin/zfs inherit freenas:state %s' % (last_snapshot))
-                    system('/sbin/zfs release -r freenas:repl %s' % (last_snapshot))
-                last_snapshot = snapname
-                system('/sbin/zfs set freenas:state=LATEST %s' % (last_snapshot))
-                #
-                # Place a hold.  This is harmless when it's already held but important if
-                # there is no hold.
-                #
-                system('/sbin/zfs hold -r freenas:repl %s' % (last_snapshot))
-                MNTLOCK.unlock()
+                    replicated.insert(0, last_snapshot)
+                last_snapshot = done[-1]
+                mark_replicated(replicated, last_snapshot)
                 replication.repl_lastsnapshot = last_snapshot
                 if resetonce:
                     replication.repl_resetonce = False
                 replication.save()
+                sent_snapshots += len(done)
+                if last_snapshot != snapname:
+                    log.warn("Only %s out of %s made it to the remote side, sending one at a time" % (last_snapshot, snapname))
+                    collapse = False
+                pending = pending[len(done):]
                 continue
             else:
                 log.warn("Remote and local mismatch after replication: %s: local=%s vs remote=%s" % (local_fs, local_snap, remote_snap))
@@ -421,11 +496,19 @@ Hello,
                     if expected_local_snapshot == snapname:
                         log.warn("Snapshot %s already exist on remote, marking as such" % (snapname))
                         system('%s -p %d %s "/sbin/zfs inherit -r freenas:state %s"' % (sshcmd, remote_port, remote, remotefs_final))
-                        # Replication was successful, mark as such
-                        MNTLOCK.lock()
-                        system('/sbin/zfs inherit freenas:state %s' % (snapname))
-                        system('/sbin/zfs release -r freenas:repl %s' % (snapname))
-                        MNTLOCK.unlock()
+                        # Replication was successful, mark as such, the
+                        # snapshots up to snapname are on the remote side
+                        done = pending[:pending.index(snapname) + 1]
+                        replicated = done[:-1]
+                        if last_snapshot != '':
+                            replicated.insert(0, last_snapshot)
+                        last_snapshot = snapname
+                        mark_replicated(replicated, last_snapshot)
+                        replication.repl_lastsnapshot = last_snapshot
+                        if resetonce:
+                            replication.repl_resetonce = False
+                        replication.save()
+                        pending = pending[len(done):]
                         continue
 
         # Something wrong, report.
@@ -439,6 +522,87 @@ Hello,
             """ % (localfs, remote, msg), interval=datetime.timedelta(hours=2), channel='autorepl')
         break
 
+    meter.clear()
+    if meter.seconds:
+        throughput[replication.id] = {
+            'bytes': meter.bytes,
+            'seconds': meter.seconds,
+            'snapshots': sent_snapshots,
+            'bytes_per_second': meter.rate,
+            'finished': time.time(),
+        }
+
+
+def run(replication, remote_slots):
+    with remote_slots:
+        with STREAMS:
+            try:
+                replicate(replication, results, results['throughput'])
+            except Exception, e:
+                log.error("Replication %s failed: %s", replication, e, exc_info=True)
+                results[replication.id] = 'Failed: %s' % e
+            finally:
+                # Each thread has got its own database connection
+                connection.close()
+
+
+def run_chain(chain):
+    for replication, slots in chain:
+        run(replication, slots)
+
+
+def overlaps(fs1, fs2):
+    """
+    Whether datasets ``fs1`` and ``fs2`` are the same or one contains
+    the other, such tasks share snapshots and their freenas:state
+    """
+    return (fs1 == fs2 or fs1.startswith(fs2 + '/') or
+            fs2.startswith(fs1 + '/'))
+
+
+# Traverse all replication tasks, independent ones run concurrently
+# within the limits of MAX_STREAMS overall and MAX_STREAMS_PER_REMOTE
+# for each remote host.  Tasks on the same or nested datasets run one
+# after the other in the same thread.
+STREAMS = threading.BoundedSemaphore(MAX_STREAMS)
+remote_slots = {}
+chains = []
+threads = []
+results.setdefault('throughput', {})
+for replication in Replication.objects.select_related('repl_remote'):
+    if not isTimeBetween(now, replication.repl_begin, replication.repl_end):
+        continue
+
+    if not replication.repl_enabled:
+        log.warn("%s replication not enabled" % replication)
+        continue
+
+    key = (
+        replication.repl_remote.ssh_remote_hostname,
+        replication.repl_remote.ssh_remote_port,
+    )
+    if key not in remote_slots:
+        remote_slots[key] = threading.BoundedSemaphore(MAX_STREAMS_PER_REMOTE)
+
+    localfs = replication.repl_filesystem.__str__()
+    chain = []
+    for other in chains[:]:
+        if any(
+            overlaps(localfs, r.repl_filesystem.__str__()) for r, _ in other
+        ):
+            chains.remove(other)
+            chain.extend(other)
+    chain.append((replication, remote_slots[key]))
+    chains.append(chain)
+
+for chain in chains:
+    thread = threading.Thread(target=run_chain, args=(chain, ))
+    thread.start()
+    threads.append(thread)
+
+for thread in threads:
+    thread.join()
+
 with open(REPL_RESULTFILE, 'w') as f:
     f.write(cPickle.dumps(results))
 os.remove('/var/run/autorepl.pid')
@@ -27,7 +27,6 @@
 
 import logging
 import os
-import re
 import sys
 import uuid
 sys.path.append('/usr/local/www')
@@ -41,11 +40,13 @@ cache.get_apps()
 
 from freenasUI.freeadmin.apppool import appPool
 from freenasUI.storage.models import Task, Replication
-from datetime import datetime, time, timedelta
+from datetime import datetime, time
 
 from freenasUI.common.pipesubr import pipeopen
 from freenasUI.common.timesubr import isTimeBetween
 from freenasUI.common.locks import mntlock
+from freenasUI.middleware import zfscache
+from freenasUI.middleware.autosnap import RetentionPlanner
 from freenasUI.system.models import VMWarePlugin
 
 log = logging.getLogger('tools.autosnap')
@@ -63,32 +64,6 @@ MNTLOCK=mntlock()
 # Set to True if verbose log desired
 debug = False
 
-def snapinfodict2datetime(snapinfo):
-    year = int(snapinfo['year'])
-    month = int(snapinfo['month'])
-    day = int(snapinfo['day'])
-    hour = int(snapinfo['hour'])
-    minute = int(snapinfo['minute'])
-    return datetime(year, month, day, hour, minute)
-
-def snap_expired(snapinfo, snaptime):
-    snapinfo_expirationtime = snapinfodict2datetime(snapinfo)
-    snap_ttl_value = int(snapinfo['retcount'])
-    snap_ttl_unit = snapinfo['retunit']
-
-    if snap_ttl_unit == 'h':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(hours = snap_ttl_value)
-    elif snap_ttl_unit == 'd':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days = snap_ttl_value)
-    elif snap_ttl_unit == 'w':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days = 7*snap_ttl_value)
-    elif snap_ttl_unit == 'm':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days = int(30.436875*snap_ttl_value))
-    elif snap_ttl_unit == 'y':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days = int(365.2425*snap_ttl_value))
-
-    return snapinfo_expirationtime <= snaptime
-
 def isMatchingTime(task, snaptime):
     curtime = time(snaptime.hour, snaptime.minute)
     repeat_type = task.task_repeat_unit
@@ -174,51 +149,21 @@ for task in TaskObjects:
             tasklist = [task]
         mp_to_task_map[(fs, expire_time)] = tasklist
 
-re_path = re.compile("^((" + '|'.join(taskpath['nonrecursive']) +
-                     ")@|(" + '|'.join(taskpath['recursive']) + ")[@/])")
 # Only proceed further if we are  going to generate any snapshots for this run
 if len(mp_to_task_map) > 0:
 
-    # Grab all existing snapshot and filter out the expiring ones
-    snapshots = {}
-    snapshots_pending_delete = set()
-    zfsproc = pipeopen("/sbin/zfs list -t snapshot -H", debug, logger=log)
-    lines = zfsproc.communicate()[0].split('\n')
-    reg_autosnap = re.compile('^auto-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2}).(?P<hour>\d{2})(?P<minute>\d{2})-(?P<retcount>\d+)(?P<retunit>[hdwmy])$')
-    for line in lines:
-        if line != '':
-            snapshot_name = line.split('\t')[0]
-            fs, snapname = snapshot_name.split('@')
-            snapname_match = reg_autosnap.match(snapname)
-            if snapname_match != None:
-                snap_infodict = snapname_match.groupdict()
-                snap_ret_policy = '%s%s' % (snap_infodict['retcount'], snap_infodict['retunit'])
-                if snap_expired(snap_infodict, snaptime):
-                    # Only delete the snapshot if there's a snapshot task enabled that created it.
-                    if re_path:
-                        if re_path.match(snapshot_name):
-                            snapshots_pending_delete.add(snapshot_name)
-                else:
-                    if mp_to_task_map.has_key((fs, snap_ret_policy)):
-                        if snapshots.has_key((fs, snap_ret_policy)):
-                            last_snapinfo = snapshots[(fs, snap_ret_policy)]
-                            if snapinfodict2datetime(last_snapinfo) < snapinfodict2datetime(snap_infodict):
-                                snapshots[(fs, snap_ret_policy)] = snap_infodict
-                        else:
-                            snapshots[(fs, snap_ret_policy)] = snap_infodict
-
-    list_mp = mp_to_task_map.keys()
-
-    for mpkey in list_mp:
-        tasklist = mp_to_task_map[mpkey]
-        if snapshots.has_key(mpkey):
-            snapshot_time = snapinfodict2datetime(snapshots[mpkey])
-            for taskindex in range(len(tasklist) -1, -1, -1):
-                task = tasklist[taskindex]
-                if snapshot_time + timedelta(minutes = task.task_interval) > snaptime:
-                    del tasklist[taskindex]
-            if len(tasklist) == 0:
-                del mp_to_task_map[mpkey]
+    # Grab all existing snapshots once, indexed by the planner
+    planner = RetentionPlanner(
+        snaptime,
+        mp_to_task_map.keys(),
+        recursive=taskpath['recursive'],
+        nonrecursive=taskpath['nonrecursive'],
+    )
+    planner.load(zfscache.zfs_lines([
+        "/sbin/zfs", "list", "-t", "snapshot", "-H",
+        "-o", "name,freenas:state",
+    ], maxage=0))
+    planner.due(mp_to_task_map)
 
     snaptime_str = snaptime.strftime('%Y%m%d.%H%M')
 
@@ -285,19 +230,32 @@ if len(mp_to_task_map) > 0:
             vm.delete_named_snapshot(vmsnapname)
 
     MNTLOCK.lock()
-    for snapshot in snapshots_pending_delete:
-        # TODO: Future versions will have freenas:state removed in favor of holds.
-        zfsproc = pipeopen('/sbin/zfs get -H freenas:state %s' % (snapshot, ), logger=log)
-        output = zfsproc.communicate()[0]
-        if output != '':
-            fsname, attrname, value, source = output.split('\n')[0].split('\t')
-            if value == '-':
-                snapcmd = '/sbin/zfs destroy -r -d %s' % (snapshot) #snapshots with clones will have destruction deferred
-                proc = pipeopen(snapcmd, logger=log)
-                err = proc.communicate()[1]
-                if proc.returncode != 0:
-                    log.error("Failed to destroy snapshot '%s': %s", snapshot, err)
-    MNTLOCK.unlock()
+    try:
+        # The listing above may predate changes made by autorepl
+        dropped = planner.recheck()
+        if dropped:
+            log.debug("autosnap: %d expired snapshots now wait for "
+                      "replication", dropped)
+        planner.destroy(logger=log)
+    finally:
+        MNTLOCK.unlock()
+
+    # Report slow runs, these may overlap the next one
+    timings = planner.timings
+    elapsed = (timings['load'] + timings['due'] +
+               timings.get('recheck', 0) + timings['destroy'])
+    log.log(
+        logging.INFO if elapsed > 30 else logging.DEBUG,
+        "autosnap planner: %d snapshots loaded in %.2fs, %d expired "
+        "destroyed in %.2fs with %d commands",
+        timings['snapshots'],
+        timings['load'],
+        sum(len(v) for v in planner.expired.values()),
+        timings['destroy'],
+        timings['destroy_commands'],
+    )
+
+    zfscache.invalidate()
 
 
 os.unlink('/var/run/autosnap.pid')
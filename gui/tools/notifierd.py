@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import logging
+import logging.config
+import os
+import sys
+
+import daemon
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(HERE, ".."))
+sys.path.append(os.path.join(HERE, "../.."))
+sys.path.append('/usr/local/www')
+sys.path.append('/usr/local/www/freenasUI')
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'freenasUI.settings'
+
+# Make sure to load all modules
+from django.db.models.loading import cache
+cache.get_apps()
+
+from django.db import connection
+
+from freenasUI.common.pidfile import PidFile
+from freenasUI.common.unixsock import UnixJSONServer
+from freenasUI.middleware import notifier_client
+from freenasUI.middleware.notifier import notifier
+from freenasUI.settings import LOGGING
+
+log = logging.getLogger('tools.notifierd')
+logging.config.dictConfig(LOGGING)
+
+
+class NotifierService(object):
+    """
+    Run notifier methods for middleware/notifier_client.py
+    """
+
+    def call(self, action, args):
+        if action.startswith('_'):
+            raise ValueError("Invalid action: %s" % action)
+        try:
+            f = getattr(notifier(), action, None)
+            if f is None:
+                raise ValueError("Unknown action: %s" % action)
+            rv = f(*[
+                a.encode('utf8') if isinstance(a, unicode) else a
+                for a in args
+            ])
+        finally:
+            # Do not hold the database between calls
+            connection.close()
+        # Same as notifier.py printing the result
+        if isinstance(rv, unicode):
+            rv = rv.encode('utf8')
+        else:
+            rv = str(rv)
+        return rv.decode('latin-1')
+
+
+def main(argv):
+    pidfile = PidFile(notifier_client.PIDFILE)
+
+    context = daemon.DaemonContext(
+        working_directory='/root',
+        umask=0o002,
+        pidfile=pidfile,
+        stdout=sys.stdout,
+        stdin=sys.stdin,
+        stderr=sys.stderr,
+    )
+
+    with context:
+        server = UnixJSONServer(notifier_client.SOCKFILE, NotifierService())
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -51,8 +51,10 @@ def main():
     args = parser.parse_args()
     _notifier = notifier()
     if args.devs:
-        for dev in args.devs:
-            dev = dev.replace("/dev/", "")
+        devs = [dev.replace("/dev/", "") for dev in args.devs]
+        # devd reported these disks as attached, probe their serial again
+        _notifier.invalidate_serials(devs)
+        for dev in devs:
             _notifier.sync_disk(dev)
     else:
         _notifier.sync_disks()
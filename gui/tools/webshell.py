@@ -53,6 +53,7 @@ sys.path.append('/usr/local/www/freenasUI')
 
 os.environ['DJANGO_SETTINGS_MODULE'] = 'freenasUI.settings'
 
+from freenasUI.common.pidfile import PidFile
 from freenasUI.settings import LOGGING
 
 log = logging.getLogger('tools.webshell')
@@ -100,43 +101,6 @@ def main_loop():
     server.serve_forever()
 
 
-class PidFile(object):
-    """
-    Context manager that locks a pid file.
-    Implemented as class not generator because daemon.py is calling __exit__
-    with no parameters instead of the None, None, None specified by PEP-343.
-
-    Based on:
-    http://code.activestate.com/recipes/
-    577911-context-manager-for-a-daemon-pid-file/
-    """
-
-    def __init__(self, path):
-        self.path = path
-        self.pidfile = None
-
-    def __enter__(self):
-        self.pidfile = open(self.path, "a+")
-        try:
-            fcntl.flock(self.pidfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError:
-            raise SystemExit("Already running according to " + self.path)
-        self.pidfile.seek(0)
-        self.pidfile.truncate()
-        self.pidfile.write(str(os.getpid()))
-        self.pidfile.flush()
-        self.pidfile.seek(0)
-        return self.pidfile
-
-    def __exit__(self, *args, **kwargs):
-        try:
-            if os.path.exists(self.path):
-                os.unlink(self.path)
-            self.pidfile.close()
-        except IOError:
-            pass
-
-
 def main(argv):
     """Our friendly neighborhood main function."""
     pidfile = PidFile('/var/run/webshell.pid')
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+import argparse
+import logging
+import logging.config
+import os
+import sys
+import threading
+import time
+
+import daemon
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(HERE, ".."))
+sys.path.append(os.path.join(HERE, "../.."))
+sys.path.append('/usr/local/www')
+sys.path.append('/usr/local/www/freenasUI')
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'freenasUI.settings'
+
+from freenasUI.common.pidfile import PidFile
+from freenasUI.common.unixsock import UnixJSONServer
+from freenasUI.middleware import zfscache
+from freenasUI.settings import LOGGING
+
+log = logging.getLogger('tools.zfscached')
+logging.config.dictConfig(LOGGING)
+
+
+def refresh_loop(cache):
+    while True:
+        time.sleep(zfscache.REFRESH_INTERVAL)
+        try:
+            cache.tick()
+        except Exception, e:
+            log.error("Failed to refresh zfs cache: %s", e, exc_info=True)
+
+
+def main_loop(args):
+    cache = zfscache.ZFSStateCache(remote_ttl=args.remote_ttl)
+
+    refresher = threading.Thread(target=refresh_loop, args=(cache, ))
+    refresher.daemon = True
+    refresher.start()
+
+    server = UnixJSONServer(zfscache.SOCKFILE, cache)
+    server.serve_forever()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-r', '--remote-ttl',
+        type=int,
+        default=zfscache.REMOTE_TTL,
+        help='Seconds before remote snapshot lists are refreshed',
+    )
+    args = parser.parse_args(argv)
+
+    pidfile = PidFile(zfscache.PIDFILE)
+
+    context = daemon.DaemonContext(
+        working_directory='/root',
+        umask=0o002,
+        pidfile=pidfile,
+        stdout=sys.stdout,
+        stdin=sys.stdin,
+        stderr=sys.stderr,
+    )
+
+    with context:
+        main_loop(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
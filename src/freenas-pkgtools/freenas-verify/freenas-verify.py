@@ -1,13 +1,42 @@
 #!/usr/local/bin/python
+import getopt
 import sys
 import traceback
 
 sys.path.append("/usr/local/lib")
 from freenasOS import Configuration
 
+def usage():
+    print >> sys.stderr, """Usage: %s [-q] [-p package]
+        -q\tQuick verify, skip files unchanged since the last verify
+        -p\tOnly verify the files of package""" % sys.argv[0]
+    sys.exit(64)
+
 if __name__ == '__main__':
     try:
-        error_flag, ed, warn_flag, wl = Configuration.do_verify()
+        opts, args = getopt.getopt(sys.argv[1:], "p:q")
+    except getopt.GetoptError as err:
+        print >> sys.stderr, str(err)
+        usage()
+    if args:
+        usage()
+
+    quick = False
+    package = None
+    for o, a in opts:
+        if o == "-q":
+            quick = True
+        elif o == "-p":
+            package = a
+
+    try:
+        error_flag, ed, warn_flag, wl = Configuration.do_verify(
+            pkgName=package,
+            quick=quick,
+        )
+    except ValueError, e:
+        print >> sys.stderr, str(e)
+        sys.exit(1)
     except IOError, e:
         traceback.print_exc()
         sys.exit(74)
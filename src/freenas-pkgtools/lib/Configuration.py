@@ -1,6 +1,9 @@
 import ConfigParser
+import contextlib
 import hashlib
+import itertools
 import logging
+import multiprocessing
 import os
 import sys
 import tempfile
@@ -23,6 +26,7 @@ from stat import (
 )
 
 VERIFY_SKIP_PATHS = ['/var/','/etc','/dev','/conf/base/etc/master.passwd']
+VERIFY_CHUNK_SIZE = 1024 * 1024
 CONFIG_DEFAULT = "Defaults"
 CONFIG_SEARCH = "Search"
 
@@ -152,6 +156,9 @@ class PackageDB:
     __db_root = ""
     __conn = None
     __close = True
+    # Nesting level of Transaction()
+    __depth = 0
+    __vacuum = False
 
     def __init__(self, root = "", create = True):
         self.__db_root = root
@@ -177,9 +184,49 @@ class PackageDB:
 			gid integer,
 			flags integer,
 			mode integer)""")
+        cur.execute("CREATE INDEX IF NOT EXISTS files_package ON files(package)")
+        # What do_verify() found for each file, so unchanged
+        # files need not be hashed again.
+        cur.execute("""CREATE TABLE IF NOT EXISTS
+		verify_cache(path text primary key,
+			size integer,
+			mtime real,
+			inode integer,
+			checksum text)""")
+        # Readers are not blocked by an installation in progress,
+        # and a commit is a single append to the log.
+        try:
+            cur.execute("PRAGMA journal_mode=WAL")
+        except Exception as err:
+            log.debug("Cannot use WAL for %s: %s", self.__db_path, str(err))
         self._closedb()
         return
 
+    @contextlib.contextmanager
+    def Transaction(self):
+        """
+        Run the PackageDB calls in the with block on one connection,
+        committed at the end, or rolled back if an exception is
+        raised.  The sqlite3 module keeps the statements prepared
+        for the life of the connection, so repeated calls are cheap.
+        Nested transactions are part of the outer one.
+        """
+        self._connectdb()
+        self.__depth += 1
+        try:
+            yield self
+        except:
+            self.__depth -= 1
+            if self.__depth == 0:
+                self.__conn.rollback()
+                self.__conn.close()
+                self.__conn = None
+                self.__vacuum = False
+            raise
+        else:
+            self.__depth -= 1
+            self._closedb()
+
     def _connectdb(self, returniferror = False, cursor = False):
 	import sqlite3
         if self.__conn is not None:
@@ -206,12 +253,23 @@ class PackageDB:
         return True
 
     def _closedb(self):
+        # Within a transaction, this is done when it ends
+        if self.__depth > 0:
+            return
         if self.__conn is not None:
             self.__conn.commit()
+            if self.__vacuum:
+                self.__vacuum = False
+                self.__conn.execute("VACUUM")
             self.__conn.close()
             self.__conn = None
         return
 
+    def _vacuum(self):
+        # VACUUM cannot run inside a transaction, so
+        # it is run once the changes are committed.
+        self.__vacuum = True
+
     def FindPackage(self, pkgName):
         self._connectdb()
         cur = self.__conn.cursor()
@@ -307,6 +365,23 @@ class PackageDB:
             rv[k] = row[k]
         return rv
 
+    def FindVerifyCache(self):
+        # Returns a dictionary of path -> (size, mtime, inode, checksum)
+        # as recorded by the last verification.
+        cur = self._connectdb(cursor = True)
+        cur.execute("SELECT path, size, mtime, inode, checksum FROM verify_cache")
+        rv = {}
+        for row in cur:
+            rv[row["path"]] = (row["size"], row["mtime"], row["inode"], row["checksum"])
+        self._closedb()
+        return rv
+
+    def UpdateVerifyCache(self, list):
+        # list is a sequence of (path, size, mtime, inode, checksum)
+        cur = self._connectdb(cursor = True)
+        cur.executemany("INSERT OR REPLACE INTO verify_cache(path, size, mtime, inode, checksum) VALUES(?, ?, ?, ?, ?)", list)
+        self._closedb()
+
     def AddFilesBulk(self, list):
         self._connectdb()
         cur = self.__conn.cursor()
@@ -315,26 +390,18 @@ class PackageDB:
         self._closedb()
 
     def AddFile(self, pkgName, path, type, checksum = "", uid = 0, gid = 0, flags = 0, mode = 0):
-        update = False
-        if self.FindFile(path) is not None:
-            update = True
-        self._connectdb()
-        cur = self.__conn.cursor()
-        if update:
-            stmt = "UPDATE files SET package = ?, kind = ?, path = ?, checksum = ?, uid = ?, gid = ?, flags = ?, mode = ? WHERE path = ?"
-            args = (pkgName, type, path, checksum, uid, gid, flags, mode, path)
-        else:
-            stmt = "INSERT INTO files(package, kind, path, checksum, uid, gid, flags, mode) VALUES(?, ?, ?, ?, ?, ?, ?, ?)"
-            args = (pkgName, type, path, checksum, uid, gid, flags, mode)
-        cur.execute(stmt, args)
-        self._closedb()
+        self.AddFilesBulk([(pkgName, path, type, checksum, uid, gid, flags, mode)])
 
     def RemoveFileEntry(self, path):
-        if self.FindFile(path) is not None:
-            self._connectdb()
-            cur = self.__conn.cursor()
-            cur.execute("DELETE FROM files WHERE path = ?", (path, ))
-            self._closedb()
+        self.RemoveFileEntries([path])
+        return
+
+    def RemoveFileEntries(self, paths):
+        # Remove the database entries (only) for the given paths;
+        # paths that are not in the database are ignored.
+        cur = self._connectdb(cursor = True)
+        cur.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in paths))
+        self._closedb()
         return
 
     def RemovePackageFiles(self, pkgName):
@@ -357,7 +424,7 @@ class PackageDB:
                 raise Exception("Cannot remove file %s" % path)
             file_list.append((path, ))
         cur.executemany("DELETE FROM files WHERE path = ?", file_list)
-        cur.execute("VACUUM")
+        self._vacuum()
         self._closedb()
         return True
 
@@ -384,7 +451,7 @@ class PackageDB:
                 raise Exception("Cannot remove directory %s" % path)
             dir_list.append((path, ))
         cur.executemany("DELETE FROM files WHERE path = ?", dir_list)
-        cur.execute("VACUUM")
+        self._vacuum()
         self._closedb()
         return True
 
@@ -895,26 +962,10 @@ class Configuration(object):
             pass
         return None
 
-    def FindPackageFile(self, package, upgrade_from=None, handler=None, save_dir = None):
-        # Given a package, and optionally a version to upgrade from, find
-        # the package file for it.  Returns a file-like
-        # object for the package file.
-        # If the package object has a checksum set, it
-        # attempts to verify the checksum; if it doesn't match,
-        # it goes onto the next one.
-        # If upgrade_from is set, it tries to find delta packages
-        # first, and will verify the checksum for that.  If the
-        # package does not have an upgrade field set, or it does
-        # but there's no checksum, then we are probably creating
-        # the manifest file, so we won't do the checksum verification --
-        # we'll only go by name.
-        # If it can't find one, it returns None
-        rv = None
-        mani = self.SystemManifest()
-        sequence = "unknown"
-        if mani:
-            sequence = mani.Sequence()
-
+    def PackageFileCandidates(self, package):
+        # Return the list of package files that can be used
+        # to install package, as dictionaries with Filename and
+        # Checksum keys.
         # We have at least one, and at most two, files
         # to look for.
         # The first file is the full package.
@@ -944,18 +995,16 @@ class Configuration(object):
         except:
             # No update packge that matches.
             pass
+        return package_files
 
-        # At this point, package_files now has at least one element.
+    def FindLocalPackageFile(self, package_files):
+        # Look for one of the package files (as returned by
+        # PackageFileCandidates) in the local package directory.
+        # Returns a file-like object, or None.
         # We want to search in this order:
         # * Local full copy
         # * Local delta copy
-        # * Network delta copy
-        # * Network full copy
-
-        # We want to look for each one in _package_dir and off the network.
         # If we find it, and the checksum matches, we're good to go.
-        # If not, we have to grab it off the network and use that.  We can't
-        # check that checksum until we get it.
         for search_attempt in package_files:
             # First try the local copy.
             log.debug("Searching for %s" % search_attempt["Filename"])
@@ -974,7 +1023,30 @@ class Configuration(object):
                             return file
             except:
                 pass
+        return None
 
+    def FindPackageFile(self, package, upgrade_from=None, handler=None, save_dir = None):
+        # Given a package, and optionally a version to upgrade from, find
+        # the package file for it.  Returns a file-like
+        # object for the package file.
+        # If the package object has a checksum set, it
+        # attempts to verify the checksum; if it doesn't match,
+        # it goes onto the next one.
+        # If upgrade_from is set, it tries to find delta packages
+        # first, and will verify the checksum for that.  If the
+        # package does not have an upgrade field set, or it does
+        # but there's no checksum, then we are probably creating
+        # the manifest file, so we won't do the checksum verification --
+        # we'll only go by name.
+        # If it can't find one, it returns None
+        package_files = self.PackageFileCandidates(package)
+        file = self.FindLocalPackageFile(package_files)
+        if file is not None:
+            return file
+
+        # Not found locally, so try the network:
+        # * Network delta copy
+        # * Network full copy
         for search_attempt in reversed(package_files):
             # Next we try to get it from the network.
             url = "%s/Packages/%s" % (UPDATE_SERVER, search_attempt["Filename"])
@@ -1043,16 +1115,18 @@ def get_ftype_and_perm(mode):
         return "socket", S_IMODE(mode)
     return "unknown", "unknown"
 
-def check_ftype(objs):
+def check_ftype(objs, lst_var = None):
     """ Checks the filetype, permissions and uid,gid of the
     pkgdg object(objs) sent to it. Returns two dicts: ed and pd
     (the error_dict with a descriptive explanantion of the problem
     if present, none otherwise, the perm_dict with a description of
     the incoorect perms if present, none otherwise
+    lst_var is the lstat() of the path, if the caller already has it.
     """
     ed = None
     pd = None
-    lst_var = os.lstat(objs["path"])
+    if lst_var is None:
+        lst_var = os.lstat(objs["path"])
     ftype, perm = get_ftype_and_perm(lst_var.st_mode)
     if ftype != objs["kind"]:
         ed = dict([('path', objs["path"]),
@@ -1071,9 +1145,28 @@ def check_ftype(objs):
                 ('pkgdb_entry', objs)])
     return ed, pd
 
-def do_verify(verify_handler=None):
+def verify_checksum(path):
+    """ Hashes the file at path in chunks.  Returns a tuple of
+    (path, size, mtime, inode, checksum), checksum being None
+    if the file could not be read.  Run in the do_verify() pool."""
+    try:
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            hash = hashlib.sha256()
+            for piece in iter(lambda: f.read(VERIFY_CHUNK_SIZE), ''):
+                hash.update(piece)
+    except (IOError, OSError):
+        return path, None, None, None, None
+    return path, st.st_size, st.st_mtime, st.st_ino, hash.hexdigest()
+
+def do_verify(verify_handler=None, pkgName=None, quick=False, workers=None):
     """A function that goes through the provided pkgdb filelist and verifies it with
-    the current root filesystem."""
+    the current root filesystem.
+    Files are hashed by a pool of workers processes (cpu_count() by
+    default), and what was found for each is recorded in the pkgdb.
+    If quick is set, files whose size, mtime and inode did not change
+    since then are not hashed again.  If pkgName is set, only the
+    files of that package are verified."""
     error_flag = False
     error_list = dict([('checksum', []), ('wrongtype',[]), ('notfound',[])])
     warn_flag = False
@@ -1083,17 +1176,45 @@ def do_verify(verify_handler=None):
     pkgdb = PackageDB(create = False)
     if pkgdb is None:
         raise IOError("Cannot get pkgdb connection")
-    filelist = pkgdb.FindFilesForPackage()
+    if pkgName is not None and pkgdb.FindPackage(pkgName) is None:
+        raise ValueError("Package %s is not installed" % pkgName)
+    filelist = pkgdb.FindFilesForPackage(pkgName)
     total_files  = len(filelist)
+    cache = pkgdb.FindVerifyCache() if quick else {}
 
+    # The handler may be slow (the UI one writes a file), so it
+    # is called when the percentage changes, or every second.
+    reported = [None, 0]
+    def progress(path):
+        if verify_handler is None:
+            return
+        now = time.time()
+        percent = i * 100 / total_files
+        if percent != reported[0] or now - reported[1] >= 1 or i == total_files:
+            reported[:] = [percent, now]
+            verify_handler(i, total_files, path)
+
+    def check_checksum(objs, checksum):
+        if (
+            objs["checksum"] and
+            objs["checksum"] !="-" and
+            checksum != objs["checksum"]
+        ):
+            error_list['checksum'].append(dict([('path', objs["path"]),
+                ('problem', 'checksum does not match'),
+                ('pkgdb_entry', objs)]))
+            return True
+        return False
+
+    to_hash = {}
     for objs in filelist:
         i = i+1
-        if verify_handler is not None:
-            verify_handler(i,total_files,objs["path"])
-        tmp = '' # Just a temp. variable to store the text to be hashed
+        progress(objs["path"])
         if is_ignore_path(objs["path"]):
             continue
-        if not os.path.lexists(objs["path"]):
+        try:
+            lst_var = os.lstat(objs["path"])
+        except OSError:
             # This basically just checks if the file/slink/dir exists or not.
             # Note: not using os.path.exists(path) here as that returns false
             # even if its a broken symlink and that is a differret problem
@@ -1105,7 +1226,7 @@ def do_verify(verify_handler=None):
                 ('pkgdb_entry', objs)]))
             continue
 
-        ed, pd = check_ftype(objs)
+        ed, pd = check_ftype(objs, lst_var)
         if ed:
             error_flag = True
             error_list['wrongtype'].append(ed)
@@ -1113,27 +1234,69 @@ def do_verify(verify_handler=None):
             warn_flag = True
             warn_list.append(pd)
 
-        if objs["kind"] == "slink":
+        # Dirs have no checksum d'oh!
+        if objs["kind"] == "slink" and S_ISLNK(lst_var.st_mode):
             tmp = os.readlink(objs["path"])
             if tmp.startswith('/'):
                 tmp = tmp[1:]
+            if check_checksum(objs, hashlib.sha256(tmp).hexdigest()):
+                error_flag = True
 
         if objs["kind"] == "file":
             if objs["path"].endswith(".pyc"):
                 continue
-            tmp = open(objs["path"]).read()
-
-        # Do this last (as it needs to be done for all, but dirs, as dirs have no checksum d'oh!)
-        if (
-            objs["kind"] != 'dir' and
-            objs["checksum"] and
-            objs["checksum"] !="-" and
-            hashlib.sha256(tmp).hexdigest()!=objs["checksum"]
-        ):
-            error_flag = True
-            error_list['checksum'].append(dict([('path', objs["path"]),
-                ('problem', 'checksum does not match'),
-                ('pkgdb_entry', objs)]))
+            if not S_ISREG(lst_var.st_mode):
+                # Already reported as the wrong type
+                continue
+            cached = cache.get(objs["path"])
+            if cached and cached[:3] == (lst_var.st_size, lst_var.st_mtime, lst_var.st_ino):
+                if check_checksum(objs, cached[3]):
+                    error_flag = True
+                continue
+            # Counted towards the progress once hashed
+            to_hash[objs["path"]] = objs
+            i = i-1
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    pool = None
+    if workers > 1 and len(to_hash) > 1:
+        pool = multiprocessing.Pool(min(workers, len(to_hash)))
+        results = pool.imap_unordered(verify_checksum, to_hash.keys(), 16)
+    else:
+        results = itertools.imap(verify_checksum, to_hash.keys())
+    checked = []
+    try:
+        for path, size, mtime, inode, checksum in results:
+            i = i+1
+            progress(path)
+            if checksum is None:
+                # Disappeared, or cannot be read
+                error_flag = True
+                error_list['notfound'].append(dict([('path', path),
+                    ('problem', 'cannot read file'),
+                    ('pkgdb_entry', to_hash[path])]))
+                continue
+            checked.append((path, size, mtime, inode, checksum))
+            if check_checksum(to_hash[path], checksum):
+                error_flag = True
+    except:
+        # Do not wait for the rest of the files to be hashed
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            pool = None
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if checked:
+        try:
+            pkgdb.UpdateVerifyCache(checked)
+        except Exception as e:
+            log.warn("Cannot record verification results: %s", str(e))
     return error_flag, error_list, warn_flag, warn_list
 
 if __name__ == "__main__":
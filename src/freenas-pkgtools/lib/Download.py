@@ -0,0 +1,305 @@
+import hashlib
+import httplib
+import logging
+import os
+import socket
+import threading
+import time
+import urllib2
+from multiprocessing.pool import ThreadPool
+
+from . import Avatar, UPDATE_SERVER
+
+log = logging.getLogger('freenasOS.Download')
+
+CHUNK_SIZE = 64 * 1024
+# Downloads in progress are kept as <file>.part, so an interrupted
+# download can be resumed with an HTTP Range request.
+PARTIAL_SUFFIX = ".part"
+# Number of packages downloaded at the same time
+CONNECTIONS = 4
+TIMEOUT = 30
+RETRIES = 5
+
+class DownloadProgress(object):
+    """
+    Aggregate progress of concurrent downloads.  The handler is called
+    as handler(method, filename, size=, progress=, download_rate=), like
+    the Configuration.TryGetNetworkFile() one, with the total size,
+    percentage and rate of all the downloads, whenever the percentage
+    changes or at least once per interval seconds.
+    """
+
+    def __init__(self, handler = None, interval = 1.0):
+        self._handler = handler
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._sizes = {}
+        self._total = 0
+        self._done = 0
+        self._percent = None
+        self._reported = 0
+        self._rate = 0
+        self._rate_time = time.time()
+        self._rate_done = 0
+
+    def Expect(self, key, size):
+        """
+        Set the (expected) size of download key.
+        """
+        with self._lock:
+            self._total += (size or 0) - self._sizes.get(key, 0)
+            self._sizes[key] = size or 0
+
+    def Resumed(self, key, nbytes):
+        """
+        nbytes of download key were already there, they count
+        towards the progress but not towards the rate.
+        """
+        with self._lock:
+            self._done += nbytes
+            self._rate_done += nbytes
+
+    def Restarted(self, key, nbytes):
+        """
+        nbytes of download key are being downloaded again.
+        """
+        with self._lock:
+            self._done -= nbytes
+            self._rate_done -= nbytes
+
+    def Update(self, key, nbytes, filename):
+        with self._lock:
+            self._done += nbytes
+            now = time.time()
+            if now - self._rate_time >= self._interval:
+                self._rate = int((self._done - self._rate_done) / (now - self._rate_time))
+                self._rate_time = now
+                self._rate_done = self._done
+            if self._handler is None or not self._total:
+                return
+            percent = min(int(self._done * 100.0 / self._total), 100)
+            if percent == self._percent and now - self._reported < self._interval:
+                return
+            self._percent = percent
+            self._reported = now
+            self._handler(
+                'network',
+                filename,
+                size = self._total,
+                progress = percent,
+                download_rate = self._rate,
+            )
+
+def RemovePartialFiles(directory):
+    """
+    Remove the partial downloads left in directory.
+    """
+    for entry in os.listdir(directory):
+        if entry.endswith(PARTIAL_SUFFIX):
+            try:
+                os.unlink(os.path.join(directory, entry))
+            except OSError:
+                pass
+
+def _Opener():
+    from . import ROOT_CA_FILE
+    import freenasOS.Configuration as Configuration
+    return urllib2.build_opener(
+        Configuration.VerifiedHTTPSHandler(ca_certs = ROOT_CA_FILE),
+    )
+
+def FetchFile(url, pathname, checksum = None, progress = None, key = None,
+              headers = None, opener = None, timeout = TIMEOUT, retries = RETRIES):
+    """
+    Download url into pathname.  Data is written to pathname.part and
+    hashed as it arrives; a pathname.part left by an earlier attempt is
+    resumed through an HTTP Range request.  Network errors are retried
+    up to retries times, keeping what was already downloaded.  Once
+    complete, and if the SHA256 matches checksum (when given), the file
+    is renamed to pathname.  If a resumed download does not match the
+    checksum, it is downloaded again from the start.  progress is a
+    DownloadProgress, the bytes are accounted under key (the url by
+    default).
+
+    Returns True if pathname was downloaded.
+    """
+    if opener is None:
+        opener = _Opener()
+    if key is None:
+        key = url
+    partial = pathname + PARTIAL_SUFFIX
+    attempt = 0
+    resumed = False
+    while True:
+        sha = hashlib.sha256()
+        offset = 0
+        if os.path.exists(partial):
+            with open(partial, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    sha.update(chunk)
+                    offset += len(chunk)
+
+        req = urllib2.Request(url, headers = headers or {})
+        if offset:
+            req.add_header("Range", "bytes=%d-" % offset)
+            resumed = True
+        try:
+            resp = opener.open(req, timeout = timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 416 and offset:
+                # Nothing left to download
+                if progress:
+                    progress.Expect(key, offset)
+                    progress.Resumed(key, offset)
+                break
+            log.warn("Unable to load %s: %s", url, str(e))
+            return False
+        except (urllib2.URLError, socket.error, httplib.HTTPException) as e:
+            attempt += 1
+            if attempt > retries:
+                log.warn("Unable to load %s: %s", url, str(e))
+                return False
+            log.debug("FetchFile(%s):  %s, retrying" % (url, str(e)))
+            time.sleep(min(2 ** attempt, 30))
+            continue
+
+        if offset and resp.getcode() != 206:
+            # The server sent the whole file
+            log.debug("FetchFile(%s):  Range not honoured, restarting" % url)
+            sha = hashlib.sha256()
+            offset = 0
+            resumed = False
+        try:
+            length = int(resp.info().getheader("Content-Length").strip())
+        except:
+            length = None
+        if progress:
+            progress.Expect(key, offset + length if length is not None else None)
+            progress.Resumed(key, offset)
+
+        read = 0
+        try:
+            with open(partial, "ab" if offset else "wb") as f:
+                while True:
+                    data = resp.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    sha.update(data)
+                    f.write(data)
+                    read += len(data)
+                    if progress:
+                        progress.Update(key, len(data), url)
+            if length is not None and read < length:
+                raise httplib.IncompleteRead("", length - read)
+        except (socket.error, httplib.HTTPException) as e:
+            attempt += 1
+            if progress:
+                progress.Restarted(key, offset + read)
+            if attempt > retries:
+                log.warn("Unable to load %s: %s", url, str(e))
+                return False
+            log.debug("FetchFile(%s):  %s after %d bytes, resuming" % (url, str(e), offset + read))
+            continue
+        finally:
+            resp.close()
+        log.debug("FetchFile(%s):  Read %d bytes total" % (url, offset + read))
+        break
+
+    if checksum and sha.hexdigest() != checksum:
+        if progress:
+            progress.Restarted(key, os.path.getsize(partial))
+        os.unlink(partial)
+        if resumed:
+            # Possibly left by a download of a different file
+            log.debug("FetchFile(%s):  Resumed download does not match, restarting" % url)
+            return FetchFile(url, pathname, checksum = checksum, progress = progress,
+                             key = key, headers = headers, opener = opener,
+                             timeout = timeout, retries = retries)
+        log.error("%s checksum does not match" % url)
+        return False
+    os.rename(partial, pathname)
+    return True
+
+class DownloadManager(object):
+    """
+    Download the package files for an update into a directory,
+    up to connections packages at a time.  Progress of all the
+    downloads together is given to handler, see DownloadProgress;
+    check_handler(index, pkg = pkg, pkgList = packages) is called
+    when each package is started.
+    """
+
+    def __init__(self, conf, directory, handler = None, check_handler = None,
+                 connections = CONNECTIONS, server = UPDATE_SERVER):
+        self._conf = conf
+        self._directory = directory
+        self._check_handler = check_handler
+        self._connections = connections
+        self._server = server
+        self._progress = DownloadProgress(handler)
+        self._lock = threading.Lock()
+        self._opener = None
+
+    def _headers(self):
+        AVATAR_VERSION = "X-%s-Manifest-Version" % Avatar()
+        current_version = "unknown"
+        temp_mani = self._conf.SystemManifest()
+        if temp_mani:
+            current_version = temp_mani.Sequence()
+        return {
+            AVATAR_VERSION : current_version,
+            # Hack for debugging
+            "User-Agent" : "%s=%s" % (AVATAR_VERSION, current_version),
+        }
+
+    def _Download(self, args):
+        (indx, pkg, packages, candidates, headers) = args
+        if self._check_handler:
+            with self._lock:
+                self._check_handler(indx + 1, pkg = pkg, pkgList = packages)
+
+        local = self._conf.FindLocalPackageFile(candidates)
+        if local is not None:
+            local.close()
+            return True
+
+        # Delta package first, then the full one
+        for search_attempt in reversed(candidates):
+            url = "%s/Packages/%s" % (self._server, search_attempt["Filename"])
+            if FetchFile(
+                    url,
+                    os.path.join(self._directory, search_attempt["Filename"]),
+                    checksum = search_attempt["Checksum"],
+                    progress = self._progress,
+                    key = pkg.Name(),
+                    headers = headers,
+                    opener = self._opener,
+            ):
+                return True
+        log.error("Could not download package file for %s" % pkg.Name())
+        return False
+
+    def Download(self, packages):
+        """
+        Returns True if every package was downloaded.
+        """
+        if not packages:
+            return True
+        if self._opener is None:
+            self._opener = _Opener()
+        headers = self._headers()
+        # Looked up here, the package database is not shared
+        # between threads.
+        jobs = []
+        for indx, pkg in enumerate(packages):
+            self._progress.Expect(pkg.Name(), pkg.Size())
+            candidates = self._conf.PackageFileCandidates(pkg)
+            jobs.append((indx, pkg, packages, candidates, headers))
+        pool = ThreadPool(min(self._connections, len(packages)))
+        try:
+            results = pool.map(self._Download, jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+        return all(results)
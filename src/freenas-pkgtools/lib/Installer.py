@@ -7,6 +7,9 @@ import json
 import tarfile
 import hashlib
 import logging
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 import getopt
 
@@ -62,6 +65,15 @@ PKG_DELTA_STYLE_KEY = "style"
 
 PKG_MANIFEST_NAME = "+MANIFEST"
 
+# Regular files are copied out of the package in chunks of this size.
+# Files no larger than one chunk are handed to a pool of EXTRACT_WORKERS
+# threads, which hash, write and rename them while the next entries are
+# being read; at most EXTRACT_PENDING of them are held in memory.  On a
+# single CPU everything is extracted inline.
+EXTRACT_CHUNK = 64 * 1024
+EXTRACT_WORKERS = min(4, cpu_count())
+EXTRACT_PENDING = 256
+
 # These are the keys for the scripts
 PKG_SCRIPTS = [ "pre-install", "install", "post-install",
                 "pre-deinstall", "deinstall", "post-deinstall",
@@ -312,7 +324,61 @@ def RunPkgScript(scripts, type, root = None, **kwargs):
 # It is given a tarfile object, an entry object into it, a
 # root directory, and an optional prefix and hash.
 
-def ExtractEntry(tf, entry, root, prefix = None, mFileHash = None):
+def _ReadChunks(fileData):
+    while True:
+        chunk = fileData.read(EXTRACT_CHUNK)
+        if not chunk:
+            break
+        yield chunk
+
+# Write the data chunks into a temporary file next to full_path,
+# hashing them on the way, and rename it in place.  Returns the
+# sha256 of the data.
+def WriteFile(full_path, chunks, meta):
+    sha = hashlib.sha256()
+    newfile = os.path.join(
+        os.path.dirname(full_path),
+        ".%s.new" % os.path.basename(full_path),
+    )
+    fd = os.open(newfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0600)
+    try:
+        with os.fdopen(fd, "w") as f:
+            for chunk in chunks:
+                sha.update(chunk)
+                f.write(chunk)
+        # We remove any flags on it -- if there are
+        # supposed to be any, SetPosix() will get them.
+        # (We hope.)
+        try:
+            os.lchflags(full_path, 0)
+        except:
+            pass
+        try:
+            os.rename(newfile, full_path)
+        except:
+            os.rename(full_path, "%s.old" % full_path)
+            os.rename(newfile, full_path)
+    except:
+        RemoveFile(newfile)
+        raise
+    SetPosix(full_path, meta)
+    return sha.hexdigest()
+
+def _CheckHash(name, hash, mFileHash):
+    # PKGNG sets hash to "-" if it's not computed.
+    if mFileHash != "-":
+        if hash != mFileHash:
+            log.error("%s hash does not match manifest" % name)
+    return hash
+
+def ExtractEntry(tf, entry, root, prefix = None, mFileHash = None, pool = None):
+    """
+    Extract one package entry under root.  Returns the files table row
+    for it (without the package name), or None.
+
+    If pool is given, files that fit in one chunk are written out by
+    the pool, and an AsyncResult for the row is returned instead.
+    """
     # This bit of code tries to turn the
     # mixture of root, prefix, and pathname into something
     # we can both manipulate, and something we can put into
@@ -360,43 +426,17 @@ def ExtractEntry(tf, entry, root, prefix = None, mFileHash = None):
     # Process the entry.  We look for a file, directory,
     # symlink, or hard link.
     if entry.isfile():
-        fileData = tf.extractfile(entry)
-        # Is this a problem?  Keeping the file in memory?
-        # Note that we write the file out later, so this allows
-        # us to not worry about the buffer.
-        buffer = fileData.read()
-        hash = hashlib.sha256(buffer).hexdigest()
-        # PKGNG sets hash to "-" if it's not computed.
-        if mFileHash != "-":
-            if hash != mFileHash:
-                log.error("%s hash does not match manifest" % entry.name)
         type = "file"
-        # First we try to create teh file.
-        # If that doesn't work, we try to create a
-        # new file (how would this get cleaned up?),
-        # and then rename it in place.
-        # We remove any flags on it -- if there are
-        # supposed to be any, SetPosix() will get them.
-        # (We hope.)
-        try:
-            os.lchflags(full_path, 0)
-        except:
-            pass
-        newfile = None
-        try:
-            f = open(full_path, "w")
-        except:
-            newfile = full_path + ".new"
-            f = open(newfile, "w")
-        f.write(buffer)
-        f.close()
-        if newfile is not None:
-            try:
-                os.rename(newfile, full_path)
-            except:
-                os.rename(full_path, "%s.old" % full_path)
-                os.rename(newfile, full_path)
-        SetPosix(full_path, meta)
+        fileData = tf.extractfile(entry)
+        if pool is not None and entry.size <= EXTRACT_CHUNK:
+            chunks = [fileData.read()]
+            def extract():
+                hash = _CheckHash(entry.name, WriteFile(full_path, chunks, meta), mFileHash)
+                return (fileName, type, hash,
+                        meta[TAR_UID_KEY], meta[TAR_GID_KEY],
+                        meta[TAR_FLAGS_KEY], meta[TAR_MODE_KEY])
+            return pool.apply_async(extract)
+        hash = _CheckHash(entry.name, WriteFile(full_path, _ReadChunks(fileData), meta), mFileHash)
     elif entry.isdir():
         # If the directory already exists, we don't care.
         try:
@@ -478,10 +518,16 @@ def install_path(pkgfile, dest):
         return install_file(f, dest)
             
 def install_file(pkgfile, dest):
+    # We explicitly want to use the pkgdb from the destination.
+    # The package is recorded in one transaction, instead of
+    # a commit for every change.
+    pkgdb = Configuration.PackageDB(dest)
+    with pkgdb.Transaction():
+        return _install_file(pkgfile, dest, pkgdb)
+
+def _install_file(pkgfile, dest, pkgdb):
     global debug, verbose, dryrun
     prefix = None
-    # We explicitly want to use the pkgdb from the destination
-    pkgdb = Configuration.PackageDB(dest)
     amroot = (os.geteuid() == 0)
     pkgScripts = None
     upgrade_aware = False
@@ -558,9 +604,8 @@ def install_file(pkgfile, dest):
     print "%s-%s" % (pkgName, pkgVersion)
     if debug > 1:  log.debug("installation target = %s" % dest)
         
-    # Note that none of this is at all atomic.
-    # To fix that, I should go to a persistent sqlite connection,
-    # and use a transaction.
+    # The database changes are atomic (see install_file), but
+    # the filesystem changes are not.
     old_pkg = pkgdb.FindPackage(pkgName)
     # Should DB be updated before or after installation?
     if old_pkg is not None:
@@ -598,13 +643,13 @@ def install_file(pkgfile, dest):
                 if RemoveFile(full_path) == False:
                     if debug:  log.debug("Could not remove file %s" % file)
                     # Ignor error for now
-                pkgdb.RemoveFileEntry(file)
+            pkgdb.RemoveFileEntries(pkgDeletedFiles)
             # Now we try to delete the directories.
             for dir in pkgDeletedDirs:
                 if verbose or debug:  log.debug("Attempting to remove directory %s" % dir)
                 full_path = dest + "/" + dir
                 RemoveDirectory(full_path)
-                pkgdb.RemoveFileEntry(dir)
+            pkgdb.RemoveFileEntries(pkgDeletedDirs)
             # Later on, when the package is upgraded, the scripts in the database are deleted.
             # So we don't have to do that now.
         else:
@@ -651,36 +696,58 @@ def install_file(pkgfile, dest):
                      dest, PKG_PREFIX=prefix, SCRIPT_ARG="PRE-INSTALL")
             
     # Go through the tarfile, looking for entries in the manifest list.
+    # Small files are written out by the worker pool, their rows are
+    # collected in order as they complete.
     pkgFiles = []
-    while member is not None:
-        # To figure out the hash, we need to look
-        # at <file>, <prefix + file>, and both of those
-        # with and without a leading "/".  (Why?  Because
-        # the manifest may have relative or absolute paths,
-        # and tar may remove a leading slash to make us secure.)
-        # We also have to look in the directories hash
-        mFileHash = "-"
-        if member.name in mfiles:
-            mFileHash = mfiles[member.name]
-        elif prefix + member.name in mfiles:
-            mFileHash = mfiles[prefix + member.name]
-        elif (prefix + member.name).startswith("/") == False:
-            if "/" + prefix + member.name in mfiles:
-                mFileHash = mfiles["/" + prefix + member.name]
-        else:
-            # If it's not in the manifest, then ignore it
-            # It may be a directory, however, so let's check
-            if EntryInDictionary(member.name, mdirs, prefix) == False:
-                continue
-        if pkgDeltaVersion is not None:
-            if verbose or debug: log.debug("Extracting %s from delta package" % member.name)
-        list = ExtractEntry(t, member, dest, prefix, mFileHash)
-        if list is not None:
-            pkgFiles.append((pkgName,) + list)
-    
-#        print "prefix = %s, member = %s, hash = %s" % (prefix, member.name, mFileHash)
-        member = t.next()
-    
+    pending = deque()
+    def collect(limit = 0):
+        while len(pending) > limit:
+            row = pending.popleft()
+            if not isinstance(row, tuple):
+                row = row.get()
+            pkgFiles.append((pkgName,) + row)
+
+    pool = ThreadPool(EXTRACT_WORKERS) if EXTRACT_WORKERS > 1 else None
+    try:
+        while member is not None:
+            # To figure out the hash, we need to look
+            # at <file>, <prefix + file>, and both of those
+            # with and without a leading "/".  (Why?  Because
+            # the manifest may have relative or absolute paths,
+            # and tar may remove a leading slash to make us secure.)
+            # We also have to look in the directories hash
+            mFileHash = "-"
+            if member.name in mfiles:
+                mFileHash = mfiles[member.name]
+            elif prefix + member.name in mfiles:
+                mFileHash = mfiles[prefix + member.name]
+            elif (prefix + member.name).startswith("/") == False:
+                if "/" + prefix + member.name in mfiles:
+                    mFileHash = mfiles["/" + prefix + member.name]
+            else:
+                # If it's not in the manifest, then ignore it
+                # It may be a directory, however, so let's check
+                if EntryInDictionary(member.name, mdirs, prefix) == False:
+                    member = t.next()
+                    continue
+            if pkgDeltaVersion is not None:
+                if verbose or debug: log.debug("Extracting %s from delta package" % member.name)
+            if member.islnk() or (member.isdir() and GetTarMeta(member)[TAR_FLAGS_KEY]):
+                # The link source has to be written out first, and
+                # files cannot be created once a directory is immutable
+                collect()
+            list = ExtractEntry(t, member, dest, prefix, mFileHash, pool = pool)
+            if list is not None:
+                pending.append(list)
+                collect(EXTRACT_PENDING)
+
+            member = t.next()
+        collect()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
     if len(pkgFiles) > 0:
         pkgdb.AddFilesBulk(pkgFiles)
         
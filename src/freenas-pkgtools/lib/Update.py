@@ -10,6 +10,7 @@ import sys
 from . import Avatar
 import freenasOS.Manifest as Manifest
 import freenasOS.Configuration as Configuration
+import freenasOS.Download as Download
 import freenasOS.Installer as Installer
 import freenasOS.Package as Package
 from freenasOS.Exceptions import UpdateIncompleteCacheException, UpdateInvalidCacheException, UpdateBusyCacheException
@@ -366,14 +367,18 @@ def Update(root=None, conf=None, train = None, check_handler=None, get_handler=N
 
         for pkg in deleted_packages:
             log.debug("Want to delete package %s" % pkg.Name())
-            if conf.PackageDB(root).RemovePackageContents(pkg) == False:
+            pkgdb = conf.PackageDB(root)
+            with pkgdb.Transaction():
+                removed = pkgdb.RemovePackageContents(pkg.Name())
+                if removed != False:
+                    pkgdb.RemovePackage(pkg.Name())
+            if removed == False:
                 log.error("Unable to remove contents package %s" % pkg.Name())
                 if mount_point:
                     UnmountClone(clone_name, mount_point)
                     mount_point = None
                 DeleteClone(clone_name)
                 raise Exception("Unable to remove contents for package %s" % pkg.Name())
-            conf.PackageDB(root).RemovePackage(pkg.Name())
 
         log.debug("Creating Installer object")
         installer = Installer.Installer(manifest = new_man, root = root, config = conf)
@@ -440,7 +445,10 @@ def DownloadUpdate(train, directory, get_handler = None, check_handler = None):
     will also stash the current sequence when it downloads; this will
     allow it to determine if a reboot into a different boot environment
     has happened.  This will remove the existing content if it decides
-    it has to redownload for any reason.
+    it has to redownload for any reason, except for partially downloaded
+    package files, which are resumed.  Package files are downloaded
+    concurrently; get_handler is given the progress of all of them
+    together (see Download.DownloadProgress).
     """
     import shutil
     import fcntl
@@ -466,7 +474,7 @@ def DownloadUpdate(train, directory, get_handler = None, check_handler = None):
                 return True
             # Not the latest
             mani_file.close()
-        RemoveUpdate(directory)
+        RemoveUpdate(directory, keep_partial = True)
         mani_file = None
     except UpdateBusyCacheException:
         log.debug("Cache directory %s is busy, so no update available" % directory)
@@ -474,14 +482,15 @@ def DownloadUpdate(train, directory, get_handler = None, check_handler = None):
     except (UpdateIncompleteCacheException, UpdateInvalidCacheException) as e:
         # It's incomplete, so we need to remove it
         log.error("DownloadUpdate(%s, %s):  Got exception %s; removing cache" % (train, directory, str(e)))
-        RemoveUpdate(directory)
+        RemoveUpdate(directory, keep_partial = True)
     except BaseException as e:
         log.error("Got exception %s while trying to prepare update cache" % str(e))
         raise e
     # If we're here, then we don't have a (valid) cached update.
-    RemoveUpdate(directory)
+    RemoveUpdate(directory, keep_partial = True)
     try:
-        os.makedirs(directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
     except BaseException as e:
         log.error("Unable to create directory %s: %s" % (directory, str(e)))
         return False
@@ -508,14 +517,18 @@ def DownloadUpdate(train, directory, get_handler = None, check_handler = None):
         download_packages.append(pkg)
 
     # Next steps:  download the package files.
-    for indx, pkg in enumerate(download_packages):
-        if check_handler:
-            check_handler(indx + 1,  pkg = pkg, pkgList = download_packages)
-        pkg_file = conf.FindPackageFile(pkg, save_dir = directory, handler = get_handler)
-        if pkg_file is None:
-            log.error("Could not download package file for %s" % pkg.Name())
-            RemoveUpdate(directory)
-            return False
+    manager = Download.DownloadManager(
+        conf,
+        directory,
+        handler = get_handler,
+        check_handler = check_handler,
+    )
+    if not manager.Download(download_packages):
+        # Keep what was downloaded, the next attempt will resume it.
+        RemoveUpdate(directory, keep_partial = True)
+        return False
+    # Whatever is left was not needed for this update
+    Download.RemovePartialFiles(directory)
 
     # Then save the manifest file.
     latest_mani.StoreFile(mani_file)
@@ -647,14 +660,18 @@ def ApplyUpdate(directory, install_handler = None):
         # Remove any deleted packages
         for pkg in deleted_packages:
             log.debug("About to delete package %s" % pkg.Name())
-            if conf.PackageDB(mount_point).RemovePackageContents(pkg) == False:
+            pkgdb = conf.PackageDB(mount_point)
+            with pkgdb.Transaction():
+                removed = pkgdb.RemovePackageContents(pkg.Name())
+                if removed != False:
+                    pkgdb.RemovePackage(pkg.Name())
+            if removed == False:
                 s = "Unable to remove contents for packate %s" % pkg.Name()
                 if mount_point:
                     UnmountClone(clone_name, mount_point)
                     mount_point = None
                     DeleteClone(clone_name)
                 raise Exception(s)
-            conf.PackageDB(mount_point).RemovePackage(pkg.Name())
 
         installer = Installer.Installer(manifest = new_manifest,
                                         root = mount_point,
@@ -812,8 +829,26 @@ def VerifyUpdate(directory):
     mani_file.seek(0)
     return mani_file
 
-def RemoveUpdate(directory):
+def RemoveUpdate(directory, keep_partial = False):
+    """
+    Remove the update cache directory.  If keep_partial is set,
+    partially downloaded package files are left in it, so the
+    next DownloadUpdate can resume them.
+    """
     import shutil
+    if keep_partial and os.path.isdir(directory):
+        for entry in os.listdir(directory):
+            if entry.endswith(Download.PARTIAL_SUFFIX):
+                continue
+            path = os.path.join(directory, entry)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+            except:
+                pass
+        return
     try:
         shutil.rmtree(directory)
     except:
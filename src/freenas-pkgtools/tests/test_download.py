@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+#
+# Tests for freenasOS.Download, run against a local HTTP server.
+#
+# Usage:
+#     python test_download.py
+#
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import urllib2
+
+sys.path.append('/usr/local/lib')
+
+from freenasOS import Download
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.getheader('Range')))
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        start = 0
+        rng = self.headers.getheader('Range')
+        if rng and server.ranges:
+            start = int(rng.split('=', 1)[1].rstrip('-'))
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header(
+                'Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data))
+            )
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        body = data[start:]
+        if server.drop:
+            # Simulate a dropped connection
+            body = body[:server.drop]
+            server.drop = 0
+        self.wfile.write(body)
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.files = {}
+        self.server.requests = []
+        self.server.ranges = True
+        self.server.drop = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.dir = tempfile.mkdtemp(prefix='test_download.')
+        self.opener = urllib2.build_opener()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def add_file(self, name, size):
+        data = os.urandom(size)
+        self.server.files['/Packages/' + name] = data
+        return data, hashlib.sha256(data).hexdigest()
+
+    def fetch(self, name, checksum, **kwargs):
+        return Download.FetchFile(
+            '%s/Packages/%s' % (self.url, name),
+            os.path.join(self.dir, name),
+            checksum=checksum,
+            opener=self.opener,
+            **kwargs
+        )
+
+    def read(self, name):
+        with open(os.path.join(self.dir, name), 'rb') as f:
+            return f.read()
+
+    def test_fetch(self):
+        data, checksum = self.add_file('a.tgz', 300000)
+        self.assertTrue(self.fetch('a.tgz', checksum))
+        self.assertEqual(self.read('a.tgz'), data)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'a.tgz.part')))
+
+    def test_resume_partial(self):
+        data, checksum = self.add_file('a.tgz', 300000)
+        with open(os.path.join(self.dir, 'a.tgz.part'), 'wb') as f:
+            f.write(data[:100000])
+        self.assertTrue(self.fetch('a.tgz', checksum))
+        self.assertEqual(self.read('a.tgz'), data)
+        self.assertEqual(self.server.requests, [('/Packages/a.tgz', 'bytes=100000-')])
+
+    def test_resume_complete_partial(self):
+        data, checksum = self.add_file('a.tgz', 1000)
+        with open(os.path.join(self.dir, 'a.tgz.part'), 'wb') as f:
+            f.write(data)
+        self.assertTrue(self.fetch('a.tgz', checksum))
+        self.assertEqual(self.read('a.tgz'), data)
+
+    def test_dropped_connection(self):
+        data, checksum = self.add_file('a.tgz', 300000)
+        self.server.drop = 120000
+        self.assertTrue(self.fetch('a.tgz', checksum))
+        self.assertEqual(self.read('a.tgz'), data)
+        self.assertEqual(self.server.requests, [
+            ('/Packages/a.tgz', None),
+            ('/Packages/a.tgz', 'bytes=120000-'),
+        ])
+
+    def test_no_range_support(self):
+        data, checksum = self.add_file('a.tgz', 300000)
+        self.server.ranges = False
+        with open(os.path.join(self.dir, 'a.tgz.part'), 'wb') as f:
+            f.write(data[:100000])
+        self.assertTrue(self.fetch('a.tgz', checksum))
+        self.assertEqual(self.read('a.tgz'), data)
+
+    def test_stale_partial(self):
+        data, checksum = self.add_file('a.tgz', 300000)
+        with open(os.path.join(self.dir, 'a.tgz.part'), 'wb') as f:
+            f.write(os.urandom(100000))
+        self.assertTrue(self.fetch('a.tgz', checksum))
+        self.assertEqual(self.read('a.tgz'), data)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_checksum_mismatch(self):
+        self.add_file('a.tgz', 1000)
+        self.assertFalse(self.fetch('a.tgz', '0' * 64))
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_not_found(self):
+        self.assertFalse(self.fetch('missing.tgz', None))
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_progress(self):
+        reports = []
+
+        def handler(method, filename, size=None, progress=None, download_rate=None):
+            reports.append((size, progress))
+
+        progress = Download.DownloadProgress(handler)
+        files = {}
+        for name in ('a.tgz', 'b.tgz'):
+            files[name] = self.add_file(name, 200000)
+            progress.Expect(name, 200000)
+        self.server.drop = 50000
+        threads = [
+            threading.Thread(
+                target=self.fetch,
+                args=(name, files[name][1]),
+                kwargs={'progress': progress, 'key': name},
+            )
+            for name in files
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for name, (data, checksum) in files.items():
+            self.assertEqual(self.read(name), data)
+        self.assertEqual(reports[-1], (400000, 100))
+        self.assertEqual(
+            [p for s, p in reports], sorted(p for s, p in reports)
+        )
+
+    def test_manager(self):
+        pkgs = []
+        for i in range(6):
+            data, checksum = self.add_file('p%d.tgz' % i, 100000 + i)
+            pkgs.append(Package('p%d' % i, checksum, len(data)))
+        # Only the full package exists for p0
+        pkgs[0].delta = 'p0-delta.tgz'
+        started = []
+
+        def check_handler(index, pkg, pkgList):
+            started.append(index)
+
+        manager = Download.DownloadManager(
+            Configuration(),
+            self.dir,
+            check_handler=check_handler,
+            connections=3,
+            server=self.url,
+        )
+        manager._opener = self.opener
+        self.assertTrue(manager.Download(pkgs))
+        self.assertEqual(sorted(started), range(1, 7))
+        for pkg in pkgs:
+            self.assertEqual(
+                self.read(pkg.FileName()),
+                self.server.files['/Packages/' + pkg.FileName()],
+            )
+        self.assertIn(('/Packages/p0-delta.tgz', None), self.server.requests)
+
+
+class Package(object):
+
+    def __init__(self, name, checksum, size):
+        self.name = name
+        self.checksum = checksum
+        self.size = size
+        self.delta = None
+
+    def Name(self):
+        return self.name
+
+    def FileName(self):
+        return '%s.tgz' % self.name
+
+    def Size(self):
+        return self.size
+
+
+class Configuration(object):
+
+    def SystemManifest(self):
+        return None
+
+    def PackageFileCandidates(self, pkg):
+        files = [{'Filename': pkg.FileName(), 'Checksum': pkg.checksum}]
+        if pkg.delta:
+            files.append({'Filename': pkg.delta, 'Checksum': None})
+        return files
+
+    def FindLocalPackageFile(self, package_files):
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Tests for freenasOS.Configuration.PackageDB, using a database in a
+# scratch directory.
+#
+# Usage:
+#     python test_pkgdb.py
+#
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append('/usr/local/lib')
+
+from freenasOS import Configuration
+
+
+class PackageDBTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='test_pkgdb.')
+        self.pkgdb = Configuration.PackageDB(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def paths(self, pkg='base'):
+        return sorted(f['path'] for f in self.pkgdb.FindFilesForPackage(pkg))
+
+    def test_add_file(self):
+        self.pkgdb.AddFile('base', '/a', 'file', 'abc')
+        self.pkgdb.AddFile('base', '/a', 'file', 'def', mode=0644)
+        row = self.pkgdb.FindFile('/a')
+        self.assertEqual((row['checksum'], row['mode']), ('def', 0644))
+
+    def test_remove_file_entries(self):
+        self.pkgdb.AddFilesBulk([
+            ('base', '/%d' % i, 'file', '', 0, 0, 0, 0644) for i in range(5)
+        ])
+        self.pkgdb.RemoveFileEntries(['/1', '/3', '/missing'])
+        self.pkgdb.RemoveFileEntry('/4')
+        self.assertEqual(self.paths(), ['/0', '/2'])
+
+    def test_transaction(self):
+        with self.pkgdb.Transaction():
+            self.pkgdb.AddPackage('base', '1.0', {'post-install': 'true'})
+            with self.pkgdb.Transaction():
+                self.pkgdb.AddFile('base', '/a', 'file')
+            # Not visible to another connection until committed
+            other = Configuration.PackageDB(self.root)
+            self.assertEqual(other.FindPackage('base'), None)
+            self.assertEqual(self.pkgdb.FindPackage('base'), {'base': '1.0'})
+        self.assertEqual(other.FindPackage('base'), {'base': '1.0'})
+        self.assertEqual(other.FindFile('/a')['package'], 'base')
+
+    def test_rollback(self):
+        self.pkgdb.AddPackage('base', '1.0', None)
+        self.pkgdb.AddFile('base', '/a', 'file')
+        try:
+            with self.pkgdb.Transaction():
+                self.pkgdb.RemoveFileEntry('/a')
+                self.pkgdb.UpdatePackage('base', '1.0', '2.0', None)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(self.pkgdb.FindPackage('base'), {'base': '1.0'})
+        self.assertEqual(self.paths(), ['/a'])
+
+    def test_remove_package_contents(self):
+        self.pkgdb.AddPackage('base', '1.0', None)
+        self.pkgdb.AddFilesBulk([
+            ('base', self.root + '/missing', 'file', '', 0, 0, 0, 0644),
+            ('base', self.root + '/dir', 'dir', '', 0, 0, 0, 0755),
+        ])
+        with self.pkgdb.Transaction():
+            self.assertTrue(self.pkgdb.RemovePackageContents('base'))
+            self.pkgdb.RemovePackage('base')
+        self.assertEqual(self.pkgdb.FindPackage('base'), None)
+        self.assertEqual(self.paths(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
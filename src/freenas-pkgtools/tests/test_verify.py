@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# Tests for freenasOS.Configuration.do_verify, run against files and
+# a package database in a scratch directory.
+#
+# Usage:
+#     python test_verify.py
+#
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append('/usr/local/lib')
+
+from freenasOS import Configuration
+
+
+class VerifyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='test_verify.')
+        self.db_name = Configuration.PackageDB.DB_NAME
+        self.skip_paths = Configuration.VERIFY_SKIP_PATHS
+        # do_verify() uses the database of the running system
+        Configuration.PackageDB.DB_NAME = self.root[1:] + '/pkgdb/freenas-db'
+        Configuration.VERIFY_SKIP_PATHS = []
+        self.pkgdb = Configuration.PackageDB('')
+        entries = []
+        for pkg in ('base', 'extra'):
+            self.pkgdb.AddPackage(pkg, '1.0', None)
+            for i in range(50):
+                entries.append(self.add_file(pkg, '%s%d' % (pkg, i)))
+        self.pkgdb.AddFilesBulk(entries)
+        self.calls = []
+
+    def tearDown(self):
+        Configuration.PackageDB.DB_NAME = self.db_name
+        Configuration.VERIFY_SKIP_PATHS = self.skip_paths
+        shutil.rmtree(self.root)
+
+    def add_file(self, pkg, name):
+        path = os.path.join(self.root, name)
+        data = os.urandom(10000)
+        with open(path, 'wb') as f:
+            f.write(data)
+        st = os.lstat(path)
+        return (
+            pkg, path, 'file', hashlib.sha256(data).hexdigest(),
+            st.st_uid, st.st_gid, 0, st.st_mode & 07777,
+        )
+
+    def handler(self, index, total, path):
+        self.calls.append((index, total))
+
+    def verify(self, **kwargs):
+        error_flag, errors, warn_flag, warnings = Configuration.do_verify(
+            self.handler, **kwargs
+        )
+        return error_flag, dict(
+            (k, sorted(os.path.basename(e['path']) for e in v))
+            for k, v in errors.items()
+        )
+
+    def test_verify(self):
+        for workers in (1, 4):
+            self.calls = []
+            self.assertEqual(self.verify(workers=workers), (False, {
+                'checksum': [], 'notfound': [], 'wrongtype': [],
+            }))
+            self.assertEqual(self.calls[-1], (100, 100))
+            self.assertEqual(self.calls, sorted(self.calls))
+
+    def test_errors(self):
+        with open(os.path.join(self.root, 'base1'), 'ab') as f:
+            f.write('x')
+        os.unlink(os.path.join(self.root, 'extra2'))
+        os.unlink(os.path.join(self.root, 'extra3'))
+        os.mkdir(os.path.join(self.root, 'extra3'))
+        self.assertEqual(self.verify(), (True, {
+            'checksum': ['base1'], 'notfound': ['extra2'], 'wrongtype': ['extra3'],
+        }))
+
+    def test_quick(self):
+        path = os.path.join(self.root, 'base1')
+        os.utime(path, (1000000000, 1000000000))
+        self.verify()
+        cache = self.pkgdb.FindVerifyCache()
+        self.assertEqual(len(cache), 100)
+        # Unchanged size, mtime and inode: not hashed again
+        with open(path, 'r+b') as f:
+            f.write('x')
+        os.utime(path, (1000000000, 1000000000))
+        self.assertEqual(self.verify(quick=True)[0], False)
+        self.assertEqual(self.verify()[1]['checksum'], ['base1'])
+        self.assertEqual(self.verify(quick=True)[1]['checksum'], ['base1'])
+
+    def test_handler_error(self):
+        pools = []
+        original = multiprocessing.Pool
+
+        def Pool(*args, **kwargs):
+            pools.append(original(*args, **kwargs))
+            return pools[-1]
+
+        def handler(index, total, path):
+            if index > 10:
+                raise KeyboardInterrupt()
+
+        Configuration.multiprocessing.Pool = Pool
+        try:
+            self.assertRaises(
+                KeyboardInterrupt, Configuration.do_verify, handler, workers=4,
+            )
+        finally:
+            Configuration.multiprocessing.Pool = original
+        # The workers are stopped rather than left to hash the rest
+        self.assertEqual(pools[0]._state, multiprocessing.pool.TERMINATE)
+
+    def test_package(self):
+        with open(os.path.join(self.root, 'base1'), 'ab') as f:
+            f.write('x')
+        self.assertEqual(self.verify(pkgName='extra')[0], False)
+        self.assertEqual(self.calls[-1], (50, 50))
+        self.assertEqual(self.verify(pkgName='base')[1]['checksum'], ['base1'])
+        self.assertRaises(ValueError, self.verify, pkgName='missing')
+
+
+if __name__ == '__main__':
+    unittest.main()
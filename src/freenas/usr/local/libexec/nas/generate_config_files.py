@@ -0,0 +1,42 @@
+#!/usr/local/bin/python
+#
+# Regenerate flat config files (group/master.passwd, exports, crontab)
+# from the config database.  Files are only rewritten, and their
+# services reloaded, when the content changed.
+#
+# Usage: generate_config_files.py passwd|exports|crontab ...
+#
+
+import os
+import sys
+
+sys.path.extend([
+    '/usr/local/www',
+    '/usr/local/www/freenasUI'
+])
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "freenasUI.settings"
+
+from django.db.models.loading import cache
+cache.get_apps()
+
+from freenasUI.common.confgen import RENDERERS, generate
+
+
+def main():
+    names = sys.argv[1:]
+    if not names or [n for n in names if n not in RENDERERS]:
+        print >> sys.stderr, "Usage: %s %s ..." % (
+            os.path.basename(sys.argv[0]),
+            '|'.join(sorted(RENDERERS)),
+        )
+        sys.exit(1)
+
+    try:
+        generate(names)
+    except Exception as e:
+        print >> sys.stderr, "generate_config_files: ERROR: %s" % e
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -65,16 +65,25 @@ def auth_group_config(cf_contents, auth_tag=None, auth_list=None, auth_type=None
 def main():
     """Use the django ORM to generate a config file.  We'll build the
     config file as a series of lines, and once that is done write it
-    out in one go"""
+    out in one go.
+
+    Everything the targets refer to (auth credentials, portal IPs,
+    target-to-extent mappings, disks, zvol sizes) is prefetched with a
+    handful of queries and a single zfs listing, so the cost no longer
+    grows with a query and a fork per LUN.  The file is only replaced
+    when its content changed."""
 
     ctl_config = "/etc/ctl.conf"
     cf_contents = []
 
+    from freenasUI.common.confgen import write_if_changed
+    from freenasUI.middleware.notifier import notifier
     from freenasUI.services.models import iSCSITargetGlobalConfiguration
     from freenasUI.services.models import iSCSITargetPortal
     from freenasUI.services.models import iSCSITargetPortalIP
     from freenasUI.services.models import iSCSITargetAuthCredential
     from freenasUI.services.models import iSCSITarget
+    from freenasUI.services.models import iSCSITargetToExtent
     from freenasUI.storage.models import Disk
 
     gconf = iSCSITargetGlobalConfiguration.objects.order_by('-id')[0]
@@ -88,10 +97,13 @@ def main():
     for auth in iSCSITargetAuthCredential.objects.order_by('iscsi_target_auth_tag'):
         auths[auth.iscsi_target_auth_tag].append(auth)
 
-    auth_ini_created = []
     for auth_tag, auth_list in auths.items():
         auth_group_config(cf_contents, auth_tag, auth_list)
 
+    listen = defaultdict(list)
+    for obj in iSCSITargetPortalIP.objects.order_by('id'):
+        listen[obj.iscsi_target_portalip_portal_id].append(obj)
+
     # Generate the portal-group section
     for portal in iSCSITargetPortal.objects.all():
         cf_contents.append("portal-group pg%s {\n" % portal.iscsi_target_portal_tag)
@@ -101,8 +113,7 @@ def main():
         else:
             cf_contents.append("\tdiscovery-auth-group ag%s\n" %
                                gconf.iscsi_discoveryauthgroup)
-        listen = iSCSITargetPortalIP.objects.filter(iscsi_target_portalip_portal=portal)
-        for obj in listen:
+        for obj in listen[portal.id]:
             if ':' in obj.iscsi_target_portalip_ip:
                 address = '[%s]' % obj.iscsi_target_portalip_ip
             else:
@@ -111,15 +122,47 @@ def main():
                                                      obj.iscsi_target_portalip_port))
         cf_contents.append("}\n\n")
 
+    # Target-to-extent mappings of every target, NULL LUN ids last
+    t2es = defaultdict(list)
+    for t2e in iSCSITargetToExtent.objects.select_related(
+        'iscsi_extent',
+    ).extra({
+        'null_first': 'iscsi_lunid IS NULL',
+    }).order_by('null_first', 'iscsi_lunid'):
+        t2es[t2e.iscsi_target_id].append(t2e)
+
+    # Disk extents store the Disk id as their path
+    _n = notifier()
+    disks = dict((str(disk.id), disk) for disk in Disk.objects.all())
+
     # Cache zpool threshold
     poolthreshold = {}
     zpoollist = zfs.zpool_list()
 
+    # A single listing for the size of every zvol with an avail threshold
+    zvols = {}
+    if [
+        t2e for t2e_list in t2es.values() for t2e in t2e_list
+        if t2e.iscsi_extent.iscsi_target_extent_type != 'Disk' and
+        t2e.iscsi_extent.iscsi_target_extent_avail_threshold
+    ]:
+        zvols = zfs.zfs_list(types=['volume'])
+
+    exists = {}
+
+    def path_exists(path):
+        if path not in exists:
+            exists[path] = os.path.exists(path)
+        return exists[path]
+
     # Generate the target section
     target_basename = gconf.iscsi_basename
-    for target in iSCSITarget.objects.all():
+    for target in iSCSITarget.objects.select_related(
+        'iscsi_target_initiatorgroup',
+        'iscsi_target_portalgroup',
+    ):
         if target.iscsi_target_authgroup:
-            auth_list = iSCSITargetAuthCredential.objects.filter(iscsi_target_auth_tag=target.iscsi_target_authgroup)
+            auth_list = auths.get(target.iscsi_target_authgroup, [])
         else:
             auth_list = []
         agname = '4tg_%d' % target.id
@@ -134,30 +177,28 @@ def main():
         cf_contents.append("\tportal-group pg%d\n" % (
             target.iscsi_target_portalgroup.iscsi_target_portal_tag,
         ))
-        used_lunids = [
+        used_lunids = set(
             o.iscsi_lunid
-            for o in target.iscsitargettoextent_set.all().exclude(
-                iscsi_lunid=None,
-            )
-        ]
+            for o in t2es[target.id]
+            if o.iscsi_lunid is not None
+        )
         cur_lunid = 0
-        for t2e in target.iscsitargettoextent_set.all().extra({
-            'null_first': 'iscsi_lunid IS NULL',
-        }).order_by('null_first', 'iscsi_lunid'):
+        for t2e in t2es[target.id]:
 
             path = t2e.iscsi_extent.iscsi_target_extent_path
             unmap = False
             poolname = None
             lunthreshold = None
             if t2e.iscsi_extent.iscsi_target_extent_type == 'Disk':
-                disk = Disk.objects.filter(id=path).order_by('disk_enabled')
-                if not disk.exists():
+                disk = disks.get(path)
+                if disk is None:
                     continue
-                disk = disk[0]
                 if disk.disk_multipath_name:
                     path = "/dev/multipath/%s" % disk.disk_multipath_name
                 else:
-                    path = "/dev/%s" % disk.identifier_to_device()
+                    path = "/dev/%s" % _n.identifier_to_device(
+                        disk.disk_identifier
+                    )
             else:
                 if not path.startswith("/mnt"):
                     poolname = path.split('/', 2)[1]
@@ -170,12 +211,12 @@ def main():
                             )
                     if t2e.iscsi_extent.iscsi_target_extent_avail_threshold:
                         zvolname = path.split('/', 1)[1]
-                        zfslist = zfs.zfs_list(path=zvolname, types=['volume'])
-                        if zfslist:
-                            lunthreshold = int(zfslist[zvolname].volsize * (t2e.iscsi_extent.iscsi_target_extent_avail_threshold / 100.0))
+                        zvol = zvols.get(zvolname)
+                        if zvol is not None and zvol.volsize:
+                            lunthreshold = int(zvol.volsize * (t2e.iscsi_extent.iscsi_target_extent_avail_threshold / 100.0))
                     path = "/dev/" + path
                     unmap = True
-            if os.path.exists(path):
+            if path_exists(path):
                 cf_contents.append("\t\t\n")
                 if t2e.iscsi_lunid is None:
                     while cur_lunid in used_lunids:
@@ -216,11 +257,7 @@ def main():
                 cf_contents.append("\t\t}\n")
         cf_contents.append("}\n\n")
 
-    fh = open(ctl_config, "w")
-    for line in cf_contents:
-        fh.write(line)
-    fh.close()
-    os.chmod(ctl_config, 0600)
+    write_if_changed(ctl_config, ''.join(cf_contents), mode=0600)
 
 if __name__ == "__main__":
     main()
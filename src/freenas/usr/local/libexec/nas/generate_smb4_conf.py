@@ -20,8 +20,6 @@ os.environ["DJANGO_SETTINGS_MODULE"] = "freenasUI.settings"
 from django.db.models.loading import cache
 cache.get_apps()
 
-from django.db.models import Q
-
 from freenasUI.account.models import (
     bsdUsers,
     bsdGroups,
@@ -32,6 +30,7 @@ from freenasUI.common.freenasldap import (
     FreeNAS_LDAP,
     FLAGS_DBINIT
 )
+from freenasUI.common.nss import getpwnam_many
 from freenasUI.common.pipesubr import pipeopen
 from freenasUI.common.samba import Samba4
 from freenasUI.common.system import (
@@ -69,6 +68,7 @@ from freenasUI.directoryservice.models import (
     DS_TYPE_CIFS
 )
 from freenasUI.directoryservice.utils import get_idmap_object
+from freenasUI.middleware import zfscache
 from freenasUI.middleware.notifier import notifier
 
 from freenasUI.services.models import (
@@ -86,34 +86,99 @@ def smb4_ldap_enabled():
 
     return ret
 
-def is_within_zfs(mountpoint):
-    try:
-        st = os.stat(mountpoint)
-    except:
-        return False
-
-    share_dev = st.st_dev
-    p = pipeopen("zfs list -H -o mountpoint")
-    zfsout = p.communicate()
-    if p.returncode != 0:
-        return False
-    if zfsout:
-        zfsout = zfsout[0]
+class DatasetIndex(object):
+    """
+    Mountpoint -> dataset index built from a single ``zfs list``, along
+    with the st_dev of every mounted dataset and the periodic snapshot
+    tasks by filesystem, so shares are resolved without listing or
+    stat'ing all the datasets again for each one.
+    """
+
+    def __init__(self):
+        self.mountpoints = []
+        self.devices = set()
+        self.tasks = {}
+        self.recursive_tasks = {}
+
+        returncode, zfsout = zfscache.zfs_command(
+            ["/sbin/zfs", "list", "-H", "-o", "mountpoint,name"]
+        )
+        if returncode == 0:
+            for line in zfsout.split('\n'):
+                try:
+                    zfs_mp, zfs_ds = line.split('\t')
+                except ValueError:
+                    continue
+                if zfs_mp in ('-', 'none', 'legacy'):
+                    continue
+                self.mountpoints.append((zfs_mp, zfs_ds))
+                try:
+                    self.devices.add(os.stat(zfs_mp).st_dev)
+                except OSError:
+                    pass
 
-    for mp in zfsout.split('\n'):
-        mp = mp.strip()
-        if mp == '-':
-            continue
+        for task in Task.objects.all():
+            self.tasks.setdefault(task.task_filesystem, task)
+            if task.task_recursive:
+                self.recursive_tasks.setdefault(task.task_filesystem, task)
 
+    def is_within_zfs(self, path):
         try:
-            st = os.stat(mp)
+            st = os.stat(path)
         except:
-            continue
+            return False
+        return st.st_dev in self.devices
+
+    def snapshot_task(self, path):
+        """
+        Periodic snapshot task of the first dataset (in zfs list order)
+        that is either mounted at ``path`` or recursively snapshotted and
+        mounted above it
+        """
+        for zfs_mp, zfs_ds in self.mountpoints:
+            if path == zfs_mp:
+                task = self.tasks.get(zfs_ds)
+            elif path.startswith("%s/" % zfs_mp):
+                task = self.recursive_tasks.get(zfs_ds)
+            else:
+                continue
+            if task is not None:
+                return task
+        return False
+
+
+class Timing(object):
+    """
+    Wall clock time spent in each phase of the config generation,
+    reported on stderr when running with --timing
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.started = time.time()
+
+    def __call__(self, phase):
+        return _TimingPhase(self, phase)
+
+    def report(self, phase, elapsed):
+        if self.enabled:
+            print >> sys.stderr, "%-24s %8.3fs" % (phase, elapsed)
+
+    def total(self):
+        self.report('total', time.time() - self.started)
+
 
-        if st.st_dev == share_dev:
-            return True
+class _TimingPhase(object):
 
-    return False
+    def __init__(self, timing, phase):
+        self.timing = timing
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *args):
+        self.timing.report(self.phase, time.time() - self.start)
 
 
 def get_sysctl(name):
@@ -748,27 +813,21 @@ def generate_smb4_shares(smb4_shares):
     if len(shares) == 0:
         return
 
-    p = pipeopen("zfs list -H -o mountpoint,name")
-    zfsout = p.communicate()[0].split('\n')
-    if p.returncode != 0:
-        zfsout = []
+    datasets = DatasetIndex()
+
+    ad_default_domain = True
+    if activedirectory_enabled():
+        try:
+            ad = ActiveDirectory.objects.all()[0]
+            ad_default_domain = ad.ad_use_default_domain
+        except:
+            pass
 
     for share in shares:
         if not os.path.isdir(share.cifs_path.encode('utf8')) and not share.cifs_home:
             continue
 
-        task = False
-        for line in zfsout:
-            try:
-                zfs_mp, zfs_ds = line.split()
-                if share.cifs_path == zfs_mp or share.cifs_path.startswith("%s/" % zfs_mp):
-                    if share.cifs_path == zfs_mp:
-                        task = Task.objects.filter(task_filesystem = zfs_ds)[0]
-                    else:
-                        task = Task.objects.filter(Q(task_filesystem = zfs_ds) & Q(task_recursive=True))[0]
-                    break
-            except:
-                pass
+        task = datasets.snapshot_task(share.cifs_path)
 
         confset1(smb4_shares, "\n")
         if share.cifs_home:
@@ -777,14 +836,9 @@ def generate_smb4_shares(smb4_shares):
             valid_users_path = "%U"
             valid_users = "%U"
 
-            if activedirectory_enabled():
-                try:
-                    ad = ActiveDirectory.objects.all()[0]
-                    if not ad.ad_use_default_domain:
-                        valid_users_path = "%D/%U"
-                        valid_users = "%D\%U"
-                except:
-                    pass
+            if not ad_default_domain:
+                valid_users_path = "%D/%U"
+                valid_users = "%D\%U"
 
             confset2(smb4_shares, "valid users = %s", valid_users)
 
@@ -811,7 +865,7 @@ def generate_smb4_shares(smb4_shares):
             vfs_objects.append('recycle')
         if task:
             vfs_objects.append('shadow_copy2')
-        if is_within_zfs(share.cifs_path):
+        if datasets.is_within_zfs(share.cifs_path):
             vfs_objects.append('zfsacl')
         vfs_objects.extend(share.cifs_vfsobjects)
 
@@ -1055,16 +1109,16 @@ def smb4_grant_rights():
 def get_groups():
     _groups = {}
 
-    groups = bsdGroups.objects.filter(bsdgrp_builtin=0)
-    for g in groups:
-        key = str(g.bsdgrp_group)
-        _groups[key] = []
-        members = bsdGroupMembership.objects.filter(bsdgrpmember_group=g.id)
-        for m in members:
-             u = bsdUsers.objects.filter(bsdusr_username=m.bsdgrpmember_user)
-             if u:
-                 u = u[0]
-                 _groups[key].append(str(u.bsdusr_username))
+    for g in bsdGroups.objects.filter(bsdgrp_builtin=0):
+        _groups[str(g.bsdgrp_group)] = []
+
+    members = bsdGroupMembership.objects.filter(
+        bsdgrpmember_group__bsdgrp_builtin=0,
+    ).select_related('bsdgrpmember_group', 'bsdgrpmember_user')
+    for m in members:
+        _groups[str(m.bsdgrpmember_group.bsdgrp_group)].append(
+            str(m.bsdgrpmember_user.bsdusr_username)
+        )
 
     return _groups
 
@@ -1079,34 +1133,14 @@ def smb4_import_groups():
             s.group_addmembers(g, groups[g])
 
 
-def smb4_group_mapped(groupmap, group):
-    for gm in groupmap:
-        unixgroup = gm['unixgroup']
-        if group == unixgroup:
-            return True
-
-    return False
-
-
-# Windows no likey
-def smb4_groupname_is_username(group):
-    cmd = "/usr/bin/getent passwd '%s'" % group
-
-    p = pipeopen(cmd)
-    p.communicate()
-    if p.returncode == 0:
-        return True
-
-    return False
-
-
 def smb4_map_groups():
-    groupmap = notifier().groupmap_list()
-    groups = get_groups()
+    _n = notifier()
+    mapped = set(gm['unixgroup'] for gm in _n.groupmap_list())
+    groups = [g for g in get_groups() if g not in mapped]
+    usernames = getpwnam_many(groups)
     for g in groups:
-        if not smb4_group_mapped(groupmap, g) and \
-            not smb4_groupname_is_username(g):
-            notifier().groupmap_add(unixgroup=g, ntgroup=g)
+        if g.lower() not in usernames:
+            _n.groupmap_add(unixgroup=g, ntgroup=g)
 
 
 def main():
@@ -1116,20 +1150,27 @@ def main():
     smb4_conf = []
     smb4_shares = []
 
-    smb4_setup()
+    timing = Timing('--timing' in sys.argv[1:])
+
+    with timing('setup'):
+        smb4_setup()
 
-    old_samba4_datasets = get_old_samba4_datasets()
-    if migration_available(old_samba4_datasets):
-        do_migration(old_samba4_datasets)
+        old_samba4_datasets = get_old_samba4_datasets()
+        if migration_available(old_samba4_datasets):
+            do_migration(old_samba4_datasets)
 
-    role = get_server_role()
+        role = get_server_role()
 
-    generate_smb4_tdb(smb4_tdb)
-    generate_smb4_conf(smb4_conf, role)
-    generate_smb4_shares(smb4_shares)
+    with timing('tdb'):
+        generate_smb4_tdb(smb4_tdb)
+    with timing('conf'):
+        generate_smb4_conf(smb4_conf, role)
+    with timing('shares'):
+        generate_smb4_shares(smb4_shares)
 
     if role == 'dc' and not Samba4().domain_provisioned():
-        provision_smb4()
+        with timing('provision'):
+            provision_smb4()
 
     with open(smb_conf_path, "w") as f:
         for line in smb4_conf:
@@ -1147,12 +1188,16 @@ def main():
     os.close(fd)
 
     if role != 'dc':
-        smb4_import_users(smb_conf_path, tmpfile,
-            "tdbsam:/var/etc/private/passdb.tdb")
-        smb4_map_groups()
-        smb4_grant_rights()
+        with timing('import users'):
+            smb4_import_users(smb_conf_path, tmpfile,
+                "tdbsam:/var/etc/private/passdb.tdb")
+        with timing('map groups'):
+            smb4_map_groups()
+        with timing('grant rights'):
+            smb4_grant_rights()
 
     os.unlink(tmpfile)
+    timing.total()
 
 
 if __name__ == '__main__':
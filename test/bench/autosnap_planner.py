@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# Benchmark the autosnap retention planner using a generated snapshot
+# listing (200k snapshots by default).
+#
+# Usage:
+#     python autosnap_planner.py [-n snapshots] [-d datasets]
+#
+import argparse
+from datetime import datetime, timedelta
+import resource
+import sys
+import time
+
+sys.path.append('/usr/local/www')
+
+from freenasUI.middleware.autosnap import RetentionPlanner
+
+
+class Task(object):
+
+    def __init__(self, interval):
+        self.task_interval = interval
+
+
+def generate_listing(count, datasets, snaptime):
+    """
+    Generate ``count`` lines in the name,freenas:state format, hourly
+    snapshots kept for two weeks spread over ``datasets`` datasets
+    """
+    lines = []
+    per_dataset = max(count // datasets, 1)
+    for i in range(datasets):
+        fs = 'tank/ds%d' % i
+        for j in range(per_dataset):
+            created = snaptime - timedelta(hours=j)
+            lines.append('%s@auto-%s-2w\t%s\n' % (
+                fs,
+                created.strftime('%Y%m%d.%H%M'),
+                'NEW' if j == 0 else '-',
+            ))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='autosnap planner benchmark.')
+    parser.add_argument('-n', '--snapshots', type=int, default=200000,
+                        help='number of generated snapshots')
+    parser.add_argument('-d', '--datasets', type=int, default=200,
+                        help='number of datasets holding them')
+    args = parser.parse_args()
+
+    snaptime = datetime.now().replace(second=0, microsecond=0)
+    lines = generate_listing(args.snapshots, args.datasets, snaptime)
+    tasks = dict(
+        (('tank/ds%d' % i, '2w'), [Task(60)]) for i in range(args.datasets)
+    )
+
+    start = time.time()
+    planner = RetentionPlanner(snaptime, tasks.keys(), ['tank'], [])
+    planner.load(iter(lines))
+    planner.due(tasks)
+    batches = list(planner.destroy_batches())
+    total = time.time() - start
+
+    print "%d snapshots, %d expired in %d zfs destroy" % (
+        planner.timings['snapshots'],
+        sum(len(v) for v in planner.expired.values()),
+        len(batches),
+    )
+    print "load %.3fs due %.3fs total %.3fs" % (
+        planner.timings['load'], planner.timings['due'], total,
+    )
+    print "max rss: %d KB" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+if __name__ == '__main__':
+    main()
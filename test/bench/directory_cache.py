@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Benchmark the directory service cache the way cachetool.py uses it:
+# fill a user and a group cache for a generated domain (100k users by
+# default), count them, walk them, then expire them.
+#
+# Usage:
+#     python directory_cache.py [-n users] [-g groups] [-d cachedir]
+#
+import argparse
+import grp
+import pwd
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append('/usr/local/www')
+
+from freenasUI.common.freenascache import FreeNAS_BaseCache
+
+
+def timed(timings, name, func, *args):
+    start = time.time()
+    ret = func(*args)
+    timings.append((name, time.time() - start))
+    return ret
+
+
+def fill(cache, entries):
+    cache.begin()
+    for key, entry in entries:
+        cache[key] = entry
+    cache.commit()
+
+
+def walk(cache):
+    count = 0
+    for entry in cache:
+        count += 1
+    return count
+
+
+def lookups(cache, count):
+    for i in xrange(0, count, max(count // 1000, 1)):
+        cache.by_uid(10000 + i)
+        cache.search('EXAMPLE\\user%d' % i, limit=20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='directory cache benchmark.')
+    parser.add_argument('-n', '--users', type=int, default=100000,
+                        help='number of generated users')
+    parser.add_argument('-g', '--groups', type=int, default=20000,
+                        help='number of generated groups')
+    parser.add_argument('-d', '--cachedir', default=None,
+                        help='directory to create the caches in')
+    args = parser.parse_args()
+
+    cachedir = args.cachedir or tempfile.mkdtemp(prefix='cachebench')
+
+    users = [(
+        'EXAMPLE\\user%d' % i,
+        pwd.struct_passwd((
+            'EXAMPLE\\user%d' % i, '*', 10000 + i, 10000 + i % args.groups,
+            'User %d' % i, '/home/EXAMPLE/user%d' % i, '/bin/sh',
+        )),
+    ) for i in xrange(args.users)]
+    groups = [(
+        'EXAMPLE\\group%d' % i,
+        grp.struct_group((
+            'EXAMPLE\\group%d' % i, '*', 10000 + i,
+            ['EXAMPLE\\user%d' % j for j in xrange(i, args.users, args.groups)],
+        )),
+    ) for i in xrange(args.groups)]
+
+    timings = []
+    try:
+        ucache = FreeNAS_BaseCache(cachedir + '/.users')
+        gcache = FreeNAS_BaseCache(cachedir + '/.groups')
+
+        timed(timings, 'fill users', fill, ucache, users)
+        timed(timings, 'fill groups', fill, gcache, groups)
+        timed(timings, 'refill users', fill, ucache, users)
+        timed(timings, 'count', lambda: (len(ucache), len(gcache)))
+        walked = timed(timings, 'walk', lambda: walk(ucache) + walk(gcache))
+        timed(timings, 'lookups', lookups, ucache, args.users)
+        timed(timings, 'expire', lambda: (ucache.expire(), gcache.expire()))
+    finally:
+        if not args.cachedir:
+            shutil.rmtree(cachedir)
+
+    print "%d users, %d groups, %d entries walked" % (
+        args.users, args.groups, walked,
+    )
+    for name, duration in timings:
+        print "%-12s %.3fs" % (name, duration)
+    print "max rss: %d KB" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Benchmark GEOM lookups done through per-disk xpath queries against the
+# indexed GeomTopology using a synthetic kern.geom.confxml.
+#
+# Usage:
+#     python geom_topology.py [-d disks]
+#
+import argparse
+import sys
+import time
+import uuid
+
+sys.path.append('/usr/local/www')
+
+from lxml import etree
+
+from freenasUI.middleware.geom import GeomTopology
+
+
+def generate_confxml(ndisks):
+    """
+    Generate a confxml with ``ndisks`` disks, each holding a GPT with
+    a swap and a freebsd-zfs partition plus the matching gptid labels
+    """
+    ids = iter(xrange(1, ndisks * 20))
+
+    def nextid():
+        return '0x%x' % next(ids)
+
+    mesh = etree.Element('mesh')
+    disk_class = etree.SubElement(mesh, 'class', id=nextid())
+    etree.SubElement(disk_class, 'name').text = 'DISK'
+    part_class = etree.SubElement(mesh, 'class', id=nextid())
+    etree.SubElement(part_class, 'name').text = 'PART'
+    label_class = etree.SubElement(mesh, 'class', id=nextid())
+    etree.SubElement(label_class, 'name').text = 'LABEL'
+    dev_class = etree.SubElement(mesh, 'class', id=nextid())
+    etree.SubElement(dev_class, 'name').text = 'DEV'
+
+    disks = []
+    for i in xrange(ndisks):
+        name = 'da%d' % i
+        geom = etree.SubElement(disk_class, 'geom', id=nextid())
+        etree.SubElement(geom, 'name').text = name
+        disk_prov = etree.SubElement(geom, 'provider', id=nextid())
+        etree.SubElement(disk_prov, 'name').text = name
+        etree.SubElement(disk_prov, 'mediasize').text = str(4000787030016)
+        config = etree.SubElement(disk_prov, 'config')
+        etree.SubElement(config, 'lunid').text = '5000c500%08x' % i
+
+        geom = etree.SubElement(dev_class, 'geom', id=nextid())
+        etree.SubElement(geom, 'name').text = name
+        consumer = etree.SubElement(geom, 'consumer', id=nextid())
+        etree.SubElement(consumer, 'provider', ref=disk_prov.get('id'))
+
+        geom = etree.SubElement(part_class, 'geom', id=nextid())
+        etree.SubElement(geom, 'name').text = name
+        consumer = etree.SubElement(geom, 'consumer', id=nextid())
+        etree.SubElement(consumer, 'provider', ref=disk_prov.get('id'))
+        rawuuid = None
+        for idx, parttype in enumerate(('freebsd-swap', 'freebsd-zfs'), 1):
+            prov = etree.SubElement(geom, 'provider', id=nextid())
+            etree.SubElement(prov, 'name').text = '%sp%d' % (name, idx)
+            config = etree.SubElement(prov, 'config')
+            etree.SubElement(config, 'type').text = parttype
+            rawuuid = str(uuid.uuid4())
+            etree.SubElement(config, 'rawuuid').text = rawuuid
+
+            label = etree.SubElement(label_class, 'geom', id=nextid())
+            etree.SubElement(label, 'name').text = '%sp%d' % (name, idx)
+            consumer = etree.SubElement(label, 'consumer', id=nextid())
+            etree.SubElement(consumer, 'provider', ref=prov.get('id'))
+            lprov = etree.SubElement(label, 'provider', id=nextid())
+            etree.SubElement(lprov, 'name').text = 'gptid/%s' % rawuuid
+
+        disks.append((name, rawuuid))
+    return etree.tostring(mesh), disks
+
+
+def bench_xpath(doc, disks):
+    for name, rawuuid in disks:
+        doc.xpath("//class[name = 'PART']/..//*[name = '%s']//config[type = 'freebsd-zfs']/rawuuid" % name)
+        doc.xpath("//class[name = 'PART']/geom//config[rawuuid = '%s']/../../name" % rawuuid)
+        doc.xpath("//class[name = 'LABEL']/geom//provider[name = 'gptid/%s']/../name" % rawuuid)
+        doc.xpath("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % name)
+
+
+def bench_topology(doc, disks):
+    topology = GeomTopology(doc)
+    for name, rawuuid in disks:
+        topology.part_rawuuid(name, 'freebsd-zfs')
+        topology.geoms_by_rawuuid(rawuuid)
+        topology.label_geom('gptid/%s' % rawuuid)
+        topology.disk_mediasize(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GEOM lookup benchmark.')
+    parser.add_argument('-d', '--disks', type=int, default=500,
+                        help='number of synthetic disks')
+    args = parser.parse_args()
+
+    confxml, disks = generate_confxml(args.disks)
+    doc = etree.fromstring(confxml)
+    print "confxml: %d disks, %d bytes" % (args.disks, len(confxml))
+
+    for name, func in (
+        ('xpath', bench_xpath),
+        ('topology', bench_topology),
+    ):
+        start = time.time()
+        func(doc, disks)
+        print "%-10s %8.3fs" % (name, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# Benchmark the cost of running a notifier method from a shell script,
+# standalone notifier.py against notifier_client.py through notifierd.
+#
+# Usage:
+#     python notifier_startup.py [-n calls] [method [args...]]
+#
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+MIDDLEWARE = '/usr/local/www/freenasUI/middleware'
+
+
+def bench(script, argv, count):
+    """
+    Run ``script`` with ``argv`` ``count`` times
+
+    Returns:
+        list of seconds per call
+    """
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(count):
+            start = time.time()
+            subprocess.call(
+                [sys.executable, os.path.join(MIDDLEWARE, script)] + argv,
+                stdout=devnull,
+                stderr=devnull,
+            )
+            timings.append(time.time() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='notifier startup benchmark.')
+    parser.add_argument('-n', '--calls', type=int, default=10,
+                        help='number of calls for each entry point')
+    parser.add_argument('argv', nargs='*', default=['get_train'],
+                        help='notifier method and arguments')
+    args = parser.parse_args()
+
+    for script in ('notifier.py', 'notifier_client.py'):
+        timings = sorted(bench(script, args.argv, args.calls))
+        print "%-20s min %.3fs median %.3fs max %.3fs" % (
+            script, timings[0], timings[len(timings) // 2], timings[-1],
+        )
+
+
+if __name__ == '__main__':
+    main()
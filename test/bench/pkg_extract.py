@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+# Benchmark package installation (freenasOS.Installer.install_path)
+# using a generated package (50k files by default) installed into a
+# scratch root.
+#
+# Usage:
+#     python pkg_extract.py [-n files] [-s size] [-l large] [-z]
+#
+import argparse
+import hashlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from cStringIO import StringIO
+
+sys.path.append('/usr/local/lib')
+
+from freenasOS import Installer
+
+
+def add_member(tf, name, data=None, fileobj=None, size=None):
+    ti = tarfile.TarInfo(name)
+    ti.size = len(data) if data is not None else size
+    ti.mode = 0644
+    ti.mtime = time.time()
+    tf.addfile(ti, StringIO(data) if data is not None else fileobj)
+
+
+def generate_package(path, workdir, count, size, large, compress):
+    """
+    Generate a package holding ``count`` files of ``size`` bytes spread
+    over 100 directories, plus one file of ``large`` MB.  Nothing is
+    kept in memory so the generation does not inflate max rss.
+    """
+    block = os.urandom(size)
+
+    def members():
+        for i in range(count):
+            yield 'bench/d%02d/f%06d' % (i % 100, i), block[i % size:] + block[:i % size]
+
+    files = {}
+    for name, data in members():
+        files['/' + name] = hashlib.sha256(data).hexdigest()
+
+    largefile = os.path.join(workdir, 'large')
+    if large:
+        sha = hashlib.sha256()
+        with open(largefile, 'wb') as f:
+            for i in range(large):
+                chunk = os.urandom(1024 * 1024)
+                sha.update(chunk)
+                f.write(chunk)
+        files['/bench/large'] = sha.hexdigest()
+
+    manifest = json.dumps({
+        'name': 'bench-pkg',
+        'version': '1.0',
+        'prefix': '/',
+        'files': files,
+        'directories': {},
+    })
+
+    tf = tarfile.open(path, 'w:gz' if compress else 'w')
+    add_member(tf, '+MANIFEST', manifest)
+    for name, data in members():
+        add_member(tf, name, data)
+    if large:
+        with open(largefile, 'rb') as f:
+            add_member(tf, 'bench/large', fileobj=f, size=large * 1024 * 1024)
+        os.unlink(largefile)
+    tf.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='package extraction benchmark.')
+    parser.add_argument('-n', '--files', type=int, default=50000,
+                        help='number of generated files')
+    parser.add_argument('-s', '--size', type=int, default=4096,
+                        help='size of each file in bytes')
+    parser.add_argument('-l', '--large', type=int, default=256,
+                        help='size of the one large file in MB')
+    parser.add_argument('-z', '--compress', action='store_true',
+                        help='gzip the package')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='pkg_extract.')
+    try:
+        pkgfile = os.path.join(workdir, 'bench.tgz' if args.compress else 'bench.tar')
+        generate_package(
+            pkgfile, workdir, args.files, args.size, args.large, args.compress,
+        )
+        dest = os.path.join(workdir, 'root')
+        os.mkdir(dest)
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        if not Installer.install_path(pkgfile, dest):
+            print >> sys.stderr, "Installation failed"
+            sys.exit(1)
+        print "install %6d files %8.3fs" % (args.files, time.time() - start)
+        print "max rss: %d KB (%d KB before installing)" % (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, rss,
+        )
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# Benchmark the package database side of package installation
+# (freenasOS.Installer.install_path): install a generated package
+# (20k files by default), upgrade it with a delta package removing
+# half of them, then reinstall it from a full package, into a scratch
+# root.
+#
+# Usage:
+#     python pkg_install.py [-n files] [--no-transaction]
+#
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from cStringIO import StringIO
+
+sys.path.append('/usr/local/lib')
+
+from freenasOS import Configuration, Installer
+
+
+def add_member(tf, name, data):
+    ti = tarfile.TarInfo(name)
+    ti.size = len(data)
+    ti.mode = 0644
+    ti.mtime = time.time()
+    tf.addfile(ti, StringIO(data))
+
+
+def generate_package(path, version, names, removed=None, delta=None):
+    """
+    Generate a package holding an empty file for each of ``names``;
+    a delta package from version ``delta`` if given.
+    """
+    manifest = {
+        'name': 'bench-pkg',
+        'version': version,
+        'prefix': '/',
+        # The checksum of an empty file
+        'files': dict(
+            ('/' + name, 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855')
+            for name in names
+        ),
+        'directories': {},
+    }
+    if delta:
+        manifest['delta-version'] = {'version': delta, 'style': 'file'}
+        manifest['removed-files'] = ['/' + name for name in removed]
+
+    tf = tarfile.open(path, 'w')
+    add_member(tf, '+MANIFEST', json.dumps(manifest))
+    for name in names:
+        add_member(tf, name, '')
+    tf.close()
+
+
+@contextlib.contextmanager
+def no_transaction(self):
+    yield self
+
+
+def main():
+    parser = argparse.ArgumentParser(description='package install benchmark.')
+    parser.add_argument('-n', '--files', type=int, default=20000,
+                        help='number of files in the package')
+    parser.add_argument('--no-transaction', action='store_true',
+                        help='commit every database change, as before '
+                        'PackageDB.Transaction')
+    args = parser.parse_args()
+
+    if args.no_transaction:
+        Configuration.PackageDB.Transaction = no_transaction
+
+    workdir = tempfile.mkdtemp(prefix='pkg_install.')
+    try:
+        names = ['bench/d%02d/f%06d' % (i % 100, i) for i in range(args.files)]
+        kept = names[:len(names) / 2]
+        packages = [
+            ('install', '1.0', names, None, None),
+            ('delta', '2.0', [], names[len(kept):], '1.0'),
+            ('reinstall', '3.0', kept, None, None),
+        ]
+        dest = os.path.join(workdir, 'root')
+        os.mkdir(dest)
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for phase, version, members, removed, delta in packages:
+            pkgfile = os.path.join(workdir, '%s.tar' % phase)
+            generate_package(pkgfile, version, members, removed, delta)
+            start = time.time()
+            if not Installer.install_path(pkgfile, dest):
+                print >> sys.stderr, "Installation failed"
+                sys.exit(1)
+            print "%-9s %6d files %8.3fs" % (
+                phase, len(members) + len(removed or []), time.time() - start,
+            )
+        print "max rss: %d KB (%d KB before installing)" % (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, rss,
+        )
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
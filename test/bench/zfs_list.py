@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#
+# Benchmark parsing of ``zfs list -p -H`` output using a generated
+# listing (50k datasets by default).
+#
+# Usage:
+#     python zfs_list.py [-n datasets]
+#
+import argparse
+import resource
+import sys
+import time
+
+sys.path.append('/usr/local/www')
+
+from freenasUI.middleware.zfs import parse_zfs_list
+
+
+def generate_listing(count, fanout=20):
+    """
+    Generate ``count`` lines in the space,refer,mountpoint,type,volsize
+    format, nested ``fanout`` children per dataset
+    """
+    lines = ['tank\t1000\t2000\t0\t100\t0\t1900\t100\t/mnt/tank\tfilesystem\t-\n']
+    paths = ['tank']
+    idx = 0
+    while len(lines) < count:
+        parent = paths[idx // fanout]
+        path = '%s/ds%d' % (parent, idx)
+        if idx % 10 == 9:
+            lines.append('%s\t1000\t2000\t0\t2000\t0\t0\t2000\t-\tvolume\t%d\n' % (
+                path, 2 ** 30,
+            ))
+        else:
+            lines.append('%s\t1000\t2000\t0\t100\t0\t1900\t100\t/mnt/%s\tfilesystem\t-\n' % (
+                path, path,
+            ))
+            paths.append(path)
+        idx += 1
+    # zfs list -s name
+    lines.sort()
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='zfs list parser benchmark.')
+    parser.add_argument('-n', '--datasets', type=int, default=50000,
+                        help='number of generated datasets')
+    args = parser.parse_args()
+
+    lines = generate_listing(args.datasets)
+    for hierarchical in (False, True):
+        start = time.time()
+        zfslist = parse_zfs_list(iter(lines), hierarchical=hierarchical)
+        print "hierarchical=%-5s %6d top-level %8.3fs" % (
+            hierarchical, len(zfslist), time.time() - start,
+        )
+    print "max rss: %d KB" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+if __name__ == '__main__':
+    main()